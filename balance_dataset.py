@@ -10,27 +10,61 @@ import os
 import shutil
 import cv2
 import numpy as np
-from PIL import Image
+from functools import partial
 from pathlib import Path
 
-def calculate_image_quality(image_path):
+from instrumentation import StageReport, file_size
+from image_cache import imread, open_image_cache
+from executor import Executor, open_executor, print_errors
+from perceptual_hash import DEDUPE_RADIUS, group_near_duplicates, hash_image
+from token_budget import image_info
+from stage_journal import StageJournal, atomic_copy, journal_exists, journaled_imap, remove_temp_files
+
+# If set to 2, 4 or 8, images are first scored on a frame decoded at that fraction of the
+# resolution and only the ones near the selection cutoff are rescored at full resolution
+QUALITY_SCALE_ENV = 'QUALITY_SCORE_SCALE'
+REDUCED_GRAYSCALE = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+# Fraction of a category's images on each side of the cutoff that is rescored exactly
+RESCORE_MARGIN = 0.1
+
+def calculate_image_quality(image_path, image_cache=None):
     """
     Calculate image quality score based on actual image characteristics.
     Higher score indicates better quality.
     """
     # Read image
-    img = cv2.imread(str(image_path))
+    img = imread(image_path, cv2.IMREAD_COLOR, image_cache)
     if img is None:
         return 0
-    
+    return image_quality(img)
+
+def approximate_image_quality(image_path, scale, image_cache=None):
+    """
+    calculate_image_quality on the frame decoded at 1/scale of its resolution (2, 4 or 8).
+
+    Much cheaper to decode and filter, and close enough to rank the images; the resolution
+    term still uses the full size from the PNG header.
+    """
+    gray = imread(image_path, REDUCED_GRAYSCALE[scale], image_cache)
+    if gray is None:
+        return 0
+    size, _ = image_info(image_path)
+    return grayscale_quality(gray, size)
+
+def image_quality(img):
+    """Quality score of a decoded BGR image (see calculate_image_quality)."""
     # Convert to grayscale
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
+    return grayscale_quality(gray)
+
+def grayscale_quality(gray, size=None):
+    """Quality score of a grayscale frame; size is the (width, height) of the full frame if gray is reduced."""
     # Calculate quality metrics
     metrics = {}
     
     # 1. Resolution score (normalized by typical ultrasound resolution)
-    height, width = gray.shape
+    width, height = size or gray.shape[::-1]
     resolution_score = min((width * height) / (800 * 600), 1.0)  # Normalize to typical ultrasound resolution
     metrics['resolution'] = resolution_score
     
@@ -60,7 +94,87 @@ def calculate_image_quality(image_path):
     final_score = sum(metrics[metric] * weight for metric, weight in weights.items())
     return final_score
 
-def create_balanced_dataset(source_dir, target_dir):
+def journal_key(kind, path):
+    """Journal key of one piece of work on a <split>/<category>/<name>.png image."""
+    path = Path(path)
+    return f"{kind}:{path.parent.parent.name}/{path.parent.name}/{path.name}"
+
+def drop_near_duplicates(images, radius, image_cache=None, executor=None, journal=None):
+    """Keep one image (the first by name) from each group of near-duplicate images."""
+    executor = executor or Executor()
+    images = sorted(images, key=lambda img: img.name)
+    hashes = {}
+    for result in journaled_imap(executor, partial(hash_image, image_cache=image_cache), images, journal,
+                                 key=partial(journal_key, 'hash')):
+        if result.ok and result.value is not None:
+            # Journaled fingerprints come back as lists
+            hashes[result.item] = tuple(result.value)
+    groups = group_near_duplicates(hashes, radius)
+    return [img for img in images if groups.get(img, img) == img]
+
+def score_images(images, score, executor=None, journal=None, kind='score', phase=None):
+    """
+    Score images on executor, reusing the journaled scores of kind.
+
+    Returns ([(image, score)] in input order, failures as 'image: error'); an image that
+    fails to score gets 0.
+    """
+    executor = executor or Executor()
+    image_scores = []
+    results = []
+    for result in journaled_imap(executor, score, images, journal, key=partial(journal_key, kind)):
+        results.append(result)
+        if phase is not None:
+            if result.ok:
+                phase.tick(bytes_read=file_size(result.item))
+            else:
+                phase.error()
+        image_scores.append((result.item, result.value if result.ok else 0))
+    return image_scores, print_errors(results)
+
+def rescore_near_cutoff(ranked, count, score, margin=RESCORE_MARGIN, executor=None, journal=None, phase=None):
+    """
+    Refine an approximate ranking around the selection cutoff.
+
+    ranked is [(image, approximate score)], best first, of which the first count are
+    selected. The images within margin (a fraction of len(ranked)) of the cutoff are
+    rescored with score and reordered by it; the rest keep their approximate places.
+    Returns (ranking, failures).
+    """
+    if count <= 0 or count >= len(ranked):
+        # Everything or nothing is selected, so the order does not matter
+        return ranked, []
+    band = max(1, int(np.ceil(margin * len(ranked))))
+    start, stop = max(count - band, 0), min(count + band, len(ranked))
+    rescored, failures = score_images([img for img, _ in ranked[start:stop]], score, executor, journal, 'score',
+                                      phase)
+    rescored.sort(key=lambda x: x[1], reverse=True)
+    return ranked[:start] + rescored + ranked[stop:], failures
+
+def create_balanced_dataset(source_dir, target_dir, report=None, image_cache=None, dedupe_radius=None,
+                            executor=None, journal=None, quality_scale=None):
+    """
+    Select the highest quality normal/benign images per split to match the malignant count.
+
+    If dedupe_radius is set, redundant near-duplicate copies are dropped from every
+    category before counting and scoring. Hashing and scoring run on executor (serial if
+    not given); an image that fails to score gets 0 and is listed in the report. If journal
+    (a StageJournal) is given, hashes, scores and copies are journaled and the ones an
+    interrupted run already finished are skipped. If quality_scale (2, 4 or 8) is set,
+    images are ranked by approximate_image_quality and only the ones near the cutoff are
+    rescored at full resolution.
+    """
+    report = report or StageReport('balance_dataset')
+    executor = executor or Executor()
+    score = partial(calculate_image_quality, image_cache=image_cache)
+    if quality_scale is not None:
+        if quality_scale not in REDUCED_GRAYSCALE:
+            raise ValueError(f"Quality scale must be one of {', '.join(map(str, REDUCED_GRAYSCALE))}")
+        approximate = partial(approximate_image_quality, scale=quality_scale, image_cache=image_cache)
+        report.set('quality_scale', quality_scale)
+    dropped = 0
+    errors = []
+    
     # Create target directory structure
     for split in ['train', 'val', 'test']:
         for category in ['normal', 'benign', 'malignant']:
@@ -77,6 +191,15 @@ def create_balanced_dataset(source_dir, target_dir):
             source_path = Path(source_dir) / split / category
             if source_path.exists():
                 images = list(source_path.glob('*.png'))
+                if dedupe_radius is not None:
+                    with report.phase(f"dedupe_{split}_{category}", total=len(images)) as phase:
+                        unique_images = drop_near_duplicates(images, dedupe_radius, image_cache, executor,
+                                                             journal)
+                        phase.tick(len(images))
+                    if len(unique_images) < len(images):
+                        print(f"{category}: dropped {len(images) - len(unique_images)} near-duplicate images")
+                        dropped += len(images) - len(unique_images)
+                    images = unique_images
                 categories[category] = images
                 print(f"{category}: {len(images)} images")
         
@@ -89,8 +212,19 @@ def create_balanced_dataset(source_dir, target_dir):
         for category, images in categories.items():
             if category in ['normal', 'benign']:
                 # For normal and benign categories, select highest quality images up to smallest_count
-                image_scores = [(img, calculate_image_quality(img)) for img in images]
+                with report.phase(f"score_{split}_{category}", total=len(images)) as phase:
+                    if quality_scale is None:
+                        image_scores, failures = score_images(images, score, executor, journal, 'score', phase)
+                    else:
+                        image_scores, failures = score_images(images, approximate, executor, journal,
+                                                              f"approx{quality_scale}", phase)
+                    errors += failures
                 image_scores.sort(key=lambda x: x[1], reverse=True)
+                if quality_scale is not None:
+                    with report.phase(f"rescore_{split}_{category}", total=0) as phase:
+                        image_scores, failures = rescore_near_cutoff(image_scores, smallest_count, score,
+                                                                     executor=executor, journal=journal, phase=phase)
+                        errors += failures
                 selected_images = [img for img, _ in image_scores[:smallest_count]]
                 print(f"Selected {len(selected_images)} highest quality images from {category} category")
             else:
@@ -99,22 +233,51 @@ def create_balanced_dataset(source_dir, target_dir):
                 print(f"Keeping all {len(selected_images)} images from {category} category")
             
             # Copy selected images
-            for img in selected_images:
-                target_path = Path(target_dir) / split / category / img.name
-                shutil.copy2(img, target_path)
+            with report.phase(f"copy_{split}_{category}", total=0) as phase:
+                for img in selected_images:
+                    target_path = Path(target_dir) / split / category / img.name
+                    key = journal_key('copy', img)
+                    if journal is not None and journal.lookup(key, img)[0] and target_path.exists():
+                        continue
+                    atomic_copy(img, target_path)
+                    if journal is not None:
+                        journal.record(key, None, img)
+                    size = file_size(target_path)
+                    phase.tick(bytes_read=size, bytes_written=size)
+    
+    if dedupe_radius is not None:
+        report.set('near_duplicates_dropped', dropped)
+    if errors:
+        report.set('errors', errors)
 
 def main():
     source_dir = "partitioned_dataset"
     target_dir = "balanced_dataset"
     
-    # Remove existing balanced dataset if it exists
-    if os.path.exists(target_dir):
+    # Remove the existing balanced dataset, unless an interrupted run left its journal to resume
+    if os.path.exists(target_dir) and not journal_exists(target_dir, 'balance_dataset'):
         shutil.rmtree(target_dir)
     
     # Create balanced dataset
-    create_balanced_dataset(source_dir, target_dir)
+    report = StageReport('balance_dataset')
+    image_cache = open_image_cache()
+    os.makedirs(target_dir, exist_ok=True)
+    remove_temp_files(target_dir)
+    journal = StageJournal(target_dir, 'balance_dataset')
+    if journal.resumed:
+        print(f"Resuming: {len(journal)} hashes, scores and copies already done")
+        report.set('resumed', len(journal))
+    with open_executor() as executor:
+        create_balanced_dataset(source_dir, target_dir, report=report, image_cache=image_cache,
+                                dedupe_radius=DEDUPE_RADIUS, executor=executor, journal=journal,
+                                quality_scale=int(os.environ.get(QUALITY_SCALE_ENV) or 0) or None)
+    journal.finish()
+    if image_cache is not None:
+        report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+        image_cache.close()
     
     print("\nBalanced dataset creation complete!")
+    report.write()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
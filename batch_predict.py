@@ -1,12 +1,41 @@
 """
 Run batch prediction on the fine-tuned model.
 
+With PROMPT_CONTEXT_CACHE set, the static prompt prefix is registered once as cached content
+and the requests carry only the image and the rest of the prompt. The model is a tuned one, so
+this only happens once it has passed the agreement check in context_cache.py; if it has not,
+caching is unavailable, or the job fails with cached content, the full prompts are sent instead.
+
 @author: Abhinav Raghavendra
 @year: 2025
 """
 
+import json
+import os
 import subprocess
-from google.cloud import aiplatform
+import time
+from collections import Counter
+
+from instrumentation import StageReport, file_size
+from context_cache import CONTEXT_CACHE_ENV, ContextCache, vertex_cached_contents_url
+from crop_overlays import dataset_dirs
+from convert_batch_format import convert_to_batch_format, effective_prompt, image_key
+from metadata_store import MetadataIndex, read_metadata
+from prediction_cache import estimate_input_tokens, open_prediction_cache, print_savings, request_hash
+from prediction_retrieval import PredictionRetriever
+from triage_model import configured_triage_cascade, triage_response
+from validate_jsonl import local_object_path, validate_files
+
+# Cached content must outlive the batch job that references it
+BATCH_CACHE_TTL_SECONDS = 6 * 3600
+
+class CachedContentRejected(Exception):
+    """The batch job failed because the model does not accept the requests' cached content."""
+
+def rejects_cached_content(error):
+    """Whether a batch job error is about the cachedContent the requests reference."""
+    message = str(error).lower().replace(' ', '').replace('_', '')
+    return 'cachedcontent' in message
 
 def upload_to_gcs(local_file, gcs_path):
     """Upload a file to Google Cloud Storage."""
@@ -20,6 +49,8 @@ def upload_to_gcs(local_file, gcs_path):
 
 def run_batch_prediction(project, location, model_id, gcs_source, gcs_destination):
     """Runs a batch prediction job on Vertex AI."""
+    from google.cloud import aiplatform
+
     print(f"Using model: {model_id}")
     aiplatform.init(project=project, location=location)
     model = aiplatform.Model(model_id)
@@ -35,24 +66,225 @@ def run_batch_prediction(project, location, model_id, gcs_source, gcs_destinatio
     print("Batch prediction job complete. Output at:", batch_prediction_job.output_info.gcs_output_directory)
     return batch_prediction_job.output_info.gcs_output_directory
 
-def main():
-    # First, convert the test dataset to batch prediction format
+def request_identity(request):
+    """(fileUri, prompt) of a batch request, used to match predictions back to requests."""
+    parts = request['contents'][0]['parts']
+    return parts[0]['fileData']['fileUri'], parts[1]['text']
+
+def split_cached_requests(input_file, misses_file, cache, model_id, cascade=None, matched_data='partitioned_dataset'):
+    """
+    Decide which requests of input_file still need the model and write them to misses_file.
+
+    If a TriageCascade is given, requests it is confident about are answered locally from the
+    image metadata in matched_data. The rest are looked up in the prediction cache.
+    Returns (entries, cached): one dict per input line with the request, its cache key (None if
+    the local image is missing), estimated input tokens and triage response (if any), and
+    {key: response} for the cache hits.
+    """
+    metadata_index = None
+    if cascade is not None:
+        metadata_index = MetadataIndex(read_metadata(matched_data, columns=['image_filename'] + cascade.model.columns))
+
+    entries = []
+    with open(input_file) as f:
+        for line in f:
+            request = json.loads(line)['request']
+            file_uri, _ = request_identity(request)
+            # Keyed on what the model sees, so cached and full prompts do not share entries
+            prompt = effective_prompt(request)
+            image_path = local_object_path(file_uri)
+            key, input_tokens = None, 0
+            if image_path.exists():
+                image_bytes = image_path.read_bytes()
+                key = request_hash(image_bytes, prompt)
+                input_tokens = estimate_input_tokens(image_bytes, prompt)
+            triage = None
+            if metadata_index is not None:
+                result = cascade.classify(metadata_index.get(image_key(file_uri), {}))
+                if result is not None:
+                    triage = triage_response(result[0])
+            entries.append({'request': request, 'key': key, 'input_tokens': input_tokens, 'triage': triage})
+
+    keys = [e['key'] for e in entries if e['key'] and e['triage'] is None]
+    cached = cache.get_many(model_id, keys) if cache is not None else {}
+    with open(misses_file, 'w') as f:
+        for entry in entries:
+            if needs_model(entry, cached):
+                f.write(json.dumps({'request': entry['request']}) + '\n')
+    return entries, cached
+
+def needs_model(entry, cached):
+    return entry['triage'] is None and entry['key'] not in cached
+
+def merge_predictions(entries, cached, predictions, output_file, cache=None, model_id=None, seconds_per_request=0.0):
+    """
+    Write one result per input request, in input order, taking triaged and cached results
+    first and the rest from the prediction records (e.g. streamed by a PredictionRetriever).
+    Each result's source is 'triage', 'cache' or 'model'. Successful fresh predictions are
+    added to the cache.
+
+    Rows are written as soon as every earlier row is available, so only records that arrive
+    ahead of the rows before them are held in memory.
+
+    Returns the number of requests without a prediction.
+    """
+    # Requests still waiting for a prediction record, by identity
+    waiting = Counter(request_identity(entry['request']) for entry in entries if needs_model(entry, cached))
+    fresh = {}
+    new_entries = []
+    missing = 0
+    written = 0
+
+    def write_ready(f, final=False):
+        nonlocal missing, written
+        while written < len(entries):
+            entry = entries[written]
+            if entry['triage'] is not None:
+                result = {'request': entry['request'], 'response': entry['triage'], 'source': 'triage'}
+            elif entry['key'] in cached:
+                result = {'request': entry['request'], 'response': cached[entry['key']], 'source': 'cache'}
+            else:
+                identity = request_identity(entry['request'])
+                if identity not in fresh and not final:
+                    return
+                result = fresh.get(identity)
+                waiting[identity] -= 1
+                if not waiting[identity]:
+                    fresh.pop(identity, None)
+                if result is None:
+                    missing += 1
+                    result = {'request': entry['request'], 'status': 'missing from batch output'}
+                elif 'response' in result and entry['key'] is not None:
+                    new_entries.append((entry['key'], result['response'], entry['input_tokens'], seconds_per_request))
+                result = dict(result, source='model')
+            f.write(json.dumps(result) + '\n')
+            written += 1
+
+    with open(output_file, 'w') as f:
+        write_ready(f)
+        for record in predictions:
+            identity = request_identity(record['request'])
+            if waiting[identity]:
+                fresh[identity] = record
+                write_ready(f)
+        write_ready(f, final=True)
+
+    if cache is not None and new_entries:
+        cache.put_many(model_id, new_entries)
+    return missing
+
+def predict_test_set(report, model_id, project, location, cached_content=None):
+    """
+    Convert, triage, look up and predict the test set, writing batch_predictions.jsonl.
+
+    If cached_content is given, the requests reference it instead of carrying the full prompt;
+    CachedContentRejected is raised, before anything is merged, if the job fails because of it.
+    """
+    # First, convert the test dataset to batch prediction format, with prompts built from the
+    # same metadata (cropped frame or not) as the tuning examples
     print("Converting test dataset to batch prediction format...")
-    subprocess.run(['python', 'convert_batch_format.py'], check=True)
+    _, prompt_metadata = dataset_dirs("balanced_dataset", "partitioned_dataset")
+    with report.phase('convert', total=0):
+        convert_to_batch_format("jsonl/balanced_test_dataset.jsonl", "batch_prediction_input.jsonl",
+                                "ground_truth.jsonl", matched_data=prompt_metadata, cached_content=cached_content)
+    
+    # Only requests that neither the triage model (when PIPELINE_TRIAGE enables it) nor the
+    # prediction cache can answer are sent to the model
+    input_file = "batch_prediction_input.jsonl"
+    misses_file = "batch_prediction_misses.jsonl"
+    cascade = configured_triage_cascade()
+    cache = open_prediction_cache()
+    with report.phase('cache_lookup', total=0) as phase:
+        entries, cached = split_cached_requests(input_file, misses_file, cache, model_id, cascade)
+        phase.tick(len(entries))
+    n_misses = sum(1 for entry in entries if needs_model(entry, cached))
+    if cascade is not None:
+        triage_stats = cascade.stats()
+        print(f"Triage model answered {triage_stats['triaged']} of {len(entries)} requests "
+              f"(threshold {cascade.threshold})")
+        report.set('triage', triage_stats)
+    print(f"{len(cached)} of {len(entries)} predictions found in the cache; submitting {n_misses}")
+    report.set('request_bytes', {'total': file_size(misses_file), 'cached_content': cached_content})
     
     # Upload the converted files to GCS
     bucket = "gs://fetus-ultrasound-with-metadata"
-    upload_to_gcs("batch_prediction_input.jsonl", f"{bucket}/batch_prediction_input.jsonl")
-    upload_to_gcs("ground_truth.jsonl", f"{bucket}/ground_truth.jsonl")
-    
-    # Run batch prediction
+    predictions = []
+    seconds_per_request = 0.0
+    if n_misses:
+        # Catch malformed requests before the job spends time queueing on Vertex AI
+        with report.phase('validate', total=0):
+            valid = validate_files([misses_file])
+        if not valid:
+            print(f"Error: {misses_file} failed validation; not submitting the batch job")
+            if cache is not None:
+                cache.close()
+            return
+
+        with report.phase('upload', total=0) as phase:
+            for local_file in [misses_file, "ground_truth.jsonl"]:
+                upload_to_gcs(local_file, f"{bucket}/{local_file}")
+                phase.tick(bytes_read=file_size(local_file))
+        
+        # Run batch prediction
+        gcs_source = f"{bucket}/{misses_file}"
+        gcs_output_prefix = f"{bucket}/batch_predictions/"
+
+        with report.phase('predict', total=0):
+            start = time.perf_counter()
+            try:
+                output_dir = run_batch_prediction(project, location, model_id, gcs_source, gcs_output_prefix)
+            except Exception as e:
+                if cached_content is None or not rejects_cached_content(e):
+                    raise
+                if cache is not None:
+                    cache.close()
+                raise CachedContentRejected(f"{type(e).__name__}: {e}") from e
+            seconds_per_request = (time.perf_counter() - start) / n_misses
+        report.set('gcs_output_directory', output_dir)
+
+        # Shards are downloaded in parallel; merge_predictions writes each row as soon as it and
+        # every row before it have arrived
+        predictions = PredictionRetriever(local_dir="batch_predictions", report=report).iter_predictions(output_dir)
+
+    # Merge triaged, cached and fresh predictions into one output in input order
+    output_file = "batch_predictions.jsonl"
+    with report.phase('merge', total=len(entries)) as phase:
+        missing = merge_predictions(entries, cached, predictions, output_file, cache, model_id,
+                                    seconds_per_request)
+        phase.tick(len(entries), bytes_written=file_size(output_file))
+    if missing:
+        print(f"Warning: {missing} requests have no prediction in the batch output")
+    print(f"Predictions written to {output_file}")
+
+    if cache is not None:
+        savings = cache.savings()
+        print_savings(savings)
+        report.record_cache('predictions', cache.hits, cache.misses)
+        report.set('prediction_cache_savings', savings)
+        cache.close()
+
+def main():
+    report = StageReport('batch_predict')
+    model_id = "projects/263165751323/locations/us-central1/models/7487026572805799936@1"
     project = "mhf-test"
     location = "us-central1"
-    model_id = "projects/263165751323/locations/us-central1/models/7487026572805799936@1"
-    gcs_source = f"{bucket}/batch_prediction_input.jsonl"
-    gcs_output_prefix = f"{bucket}/batch_predictions/"
 
-    run_batch_prediction(project, location, model_id, gcs_source, gcs_output_prefix)
+    context_cache = None
+    if os.environ.get(CONTEXT_CACHE_ENV):
+        context_cache = ContextCache(vertex_cached_contents_url(project, location), model_id,
+                                     ttl_seconds=BATCH_CACHE_TTL_SECONDS)
+    cached_content = context_cache.get() if context_cache is not None else None
+    try:
+        predict_test_set(report, model_id, project, location, cached_content)
+    except CachedContentRejected as e:
+        # E.g. the model does not accept cached content in batch jobs: convert and submit again
+        # with the full prompts
+        context_cache.disable(f"Batch prediction rejected the cached content: {e}")
+        report.set('cached_content_rejected', str(e))
+        predict_test_set(report, model_id, project, location)
+    if context_cache is not None:
+        report.set('context_cache', context_cache.stats())
+    report.write()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,385 @@
+"""
+Benchmark the pipeline stages on synthetic datasets of increasing size.
+
+Each run is appended to benchmarks/results.jsonl together with the git commit, so
+regressions show up when a stage gets slower than its previous result at the same size.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from executor import EXECUTOR_ENV, open_executor
+from generate_overlays import OverlayRenderer
+from generate_synthetic_dataset import generate_synthetic_dataset, DATASET_SUBDIR
+
+RESULTS_FILE = "benchmarks/results.jsonl"
+WORK_DIR = "benchmarks/work"
+# Directories written by the stages; removed before every run so timings are comparable
+STAGE_OUTPUTS = ['matched_dataset', 'overlayed_dataset', 'partitioned_dataset', 'balanced_dataset', 'jsonl',
+                 'reports', 'batch_prediction_input.jsonl', 'ground_truth.jsonl']
+
+def git_commit():
+    """Return the short hash of HEAD, or None outside a git checkout."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parent)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def prepare_dataset(size_dir, num_images, width, height, seed):
+    """Generate the synthetic dataset for one size, reusing it if the parameters match."""
+    marker = Path(size_dir) / 'data' / DATASET_SUBDIR / 'synthetic.json'
+    expected = {'num_images': num_images, 'width': width, 'height': height, 'seed': seed, 'annotation_ratio': 1.0}
+    if marker.exists():
+        with open(marker) as f:
+            if json.load(f) == expected:
+                return
+    shutil.rmtree(Path(size_dir) / 'data', ignore_errors=True)
+    generate_synthetic_dataset(Path(size_dir) / 'data', num_images, width, height, seed)
+
+def clean_outputs():
+    for name in STAGE_OUTPUTS:
+        if os.path.isdir(name):
+            shutil.rmtree(name)
+        elif os.path.exists(name):
+            os.remove(name)
+
+def _bench_match_metadata():
+    import match_metadata
+    df = match_metadata.match_metadata()
+    return len(df)
+
+def _bench_process_annotations():
+    import generate_overlays
+    with open_executor() as executor:
+        total, _ = generate_overlays.process_annotations('matched_dataset', 'overlayed_dataset', executor=executor)
+    return total
+
+def _bench_calculate_image_quality(sample_size=500, seed=42):
+    import balance_dataset
+    images = sorted(Path('overlayed_dataset').glob('*/*.png'))
+    random.Random(seed).shuffle(images)
+    images = images[:sample_size]
+    for image in images:
+        balance_dataset.calculate_image_quality(image)
+    return len(images)
+
+def _bench_partition_dataset():
+    import partition_dataset
+    partition_dataset.main()
+    return sum(1 for _ in Path('partitioned_dataset').glob('*/*/*.png'))
+
+def _bench_balance_dataset():
+    import balance_dataset
+    with open_executor() as executor:
+        balance_dataset.create_balanced_dataset('partitioned_dataset', 'balanced_dataset', executor=executor)
+    return sum(1 for _ in Path('balanced_dataset').glob('*/*/*.png'))
+
+def _bench_generate_jsonl():
+    import generate_jsonl
+    generate_jsonl.main()
+    return sum(sum(1 for _ in open(p)) for p in Path('jsonl').glob('balanced_*.jsonl'))
+
+def _bench_convert_batch_format():
+    import convert_batch_format
+    convert_batch_format.convert_to_batch_format('jsonl/balanced_test_dataset.jsonl',
+                                                 'batch_prediction_input.jsonl', 'ground_truth.jsonl')
+    return sum(1 for _ in open('batch_prediction_input.jsonl'))
+
+# Stage name -> benchmark function returning the number of items processed.
+# Order matters: each stage consumes the previous stage's output.
+BENCHMARKS = {
+    'match_metadata': _bench_match_metadata,
+    'process_annotations': _bench_process_annotations,
+    'calculate_image_quality': _bench_calculate_image_quality,
+    'partition_dataset': _bench_partition_dataset,
+    'balance_dataset': _bench_balance_dataset,
+    'generate_jsonl': _bench_generate_jsonl,
+    'convert_batch_format': _bench_convert_batch_format,
+}
+
+def run_stage(name):
+    """Run one benchmark with stage output suppressed. Returns (items, wall_seconds, cpu_seconds)."""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        items = BENCHMARKS[name]()
+    return items, time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+def load_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def find_regression(result, history, threshold):
+    """Compare a result with the latest earlier result for the same stage and size."""
+    previous = [r for r in history if r['stage'] == result['stage'] and r['num_images'] == result['num_images']
+                and r['width'] == result['width'] and r['height'] == result['height']
+                and r.get('executor', 'serial') == result['executor']]
+    if not previous:
+        return None
+    baseline = previous[-1]
+    ratio = result['wall_seconds'] / baseline['wall_seconds'] if baseline['wall_seconds'] > 0 else 1.0
+    return {'baseline_commit': baseline.get('git_commit'), 'ratio': round(ratio, 3),
+            'regressed': ratio > 1.0 + threshold}
+
+def run_benchmarks(sizes=(1000,), stages=None, width=320, height=240, seed=42, work_dir=WORK_DIR,
+                   results_file=RESULTS_FILE, regression_threshold=0.2):
+    """
+    Run the selected stages for each dataset size and append the results to results_file.
+
+    Returns the list of result records produced by this run.
+    """
+    stages = [s for s in BENCHMARKS if stages is None or s in stages]
+    results_file = os.path.abspath(results_file)
+    history = load_results(results_file)
+    commit = git_commit()
+    timestamp = datetime.now(timezone.utc).isoformat()
+    results = []
+    executor = os.environ.get(EXECUTOR_ENV) or 'serial'
+
+    for num_images in sizes:
+        size_dir = Path(work_dir) / f"{num_images}_{width}x{height}"
+        size_dir.mkdir(parents=True, exist_ok=True)
+        print(f"\nPreparing synthetic dataset with {num_images} images...")
+        prepare_dataset(size_dir, num_images, width, height, seed)
+
+        cwd = os.getcwd()
+        os.chdir(size_dir)
+        try:
+            clean_outputs()
+            for stage in stages:
+                items, wall, cpu = run_stage(stage)
+                result = {
+                    'timestamp': timestamp,
+                    'git_commit': commit,
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'cpu_count': os.cpu_count(),
+                    'executor': executor,
+                    'stage': stage,
+                    'num_images': num_images,
+                    'width': width,
+                    'height': height,
+                    'items': items,
+                    'wall_seconds': round(wall, 4),
+                    'cpu_seconds': round(cpu, 4),
+                    'items_per_second': round(items / wall, 2) if wall > 0 else None,
+                }
+                result['comparison'] = find_regression(result, history, regression_threshold)
+                results.append(result)
+
+                flag = ''
+                if result['comparison']:
+                    flag = f"  x{result['comparison']['ratio']} vs {result['comparison']['baseline_commit']}"
+                    if result['comparison']['regressed']:
+                        flag += '  REGRESSION'
+                print(f"{stage:<25} {items:>8} items {wall:>9.3f}s {result['items_per_second'] or 0:>10.1f}/s{flag}")
+        finally:
+            os.chdir(cwd)
+
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    print(f"\nResults appended to {results_file}")
+    return results
+
+def full_frame_overlay(image, ellipse_params):
+    """The original overlay: draw on a full copy of the frame and blend the whole frame."""
+    overlay = image.copy()
+    cv2.ellipse(overlay,
+                (int(ellipse_params['center_x']), int(ellipse_params['center_y'])),
+                (int(ellipse_params['axis_x']), int(ellipse_params['axis_y'])),
+                ellipse_params['angle'],
+                0, 360, (0, 255, 0), 2)
+    return cv2.addWeighted(overlay, 0.7, image, 0.3, 0)
+
+def _measure_renderer(render, images, params):
+    """(seconds per image, peak traced bytes per image) of render over images."""
+    start = time.perf_counter()
+    for image, p in zip(images, params):
+        render(image, p)
+    seconds = (time.perf_counter() - start) / len(images)
+    peak = 0
+    tracemalloc.start()
+    try:
+        for image, p in zip(images, params):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            render(image, p)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+def benchmark_overlay_rendering(num_images=500, width=320, height=240, seed=42):
+    """
+    Time and trace allocations of the full-frame overlay against OverlayRenderer, checking
+    every image is pixel-identical. Returns one result dict per renderer.
+    """
+    rng = np.random.default_rng(seed)
+    images = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(num_images)]
+    params = [{'center_x': rng.uniform(0, width), 'center_y': rng.uniform(0, height),
+               'axis_x': rng.uniform(5, width / 2), 'axis_y': rng.uniform(5, height / 2),
+               'angle': rng.uniform(0, 180)} for _ in range(num_images)]
+    renderer = OverlayRenderer()
+    mismatches = sum(not np.array_equal(full_frame_overlay(image, p), renderer.render(image, p))
+                     for image, p in zip(images, params))
+    if mismatches:
+        raise SystemExit(f"OverlayRenderer differs from the full-frame overlay on {mismatches} images")
+
+    # Writing into a reused output buffer is how a batch of same-sized frames is rendered
+    out = np.empty_like(images[0])
+    renderers = {
+        'full_frame': full_frame_overlay,
+        'renderer': renderer.render,
+        'renderer_reused_out': lambda image, p: renderer.render(image, p, out),
+    }
+    frame_bytes = images[0].nbytes
+    results = []
+    print(f"Overlay rendering, {num_images} images of {width}x{height} (all pixel-identical):")
+    for name, render in renderers.items():
+        seconds, peak = _measure_renderer(render, images, params)
+        results.append({'renderer': name, 'ms_per_image': round(seconds * 1000, 4), 'peak_bytes_per_image': peak,
+                        'frames_allocated': round(peak / frame_bytes, 2)})
+        print(f"{name:<22} {seconds * 1000:>8.3f} ms/image {peak:>10} peak bytes "
+              f"({peak / frame_bytes:.2f} frames)")
+    return results
+
+def kendall_tau(a, b):
+    """Kendall rank correlation (tau-a) of two equally long score sequences, in O(n log n)."""
+    n = len(a)
+    if n < 2:
+        return 1.0
+    # Ranks of b, taken in the order of a; discordant pairs are the inversions
+    order = np.lexsort((b, a))
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[np.argsort(np.asarray(b)[order], kind='stable')] = np.arange(n)
+    tree = [0] * (n + 1)
+    discordant = 0
+    for i, rank in enumerate(ranks):
+        # Earlier items ranked above this one
+        below, j = 0, rank + 1
+        while j > 0:
+            below += tree[j]
+            j -= j & -j
+        discordant += i - below
+        j = rank + 1
+        while j <= n:
+            tree[j] += 1
+            j += j & -j
+    pairs = n * (n - 1) // 2
+    return 1 - 2 * discordant / pairs
+
+def benchmark_quality_scoring(source_dir='partitioned_dataset', scales=(2, 4, 8), margin=None):
+    """
+    Compare approximate quality scoring with the exact scorer on the normal and benign
+    images of every <split>/ of source_dir, selecting as many as the split's malignant
+    images like balance_dataset. Returns one result dict per scale.
+    """
+    import balance_dataset
+
+    margin = balance_dataset.RESCORE_MARGIN if margin is None else margin
+    groups = []
+    for split_dir in sorted(p for p in Path(source_dir).iterdir() if p.is_dir()):
+        count = sum(1 for _ in (split_dir / 'malignant').glob('*.png'))
+        for category in ['normal', 'benign']:
+            images = sorted((split_dir / category).glob('*.png'))
+            if images:
+                groups.append((images, count))
+    if not groups:
+        raise SystemExit(f"No <split>/normal or <split>/benign images in {source_dir}")
+
+    def timed_scores(score, images):
+        start = time.perf_counter()
+        scores = [score(image) for image in images]
+        return scores, time.perf_counter() - start
+
+    exact = [timed_scores(balance_dataset.calculate_image_quality, images) for images, _ in groups]
+    exact_seconds = sum(seconds for _, seconds in exact)
+    total = sum(len(images) for images, _ in groups)
+    results = []
+    print(f"Quality scoring, {total} images in {len(groups)} groups, exact {exact_seconds:.2f}s:")
+    for scale in scales:
+        seconds = 0.0
+        taus, approximate_overlap, rescored_overlap = [], 0, 0
+        selected = 0
+        for (images, count), (exact_scores, _) in zip(groups, exact):
+            scores, approximate_seconds = timed_scores(
+                lambda image: balance_dataset.approximate_image_quality(image, scale), images)
+            ranked = sorted(zip(images, scores), key=lambda x: x[1], reverse=True)
+            start = time.perf_counter()
+            refined, _ = balance_dataset.rescore_near_cutoff(ranked, count, balance_dataset.calculate_image_quality,
+                                                             margin)
+            seconds += approximate_seconds + time.perf_counter() - start
+            exact_top = {img for img, _ in sorted(zip(images, exact_scores), key=lambda x: x[1],
+                                                  reverse=True)[:count]}
+            approximate_overlap += len(exact_top & {img for img, _ in ranked[:count]})
+            rescored_overlap += len(exact_top & {img for img, _ in refined[:count]})
+            selected += len(exact_top)
+            taus.append((kendall_tau(exact_scores, scores), len(images)))
+        result = {
+            'scale': scale,
+            'kendall_tau': round(sum(tau * n for tau, n in taus) / total, 4),
+            'top_k_overlap': round(approximate_overlap / max(selected, 1), 4),
+            'top_k_overlap_rescored': round(rescored_overlap / max(selected, 1), 4),
+            'seconds': round(seconds, 3),
+            'speedup': round(exact_seconds / seconds, 2) if seconds > 0 else None,
+        }
+        results.append(result)
+        print(f"1/{scale:<3} tau {result['kendall_tau']:.3f}  top-k overlap {result['top_k_overlap']:.3f} "
+              f"-> {result['top_k_overlap_rescored']:.3f} after rescoring  {seconds:.2f}s ({result['speedup']}x)")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000],
+                        help='Dataset sizes to benchmark, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--stages', nargs='+', choices=list(BENCHMARKS), default=None)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--work-dir', default=WORK_DIR)
+    parser.add_argument('--results-file', default=RESULTS_FILE)
+    parser.add_argument('--regression-threshold', type=float, default=0.2,
+                        help='Flag a stage whose wall time grew by more than this fraction')
+    parser.add_argument('--overlay-rendering', action='store_true',
+                        help='Only compare the full-frame overlay with OverlayRenderer in memory')
+    parser.add_argument('--quality-scoring', metavar='DIR',
+                        help='Only compare approximate and exact quality scoring on a partitioned dataset')
+    args = parser.parse_args()
+
+    if args.quality_scoring:
+        benchmark_quality_scoring(args.quality_scoring)
+        return
+    if args.overlay_rendering:
+        benchmark_overlay_rendering(args.sizes[0], args.width, args.height, args.seed)
+        return
+
+    results = run_benchmarks(args.sizes, args.stages, args.width, args.height, args.seed, args.work_dir,
+                             args.results_file, args.regression_threshold)
+    if any(r['comparison'] and r['comparison']['regressed'] for r in results):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
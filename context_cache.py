@@ -0,0 +1,264 @@
+"""
+Context caching of the static prompt prefix.
+
+Every prediction request starts with the same few kilobytes of instructions; only the image,
+its ellipse measurements and its metadata lines differ. ContextCache registers the static
+start of the prompt (convert_batch_format.cached_prompt_prefix) once as Vertex AI cached
+content and turns a request into a compact one that references it and carries only the rest
+of the prompt (convert_batch_format.per_image_prompt). The cached content is re-registered
+before it expires.
+
+The text is the same as the full prompt, but the model sees the instructions as an earlier
+turn ahead of the image rather than after it. A tuned model was only trained on full
+prompts, so caching stays off for it until an agreement check against full prompts has
+passed for the current prefix:
+
+    python context_cache.py --endpoint-url https://.../endpoints/...:generateContent --cache-model projects/.../models/...
+
+Caching is not available everywhere (some models, prefixes below the minimum cached size);
+if registering fails, or the endpoint rejects a compact request, the cache disables itself
+with the reason and callers send the full prompts instead.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from convert_batch_format import cached_prompt_prefix, per_image_prompt
+
+CONTEXT_CACHE_ENV = 'PROMPT_CONTEXT_CACHE'
+DEFAULT_TTL_SECONDS = 3600
+# Cached content is re-registered this long before it expires, so no request references an expired one
+REFRESH_MARGIN_SECONDS = 300
+
+# Results of the agreement check, per model
+AGREEMENT_PATH = Path('context_cache_agreement.json')
+AGREEMENT_SAMPLES = 100
+# Fraction of sampled requests whose compact and full prompts must give the same label
+MIN_AGREEMENT = 0.98
+
+def cached_contents_url(url):
+    """cachedContents collection URL for an endpoint, model or API URL of the same project and location."""
+    for marker in ('/endpoints/', '/publishers/', '/models/'):
+        if marker in url:
+            return url[:url.index(marker)] + '/cachedContents'
+    raise ValueError(f"Cannot derive the cachedContents URL from {url}")
+
+def vertex_cached_contents_url(project, location):
+    return (f"https://{location}-aiplatform.googleapis.com/v1/projects/{project}/locations/{location}"
+            "/cachedContents")
+
+def compact_request(request, cached_content, prompt_metadata):
+    """The request with its prompt replaced by the per-image part and a reference to cached_content."""
+    image_part = request['contents'][0]['parts'][0]
+    return {
+        'cachedContent': cached_content,
+        'contents': [{'role': 'user', 'parts': [image_part, {'text': per_image_prompt(prompt_metadata)}]}],
+    }
+
+def tuned_model(model):
+    """Whether model is a tuned model resource (projects/.../models/...) rather than a publisher model."""
+    return '/models/' in model and '/publishers/' not in model
+
+def prefix_digest(prefix):
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+def load_agreement(path=AGREEMENT_PATH):
+    """Agreement check results by model, or {} if none have been recorded."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def agreement_failure(model, prefix, path=AGREEMENT_PATH):
+    """Why caching prefix is not yet allowed for model, or None if its agreement check passed."""
+    result = load_agreement(path).get(model)
+    if result is None:
+        return f"no agreement check against full prompts has been run for tuned model {model}"
+    if result['prefix_sha256'] != prefix_digest(prefix):
+        return f"the agreement check for {model} was run with a different prompt prefix"
+    if result['samples'] < AGREEMENT_SAMPLES or result['agreement'] < MIN_AGREEMENT:
+        return (f"the agreement check for {model} did not pass ({result['agreed']} of {result['samples']} "
+                f"labels matched the full prompts)")
+    return None
+
+class ContextCache:
+    """
+    The static prompt prefix registered as cached content for model at url (a cachedContents
+    collection URL). access_token is as for inference_server.access_token_for. Unless
+    require_agreement is False, a tuned model is only used with the cache once its agreement
+    check has passed (see agreement_failure). Safe to share between threads.
+    """
+
+    def __init__(self, url, model, prefix=None, ttl_seconds=DEFAULT_TTL_SECONDS, access_token=None, timeout=30,
+                 require_agreement=True):
+        self.url = url
+        self.model = model
+        self.prefix = prefix or cached_prompt_prefix()
+        self.ttl_seconds = ttl_seconds
+        self._access_token = access_token
+        self.timeout = timeout
+        self.require_agreement = require_agreement
+        self.name = None
+        self.expires = 0.0
+        self.unavailable = None
+        self.compact_requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.unavailable is None
+
+    def _token(self):
+        if self._access_token is None or isinstance(self._access_token, str):
+            # inference_server imports this module
+            from inference_server import access_token_for
+            self._access_token = access_token_for(self.url, self._access_token)
+        return self._access_token
+
+    def _register(self):
+        token = self._token()
+        body = {
+            'model': self.model,
+            'displayName': 'fetal-ultrasound-prompt-prefix',
+            # A user turn, as in the tuning examples, rather than a system instruction
+            'contents': [{'role': 'user', 'parts': [{'text': self.prefix}]}],
+            'ttl': f"{self.ttl_seconds}s",
+        }
+        data = json.dumps(body).encode('utf-8')
+        for attempt in range(2):
+            request = urllib.request.Request(self.url, data, token.headers({'Content-Type': 'application/json'}),
+                                             method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return json.loads(response.read())['name']
+            except urllib.error.HTTPError as e:
+                if e.code != 401 or attempt:
+                    raise
+                # The token expired: refresh it and retry once
+                token.invalidate()
+
+    def get(self):
+        """Name of the live cached content, registering it if needed, or None if caching is unavailable."""
+        with self._lock:
+            if not self.active:
+                return None
+            if self.name is None and self.require_agreement and tuned_model(self.model):
+                reason = agreement_failure(self.model, self.prefix)
+                if reason:
+                    self._disable(reason)
+                    return None
+            if self.name is None or time.time() >= self.expires - REFRESH_MARGIN_SECONDS:
+                try:
+                    self.name = self._register()
+                except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+                    detail = e.read()[:200].decode('utf-8', 'replace') if isinstance(e, urllib.error.HTTPError) else ''
+                    self._disable(f"{type(e).__name__}: {e} {detail}".strip())
+                    return None
+                self.expires = time.time() + self.ttl_seconds
+            return self.name
+
+    def _disable(self, reason):
+        self.unavailable = reason
+        self.name = None
+        print(f"Context caching unavailable, sending full prompts: {reason}")
+
+    def disable(self, reason):
+        """Stop using cached content (e.g. after the endpoint rejected it)."""
+        with self._lock:
+            if self.active:
+                self._disable(reason)
+
+    def compact(self, request, prompt_metadata):
+        """compact_request for the live cached content, or None if caching is unavailable."""
+        name = self.get()
+        if name is None:
+            return None
+        with self._lock:
+            self.compact_requests += 1
+        return compact_request(request, name, prompt_metadata)
+
+    def stats(self):
+        return {'cached_content': self.name, 'active': self.active, 'unavailable': self.unavailable,
+                'compact_requests': self.compact_requests, 'prefix_chars': len(self.prefix)}
+
+def check_agreement(endpoint_url, model, requests_file, samples=AGREEMENT_SAMPLES, access_token=None, seed=0):
+    """
+    Send a sample of the full-prompt requests in requests_file (batch prediction input) to
+    endpoint_url both as they are and compact, and return how often the labels agree.
+    """
+    # inference_server imports this module
+    from inference_server import ModelClient, parse_label, response_text
+
+    prefix = cached_prompt_prefix()
+    with open(requests_file) as f:
+        requests = [json.loads(line)['request'] for line in f if line.strip()]
+    requests = [request for request in requests
+                if 'cachedContent' not in request and request['contents'][0]['parts'][1]['text'].startswith(prefix)]
+    requests = random.Random(seed).sample(requests, min(samples, len(requests)))
+
+    cache = ContextCache(cached_contents_url(endpoint_url), model, prefix, access_token=access_token,
+                         require_agreement=False)
+    name = cache.get()
+    if name is None:
+        raise RuntimeError(f"Could not register the prompt prefix: {cache.unavailable}")
+    compact = []
+    for request in requests:
+        image_part, text_part = request['contents'][0]['parts']
+        compact.append({'cachedContent': name,
+                        'contents': [{'role': 'user', 'parts': [image_part, {'text': text_part['text'][len(prefix):]}]}]})
+
+    client = ModelClient(endpoint_url, access_token=access_token)
+    try:
+        full_results = client.predict(requests)
+        compact_results = client.predict(compact)
+    finally:
+        client.close()
+    agreed = errors = 0
+    for full, cached in zip(full_results, compact_results):
+        if isinstance(full, Exception) or isinstance(cached, Exception):
+            errors += 1
+            continue
+        label = parse_label(response_text(full))
+        agreed += label is not None and label == parse_label(response_text(cached))
+    return {
+        'prefix_sha256': prefix_digest(prefix),
+        'samples': len(requests),
+        'agreed': agreed,
+        'errors': errors,
+        'agreement': agreed / len(requests) if requests else 0.0,
+        'endpoint_url': endpoint_url,
+        'checked_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--endpoint-url', required=True, help="Endpoint serving the model (:predict or :generateContent)")
+    parser.add_argument('--cache-model', required=True, help="Model resource the cached content is created for")
+    parser.add_argument('--requests', default='batch_prediction_input.jsonl',
+                        help="Batch prediction input with full prompts (convert_batch_format.py)")
+    parser.add_argument('--samples', type=int, default=AGREEMENT_SAMPLES)
+    args = parser.parse_args()
+
+    result = check_agreement(args.endpoint_url, args.cache_model, args.requests, args.samples)
+    results = load_agreement()
+    results[args.cache_model] = result
+    with open(AGREEMENT_PATH, 'w') as f:
+        json.dump(results, f, indent=2)
+    reason = agreement_failure(args.cache_model, cached_prompt_prefix())
+    print(f"{result['agreed']} of {result['samples']} labels agree ({result['errors']} errors); "
+          f"{'caching is allowed' if reason is None else reason}. Written to {AGREEMENT_PATH}")
+    raise SystemExit(0 if reason is None else 1)
+
+if __name__ == "__main__":
+    main()
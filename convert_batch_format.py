@@ -6,12 +6,14 @@ Convert test dataset to batch prediction format.
 """
 
 import json
-import pandas as pd
+from instrumentation import StageReport
+from crop_overlays import dataset_dirs
+from metadata_store import ELLIPSE_COLUMNS, FEATURE_COLUMNS, PROMPT_COLUMNS, MetadataIndex, read_metadata
 
-def create_dynamic_prompt(metadata):
-    """Create a dynamic prompt based on the image's metadata and ellipse parameters."""
-    # Base prompt
-    base_prompt = """You are a diagnostic medical AI trained in fetal neuroimaging.
+# The prompt is built from static instructions and the per-image ellipse and metadata lines.
+# With context caching (context_cache.py) the instructions before the first per-image line are
+# registered once as cached_prompt_prefix() and requests carry only per_image_prompt().
+BASE_PROMPT = """You are a diagnostic medical AI trained in fetal neuroimaging.
 
 Analyze the provided fetal brain ultrasound image and classify it as one of the following:
 – normal
@@ -57,14 +59,7 @@ Base your classification on the following medically relevant criteria:
     – Do all visible structures appear appropriate for the estimated gestational age?
     – Is the brain shape and size appropriate for the gestational age?"""
 
-    # Add ellipse parameters if available
-    if all(key in metadata for key in ['ellipse_center_x', 'ellipse_center_y', 'ellipse_axis_x', 'ellipse_axis_y', 'ellipse_angle']):
-        ellipse_info = f"""
-Brain Region Measurements:
-The green ellipse surrounding the brain region has the following characteristics:
-- Center: ({metadata['ellipse_center_x']}, {metadata['ellipse_center_y']}) pixels
-- Major and Minor Axes: ({metadata['ellipse_axis_x']}, {metadata['ellipse_axis_y']}) pixels
-- Rotation Angle: {metadata['ellipse_angle']} degrees
+ELLIPSE_GUIDANCE = """
 
 Use these measurements to assess:
 1. Brain size and shape relative to gestational age
@@ -77,22 +72,33 @@ Note: While the position and orientation of the ellipse are not relevant, the sh
 1. The shape and proportions of the brain region (as indicated by the green ellipse measurements)
 2. Any abnormalities, tumors, or unusual growths within the brain region
 3. Whether the brain shape and size are appropriate for normal development"""
-        base_prompt += ellipse_info
 
-    # Add metadata if available
-    metadata_fields = [
-        'baseline_value', 'accelerations', 'fetal_movement', 'uterine_contractions',
-        'light_decelerations', 'severe_decelerations', 'prolongued_decelerations',
-        'abnormal_short_term_variability', 'mean_value_of_short_term_variability',
-        'percentage_of_time_with_abnormal_long_term_variability',
-        'mean_value_of_long_term_variability', 'histogram_width', 'histogram_min',
-        'histogram_max', 'histogram_number_of_peaks', 'histogram_number_of_zeroes',
-        'histogram_mode', 'histogram_mean', 'histogram_median', 'histogram_variance',
-        'histogram_tendency'
-    ]
-    
-    if all(field in metadata for field in metadata_fields):
-        metadata_info = f"""
+METADATA_GUIDANCE = """
+
+Use this metadata to enhance your analysis by considering:
+1. Fetal health metrics and their implications
+2. Variability in fetal heart rate and its significance
+3. Histogram data to understand the distribution of measurements
+4. Any correlations between metadata and brain development"""
+
+ANSWER_FORMAT = "\n\nReturn your analysis as one word, either: normal, benign, malignant"
+
+def ellipse_lines(metadata):
+    """The ellipse measurements of one image, or '' if they are missing."""
+    if not all(key in metadata for key in ELLIPSE_COLUMNS):
+        return ''
+    return f"""
+Brain Region Measurements:
+The green ellipse surrounding the brain region has the following characteristics:
+- Center: ({metadata['ellipse_center_x']}, {metadata['ellipse_center_y']}) pixels
+- Major and Minor Axes: ({metadata['ellipse_axis_x']}, {metadata['ellipse_axis_y']}) pixels
+- Rotation Angle: {metadata['ellipse_angle']} degrees"""
+
+def metadata_lines(metadata):
+    """The CTG metadata of one image, or '' if any feature is missing."""
+    if not all(field in metadata for field in FEATURE_COLUMNS):
+        return ''
+    return f"""
 Additional Metadata:
 - Baseline Value: {metadata['baseline_value']} bpm
 - Accelerations: {metadata['accelerations']} bpm
@@ -114,42 +120,83 @@ Additional Metadata:
 - Histogram Mean: {metadata['histogram_mean']}
 - Histogram Median: {metadata['histogram_median']}
 - Histogram Variance: {metadata['histogram_variance']}
-- Histogram Tendency: {metadata['histogram_tendency']}
+- Histogram Tendency: {metadata['histogram_tendency']}"""
 
-Use this metadata to enhance your analysis by considering:
-1. Fetal health metrics and their implications
-2. Variability in fetal heart rate and its significance
-3. Histogram data to understand the distribution of measurements
-4. Any correlations between metadata and brain development"""
-        base_prompt += metadata_info
+def create_dynamic_prompt(metadata):
+    """Create a dynamic prompt based on the image's metadata and ellipse parameters."""
+    base_prompt = BASE_PROMPT
+
+    # Add ellipse parameters if available
+    ellipse_info = ellipse_lines(metadata)
+    if ellipse_info:
+        base_prompt += ellipse_info + ELLIPSE_GUIDANCE
 
-    base_prompt += "\n\nReturn your analysis as one word, either: normal, benign, malignant"
+    # Add metadata if available
+    metadata_info = metadata_lines(metadata)
+    if metadata_info:
+        base_prompt += metadata_info + METADATA_GUIDANCE
+
+    base_prompt += ANSWER_FORMAT
     return base_prompt
 
-def convert_to_batch_format(input_file, output_file, ground_truth_file):
-    """Convert the test dataset to batch prediction format."""
-    # Read the matched data CSV for ground truth and metadata
-    matched_data = pd.read_csv('partitioned_dataset/matched_data.csv')
-    matched_data = matched_data[matched_data['image_filename'].str.startswith('test/')]
+def cached_prompt_prefix():
+    """The static instructions every prompt starts with, registered once as cached content."""
+    return BASE_PROMPT
+
+def per_image_prompt(metadata):
+    """
+    The rest of the prompt after cached_prompt_prefix(), sent with the image when the prefix
+    is cached; the two together are exactly create_dynamic_prompt(metadata).
+    """
+    return create_dynamic_prompt(metadata)[len(BASE_PROMPT):]
+
+def effective_prompt(request):
+    """The prompt text the model sees for a request: the cached prefix is prepended if it references cached content."""
+    text = request['contents'][0]['parts'][1]['text']
+    if 'cachedContent' in request:
+        return cached_prompt_prefix() + text
+    return text
+
+def image_key(file_uri):
+    """Map a fileUri to the split/category/filename key used in the metadata table."""
+    return '/'.join(file_uri.split('/')[-3:])
+
+def convert_to_batch_format(input_file, output_file, ground_truth_file, report=None, matched_data='partitioned_dataset',
+                            cached_content=None):
+    """
+    Convert the test dataset to batch prediction format.
+
+    If cached_content (the name of the registered cached_prompt_prefix) is given, each
+    request references it and carries only the per-image part of the prompt.
+    """
+    report = report or StageReport('convert_batch_format')
+    requests = request_bytes = 0
+
+    # Load only the test rows and the columns needed for ground truth and prompts
+    with report.phase('read_metadata', total=0):
+        matched_data = read_metadata(matched_data, columns=PROMPT_COLUMNS + ['category'])
+        matched_data = matched_data[matched_data['image_filename'].str.startswith('test/')]
+        metadata_index = MetadataIndex(matched_data)
     
-    # Create a mapping of image filenames to their categories and metadata
-    ground_truth_map = dict(zip(matched_data['image_filename'], matched_data['category']))
-    metadata_map = dict(zip(matched_data['image_filename'], matched_data.to_dict('records')))
-    
-    with open(input_file, 'r') as f_in, open(output_file, 'w') as f_out, open(ground_truth_file, 'w') as f_truth:
+    with open(input_file, 'r') as f_in, open(output_file, 'w') as f_out, open(ground_truth_file, 'w') as f_truth, \
+            report.phase('convert', total=0) as phase:
         for line in f_in:
+            phase.tick(bytes_read=len(line))
             data = json.loads(line)
             # Extract the user message which contains the image
             user_message = data['contents'][0]
             
-            # Get the image filename from the fileUri
-            image_path = user_message['parts'][0]['fileData']['fileUri'].split('/')[-1]
+            # Get the split/category/filename key from the fileUri
+            image_path = image_key(user_message['parts'][0]['fileData']['fileUri'])
             
             # Get metadata for this image
-            metadata = metadata_map.get(image_path, {})
+            metadata = metadata_index.get(image_path, {})
             
             # Create dynamic prompt with this image's metadata
-            dynamic_prompt = create_dynamic_prompt(metadata)
+            if cached_content is None:
+                dynamic_prompt = create_dynamic_prompt(metadata)
+            else:
+                dynamic_prompt = per_image_prompt(metadata)
             
             # Create the batch prediction format with the dynamic prompt
             batch_format = {
@@ -163,23 +210,36 @@ def convert_to_batch_format(input_file, output_file, ground_truth_file):
                     }]
                 }
             }
+            if cached_content is not None:
+                batch_format['request']['cachedContent'] = cached_content
             
             # Write to output file
-            f_out.write(json.dumps(batch_format) + '\n')
+            out_line = json.dumps(batch_format) + '\n'
+            f_out.write(out_line)
+            phase.add_bytes(bytes_written=len(out_line))
+            requests += 1
+            request_bytes += len(out_line)
             
             # Get ground truth from the matched data
-            if image_path in ground_truth_map:
-                ground_truth = ground_truth_map[image_path]
+            if image_path in metadata_index:
+                ground_truth = metadata['category']
                 f_truth.write(json.dumps({"ground_truth": ground_truth}) + '\n')
 
+    report.set('requests', {'count': requests, 'mean_bytes': request_bytes / requests if requests else 0.0,
+                            'cached_content': cached_content})
+
 def main():
-    input_file = "jsonl/test_dataset.jsonl"
+    input_file = "jsonl/balanced_test_dataset.jsonl"
     output_file = "batch_prediction_input.jsonl"
     ground_truth_file = "ground_truth.jsonl"
     
     print("Converting test dataset to batch prediction format...")
-    convert_to_batch_format(input_file, output_file, ground_truth_file)
+    report = StageReport('convert_batch_format')
+    # Prompts use the same metadata (cropped frame or not) as the tuning examples
+    _, matched_data = dataset_dirs("balanced_dataset", "partitioned_dataset")
+    convert_to_batch_format(input_file, output_file, ground_truth_file, report=report, matched_data=matched_data)
     print(f"Conversion complete. Output written to {output_file} and ground truth to {ground_truth_file}")
+    report.write()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,270 @@
+"""
+Crop the balanced overlay images to the fitted brain ellipse and downscale them.
+
+The prompt tells the model to look only inside the green ellipse, so everything outside its
+bounding box (plus a margin) is dropped and the crop is resized to a maximum side. The
+ellipse parameters in the metadata are rewritten into the cropped frame so the prompts stay
+consistent with the pixels. This reduces upload bytes, image tokens, tuning cost and
+prediction latency.
+
+Cropping is opt-in: with PIPELINE_CROP set, upload_dataset.py, generate_jsonl.py and
+batch_predict.py use cropped_dataset/ (and its metadata) instead of balanced_dataset/.
+PIPELINE_CROP_MAX_SIDE (or --max-side) sets the maximum side, 384px by default.
+
+    PIPELINE_CROP=1 python crop_overlays.py --max-side 512
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import math
+import os
+import shutil
+from functools import partial
+from pathlib import Path
+
+import cv2
+import pandas as pd
+
+from instrumentation import StageReport, file_size, format_bytes
+from image_cache import imread, open_image_cache
+from executor import Executor, open_executor, print_errors
+from metadata_store import ELLIPSE_COLUMNS, read_metadata, write_metadata
+from token_estimates import estimate_image_tokens
+
+CROP_ENV = 'PIPELINE_CROP'
+MAX_SIDE_ENV = 'PIPELINE_CROP_MAX_SIDE'
+# A single Gemini image tile
+DEFAULT_MAX_SIDE = 384
+CROPPED_DIR = 'cropped_dataset'
+
+def cropping_enabled():
+    """Whether PIPELINE_CROP asks the stages to use the cropped dataset."""
+    return os.environ.get(CROP_ENV, '').lower() not in ('', '0', 'false', 'off', 'no')
+
+def crop_max_side():
+    """Maximum side of a crop, from PIPELINE_CROP_MAX_SIDE or DEFAULT_MAX_SIDE."""
+    return int(os.environ.get(MAX_SIDE_ENV) or DEFAULT_MAX_SIDE)
+
+def dataset_dirs(folder_path, matched_data):
+    """
+    (image directory, metadata location) for the stages after balancing.
+
+    folder_path and matched_data unless cropping is enabled, in which case cropped_dataset;
+    raises FileNotFoundError if it has not been created yet.
+    """
+    if not cropping_enabled():
+        return folder_path, matched_data
+    if not os.path.exists(CROPPED_DIR):
+        raise FileNotFoundError(f"{CROP_ENV} is set but {CROPPED_DIR} does not exist; run crop_overlays.py first")
+    return CROPPED_DIR, CROPPED_DIR
+
+def ellipse_bounding_box(center_x, center_y, axis_x, axis_y, angle, margin=0.1, width=None, height=None):
+    """
+    Axis-aligned bounding box (x0, y0, x1, y1) of a rotated ellipse.
+
+    axis_x and axis_y are semi-axes as stored in the metadata. margin is a fraction of the
+    box size added on every side; the box is clipped to width x height when given.
+    """
+    theta = math.radians(angle)
+    half_w = math.sqrt((axis_x * math.cos(theta)) ** 2 + (axis_y * math.sin(theta)) ** 2)
+    half_h = math.sqrt((axis_x * math.sin(theta)) ** 2 + (axis_y * math.cos(theta)) ** 2)
+    # Leave room for the 2px overlay outline
+    half_w += margin * 2 * half_w + 2
+    half_h += margin * 2 * half_h + 2
+
+    x0, y0 = int(math.floor(center_x - half_w)), int(math.floor(center_y - half_h))
+    x1, y1 = int(math.ceil(center_x + half_w)), int(math.ceil(center_y + half_h))
+    if width is not None:
+        x0, x1 = max(x0, 0), min(x1, width)
+    if height is not None:
+        y0, y1 = max(y0, 0), min(y1, height)
+    return x0, y0, x1, y1
+
+def downscale(image, max_side):
+    """Resize image so its longest side is at most max_side. Returns (image, scale)."""
+    longest = max(image.shape[:2])
+    if not max_side or longest <= max_side:
+        return image, 1.0
+    scale = max_side / longest
+    new_size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+    return cv2.resize(image, new_size, interpolation=cv2.INTER_AREA), scale
+
+def crop_to_ellipse(image, ellipse, margin=0.1, max_side=DEFAULT_MAX_SIDE):
+    """
+    Crop image to the ellipse bounding box plus margin and resize so no side exceeds max_side.
+
+    ellipse is a dict with the ELLIPSE_COLUMNS keys. Returns (cropped_image, new_ellipse, transform)
+    where new_ellipse is in the cropped frame and transform holds the crop origin and scale.
+    """
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = ellipse_bounding_box(
+        ellipse['ellipse_center_x'], ellipse['ellipse_center_y'],
+        ellipse['ellipse_axis_x'], ellipse['ellipse_axis_y'], ellipse['ellipse_angle'],
+        margin=margin, width=width, height=height)
+    if x1 <= x0 or y1 <= y0:
+        # Ellipse entirely outside the frame: keep the whole image
+        x0, y0, x1, y1 = 0, 0, width, height
+    cropped, scale = downscale(image[y0:y1, x0:x1], max_side)
+
+    new_ellipse = {
+        'ellipse_center_x': (ellipse['ellipse_center_x'] - x0) * scale,
+        'ellipse_center_y': (ellipse['ellipse_center_y'] - y0) * scale,
+        'ellipse_axis_x': ellipse['ellipse_axis_x'] * scale,
+        'ellipse_axis_y': ellipse['ellipse_axis_y'] * scale,
+        # Uniform scaling and translation leave the rotation unchanged
+        'ellipse_angle': ellipse['ellipse_angle'],
+    }
+    transform = {'crop_x0': x0, 'crop_y0': y0, 'crop_scale': scale,
+                 'original_width': width, 'original_height': height}
+    return cropped, new_ellipse, transform
+
+def crop_image(task, output_dir, margin=0.1, max_side=DEFAULT_MAX_SIDE, image_cache=None):
+    """
+    Crop one image for crop_dataset.
+
+    task is (image_path, ellipse) where ellipse is None if there is no usable ellipse, in which
+    case the image is only downscaled. The crop is written under output_dir with the same
+    split/category layout. Returns (transform, counts) where counts holds the bytes and
+    estimated image tokens before and after. Raises ValueError if the image cannot be read or
+    the crop cannot be written.
+    """
+    image_path, ellipse = task
+    split, category = image_path.parent.parent.name, image_path.parent.name
+    image = imread(image_path, cv2.IMREAD_COLOR, image_cache)
+    if image is None:
+        raise ValueError("Could not read image")
+
+    if ellipse is None:
+        # No ellipse to crop to: only downscale
+        cropped, scale = downscale(image, max_side)
+        transform = {'crop_x0': 0, 'crop_y0': 0, 'crop_scale': scale,
+                     'original_width': image.shape[1], 'original_height': image.shape[0]}
+    else:
+        cropped, new_ellipse, transform = crop_to_ellipse(image, ellipse, margin=margin, max_side=max_side)
+        transform.update(new_ellipse)
+
+    output_path = Path(output_dir) / split / category / image_path.name
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if not cv2.imwrite(str(output_path), cropped):
+        raise ValueError(f"Could not write {output_path}")
+
+    counts = {
+        'bytes_before': file_size(image_path),
+        'bytes_after': file_size(output_path),
+        'tokens_before': estimate_image_tokens(image.shape[1], image.shape[0]),
+        'tokens_after': estimate_image_tokens(cropped.shape[1], cropped.shape[0]),
+    }
+    return transform, counts
+
+def crop_dataset(source_dir, output_dir, matched_data, margin=0.1, max_side=DEFAULT_MAX_SIDE, report=None,
+                 image_cache=None, executor=None):
+    """
+    Crop every split/category/*.png image in source_dir into output_dir.
+
+    matched_data is the metadata store location holding the ellipse parameters. The cropped
+    metadata table, with ellipse columns in the cropped frame, is written to output_dir.
+    Images are cropped on executor (serial if not given). Returns a dict with bytes and
+    estimated image tokens before and after.
+    """
+    report = report or StageReport('crop_overlays')
+    executor = executor or Executor()
+    metadata = read_metadata(matched_data)
+    positions = {name: i for i, name in enumerate(metadata['image_filename'].tolist())}
+    ellipses = metadata[ELLIPSE_COLUMNS].to_numpy()
+
+    images = sorted(Path(source_dir).glob('*/*/*.png'))
+    stats = {'images': 0, 'bytes_before': 0, 'bytes_after': 0, 'tokens_before': 0, 'tokens_after': 0,
+             'missing_ellipse': 0}
+    rows = []
+    transforms = []
+
+    tasks = []
+    task_positions = []
+    for image_path in images:
+        position = positions.get(f"{image_path.parent.parent.name}/{image_path.parent.name}/{image_path.name}")
+        ellipse = dict(zip(ELLIPSE_COLUMNS, ellipses[position])) if position is not None else None
+        if ellipse is not None and any(math.isnan(v) for v in ellipse.values()):
+            ellipse = None
+        tasks.append((image_path, ellipse))
+        task_positions.append(position)
+
+    task = partial(crop_image, output_dir=output_dir, margin=margin, max_side=max_side, image_cache=image_cache)
+    results = []
+    with report.phase('crop', total=len(images)) as phase:
+        for position, result in zip(task_positions, executor.imap(task, tasks)):
+            results.append(result)
+            if not result.ok:
+                phase.error()
+                continue
+            transform, counts = result.value
+            if result.item[1] is None:
+                stats['missing_ellipse'] += 1
+            stats['images'] += 1
+            for name, value in counts.items():
+                stats[name] += value
+            phase.tick(bytes_read=counts['bytes_before'], bytes_written=counts['bytes_after'])
+
+            if position is not None:
+                rows.append(position)
+                transforms.append(transform)
+    errors = print_errors(results, describe=lambda item: item[0])
+    if errors:
+        report.set('errors', errors)
+
+    # Metadata for the cropped images: same rows, ellipse rewritten into the cropped frame
+    cropped_metadata = metadata.iloc[rows].reset_index(drop=True)
+    transforms = pd.DataFrame(transforms)
+    for column in transforms.columns:
+        cropped_metadata[column] = transforms[column].to_numpy()
+    write_metadata(cropped_metadata, output_dir)
+
+    report.set('payload', stats)
+    return stats
+
+def print_payload_summary(stats):
+    images = max(stats['images'], 1)
+    print(f"\nCropped {stats['images']} images ({stats['missing_ellipse']} without ellipse, downscaled only)")
+    print(f"Bytes:  {format_bytes(stats['bytes_before'])} -> {format_bytes(stats['bytes_after'])} "
+          f"({format_bytes(stats['bytes_before'] / images)} -> {format_bytes(stats['bytes_after'] / images)} per image)")
+    print(f"Estimated image tokens: {stats['tokens_before']} -> {stats['tokens_after']} "
+          f"({stats['tokens_before'] / images:.0f} -> {stats['tokens_after'] / images:.0f} per image)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--max-side', type=int, default=crop_max_side(),
+                        help=f"Maximum side of a crop in pixels (default: {MAX_SIDE_ENV} or {DEFAULT_MAX_SIDE})")
+    args = parser.parse_args()
+
+    source_dir = "balanced_dataset"
+    output_dir = CROPPED_DIR
+    matched_data = "partitioned_dataset"
+
+    if not os.path.exists(source_dir):
+        print(f"Error: Source directory not found at {source_dir}")
+        return
+
+    # Remove the crops of an earlier run, whose images may no longer be in the balanced dataset
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    print(f"Cropping overlays to the brain ellipse (max side {args.max_side}px)...")
+    report = StageReport('crop_overlays')
+    report.set('max_side', args.max_side)
+    image_cache = open_image_cache()
+    with open_executor() as executor:
+        stats = crop_dataset(source_dir, output_dir, matched_data, max_side=args.max_side, report=report,
+                             image_cache=image_cache, executor=executor)
+    if image_cache is not None:
+        report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+        image_cache.close()
+
+    print_payload_summary(stats)
+    print(f"\nCropped dataset saved to: {output_dir}")
+    if not cropping_enabled():
+        print(f"Set {CROP_ENV}=1 for the later stages to use it")
+    report.write()
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,6 @@ Download the fetal ultrasound dataset from Kaggle.
 """
 
 import os
-import kaggle
 from pathlib import Path
 
 def setup_kaggle_credentials():
@@ -27,6 +26,9 @@ def download_dataset():
     if not setup_kaggle_credentials():
         return
     
+    # kaggle authenticates when it is imported, so only import it once credentials are in place
+    import kaggle
+
     print("Downloading ultrasound fetus dataset...")
     try:
         # Download the dataset
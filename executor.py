@@ -0,0 +1,266 @@
+"""
+Pluggable executor for the per-image stages.
+
+Overlay fitting, quality scoring, hashing and cropping all map a function over images and
+collect one row per image. Executor runs that map on one of several backends:
+
+- serial: in the calling process (the default)
+- thread: a thread pool, for work that releases the GIL (OpenCV decoding and filtering)
+- process: a process pool
+- dask / ray: a local or existing Dask or Ray cluster (optional dependencies)
+
+Items are submitted in chunks whose size is tuned while the map runs, results come back in
+input order, and an exception raised for one item is captured in its TaskResult instead of
+stopping the map. Pick the backend with PIPELINE_EXECUTOR and the worker count with
+PIPELINE_WORKERS.
+
+Functions and items must be picklable for the process, dask and ray backends, so use
+module-level functions (functools.partial for fixed arguments). A DecodedImageCache passed
+along is reopened read-only in each worker process.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EXECUTOR_ENV = 'PIPELINE_EXECUTOR'
+WORKERS_ENV = 'PIPELINE_WORKERS'
+CHUNK_SIZE_ENV = 'PIPELINE_CHUNK_SIZE'
+DASK_ADDRESS_ENV = 'DASK_SCHEDULER_ADDRESS'
+RAY_ADDRESS_ENV = 'RAY_ADDRESS'
+BACKENDS = ('serial', 'thread', 'process', 'dask', 'ray')
+# Chunks are sized so one takes about this long: long enough to amortize the dispatch
+# overhead, short enough to keep every worker busy until the end of the map
+TARGET_CHUNK_SECONDS = 0.2
+# Chunks in flight per worker
+CHUNKS_PER_WORKER = 2
+
+class TaskResult(namedtuple('TaskResult', ['item', 'value', 'error'])):
+    """Outcome of one item: value on success, otherwise error as 'ExceptionType: message'."""
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def _format_error(e):
+    message = str(e)
+    return f"{type(e).__name__}: {message}" if message else type(e).__name__
+
+def _run_chunk(function, chunk):
+    """Worker: apply function to every item of chunk. Returns ([(value, error)], seconds)."""
+    start = time.perf_counter()
+    outcomes = []
+    for item in chunk:
+        try:
+            outcomes.append((function(item), None))
+        except Exception as e:
+            outcomes.append((None, _format_error(e)))
+    return outcomes, time.perf_counter() - start
+
+class ChunkTuner:
+    """
+    Picks the chunk size from the measured time per item.
+
+    Starts with initial items per chunk and moves towards TARGET_CHUNK_SECONDS per chunk,
+    never above max_size.
+    """
+
+    def __init__(self, initial=1, target_seconds=TARGET_CHUNK_SECONDS, max_size=None, smoothing=0.5):
+        self.size = max(1, int(initial))
+        self.target_seconds = target_seconds
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.seconds_per_item = None
+
+    def record(self, items, seconds):
+        if not items:
+            return
+        sample = seconds / items
+        if self.seconds_per_item is None:
+            self.seconds_per_item = sample
+        else:
+            self.seconds_per_item += self.smoothing * (sample - self.seconds_per_item)
+        size = self.target_seconds / self.seconds_per_item if self.seconds_per_item > 0 else self.size * 2
+        # Grow at most 4x per chunk so one fast outlier does not produce a huge chunk
+        size = min(int(size), self.size * 4)
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        self.size = max(1, size)
+
+class _SerialPool:
+    def submit(self, fn, *args):
+        return _Done(fn(*args))
+
+    def shutdown(self):
+        pass
+
+class _Done:
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+class _DaskPool:
+    def __init__(self, workers):
+        from dask.distributed import Client, LocalCluster
+
+        address = os.environ.get(DASK_ADDRESS_ENV)
+        self.cluster = None if address else LocalCluster(n_workers=workers, threads_per_worker=1)
+        self.client = Client(address or self.cluster)
+
+    def submit(self, fn, *args):
+        return self.client.submit(fn, *args, pure=False)
+
+    def shutdown(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+class _RayPool:
+    def __init__(self, workers):
+        import ray
+
+        self.ray = ray
+        self.started = not ray.is_initialized()
+        if self.started:
+            address = os.environ.get(RAY_ADDRESS_ENV)
+            if address:
+                ray.init(address=address)
+            else:
+                ray.init(num_cpus=workers)
+        self.remote_functions = {}
+
+    def submit(self, fn, *args):
+        remote = self.remote_functions.get(fn)
+        if remote is None:
+            remote = self.remote_functions[fn] = self.ray.remote(fn)
+        return _RayFuture(self.ray, remote.remote(*args))
+
+    def shutdown(self):
+        if self.started:
+            self.ray.shutdown()
+
+class _RayFuture:
+    def __init__(self, ray, ref):
+        self.ray = ray
+        self.ref = ref
+
+    def result(self):
+        return self.ray.get(self.ref)
+
+class Executor:
+    """
+    Maps functions over items on the configured backend.
+
+    The pool is started on first use and reused by later maps until close(). chunk_size
+    fixes the number of items per chunk; by default a ChunkTuner picks it.
+    """
+
+    def __init__(self, backend='serial', workers=None, chunk_size=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown executor backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+        self.backend = backend
+        self.workers = 1 if backend == 'serial' else (workers or os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.backend == 'serial':
+                self._pool = _SerialPool()
+            elif self.backend == 'thread':
+                self._pool = ThreadPoolExecutor(self.workers)
+            elif self.backend == 'process':
+                self._pool = ProcessPoolExecutor(self.workers)
+            elif self.backend == 'dask':
+                self._pool = _DaskPool(self.workers)
+            else:
+                self._pool = _RayPool(self.workers)
+        return self._pool
+
+    def imap(self, function, items, total=None):
+        """
+        Yield a TaskResult per item, in input order, as results arrive.
+
+        total (default len(items) if available) caps the chunk size so every worker gets
+        several chunks.
+        """
+        if total is None and hasattr(items, '__len__'):
+            total = len(items)
+        max_size = max(1, total // (self.workers * 4)) if total else None
+        tuner = ChunkTuner(initial=self.chunk_size or 1, max_size=max_size)
+        pool = self._get_pool()
+        items = iter(items)
+        pending = deque()
+
+        def submit():
+            chunk = []
+            size = self.chunk_size or tuner.size
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= size:
+                    break
+            if chunk:
+                pending.append((chunk, pool.submit(_run_chunk, function, chunk)))
+            return bool(chunk)
+
+        while len(pending) < self.workers * CHUNKS_PER_WORKER and submit():
+            pass
+        while pending:
+            chunk, future = pending.popleft()
+            try:
+                outcomes, seconds = future.result()
+            except Exception as e:
+                # The chunk itself failed (e.g. a worker died or an item could not be pickled)
+                error = _format_error(e)
+                outcomes, seconds = [(None, error)] * len(chunk), 0.0
+            tuner.record(len(chunk), seconds)
+            submit()
+            for item, (value, error) in zip(chunk, outcomes):
+                yield TaskResult(item, value, error)
+
+    def map(self, function, items):
+        """List of TaskResults, one per item in input order."""
+        return list(self.imap(function, items))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+def open_executor(backend=None, workers=None, chunk_size=None):
+    """
+    Executor configured by the environment.
+
+    backend, workers and chunk_size default to PIPELINE_EXECUTOR (serial if unset),
+    PIPELINE_WORKERS and PIPELINE_CHUNK_SIZE.
+    """
+    backend = backend or os.environ.get(EXECUTOR_ENV) or 'serial'
+    workers = workers or int(os.environ.get(WORKERS_ENV) or 0) or None
+    chunk_size = chunk_size or int(os.environ.get(CHUNK_SIZE_ENV) or 0) or None
+    return Executor(backend, workers, chunk_size)
+
+def print_errors(results, limit=5, describe=str):
+    """
+    Print up to limit failed items of a map.
+
+    Returns every failure as an 'item: error' string, e.g. for the run report; describe
+    turns an item into its label.
+    """
+    failures = [f"{describe(result.item)}: {result.error}" for result in results if not result.ok]
+    for failure in failures[:limit]:
+        print(failure)
+    if len(failures) > limit:
+        print(f"... and {len(failures) - limit} more errors")
+    return failures
@@ -6,38 +6,52 @@ Fine-tune the Gemini model on the balanced fetal ultrasound dataset.
 """
 
 import time
-import vertexai
-from vertexai.tuning import sft
 
-# Initialize Vertex AI with your project
 PROJECT_ID = "mhf-test"
-vertexai.init(project=PROJECT_ID, location="us-central1")
+LOCATION = "us-central1"
+SOURCE_MODEL = "gemini-2.0-flash-001"
 
 # Define dataset paths for balanced dataset
 TRAIN_DATASET = "gs://fetus-ultrasound-balanced-with-metadata/jsonl/balanced_train_dataset.jsonl"
 VAL_DATASET = "gs://fetus-ultrasound-balanced-with-metadata/jsonl/balanced_val_dataset.jsonl"
 
-print("Starting fine-tuning job with balanced dataset...")
-print(f"Training dataset: {TRAIN_DATASET}")
-print(f"Validation dataset: {VAL_DATASET}")
-
-# Create fine-tuning job
-sft_tuning_job = sft.train(
-    source_model="gemini-2.0-flash-001",
-    train_dataset=TRAIN_DATASET,
-    validation_dataset=VAL_DATASET,
-)
-
-# Polling for job completion
-print("\nFine-tuning job started successfully!")
-print(f"Job name: {sft_tuning_job.name}")
-
-while not sft_tuning_job.has_ended:
-    time.sleep(60)
-    sft_tuning_job.refresh()
-    print("Job still running...")
-
-print("\nFine-tuning completed successfully!")
-print(f"Tuned model name: {sft_tuning_job.tuned_model_name}")
-print(f"Tuned model endpoint: {sft_tuning_job.tuned_model_endpoint_name}")
-print(f"Experiment: {sft_tuning_job.experiment}") 
\ No newline at end of file
+def fine_tune(train_dataset=TRAIN_DATASET, val_dataset=VAL_DATASET, source_model=SOURCE_MODEL,
+              project_id=PROJECT_ID, location=LOCATION, poll_seconds=60):
+    """Start a supervised tuning job and wait for it to finish. Returns the tuning job."""
+    import vertexai
+    from vertexai.tuning import sft
+
+    # Initialize Vertex AI with your project
+    vertexai.init(project=project_id, location=location)
+
+    print("Starting fine-tuning job with balanced dataset...")
+    print(f"Training dataset: {train_dataset}")
+    print(f"Validation dataset: {val_dataset}")
+
+    # Create fine-tuning job
+    sft_tuning_job = sft.train(
+        source_model=source_model,
+        train_dataset=train_dataset,
+        validation_dataset=val_dataset,
+    )
+
+    # Polling for job completion
+    print("\nFine-tuning job started successfully!")
+    print(f"Job name: {sft_tuning_job.name}")
+
+    while not sft_tuning_job.has_ended:
+        time.sleep(poll_seconds)
+        sft_tuning_job.refresh()
+        print("Job still running...")
+
+    print("\nFine-tuning completed successfully!")
+    print(f"Tuned model name: {sft_tuning_job.tuned_model_name}")
+    print(f"Tuned model endpoint: {sft_tuning_job.tuned_model_endpoint_name}")
+    print(f"Experiment: {sft_tuning_job.experiment}")
+    return sft_tuning_job
+
+def main():
+    fine_tune()
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,19 @@ Generate JSONL files for model training from the balanced dataset.
 
 import json
 import os
-import pandas as pd
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
 import re
 
+from instrumentation import StageReport, file_size
+from metadata_store import MetadataIndex, PROMPT_COLUMNS, metadata_exists, read_metadata
+from token_budget import BudgetExceeded, configured_budget, example_cost, image_info
+from executor import Executor, open_executor
+from partition_dataset import FOLD_MANIFEST, fold_count
+from crop_overlays import CROPPED_DIR, dataset_dirs
+from stage_journal import atomic_path
+
 def natural_sort_key(s):
     # Extract numbers from the filename for sorting
     return [int(text) if text.isdigit() else text.lower()
@@ -148,44 +157,189 @@ Use this metadata to enhance your analysis by considering:
         ]
     }
 
-def generate_jsonl(folder_path, output_file, bucket_path, matched_data_csv, split):
-    # Read metadata from matched_data.csv
-    params_df = pd.read_csv(matched_data_csv)
-    params_dict = dict(zip(params_df['image_filename'], params_df.to_dict('records')))
+def load_prompt_metadata(matched_data):
+    """Load only the metadata columns the prompts use, indexed by image_filename."""
+    return MetadataIndex(read_metadata(matched_data, columns=PROMPT_COLUMNS))
+
+def render_example(task, bucket_path):
+    """
+    Worker: the JSONL line of one image and its cost (see token_budget.example_cost).
+
+    task is (image file, image path relative to bucket_path, label, metadata or None).
+    """
+    image_file, image_path, label, metadata = task
+    example = create_jsonl_example(image_path, label, bucket_path, metadata, metadata)
+    line = json.dumps(example) + '\n'
+    size, image_bytes = image_info(image_file)
+    return line, example_cost(example['contents'][0]['parts'][1]['text'], label, size, image_bytes, len(line))
+
+def generate_jsonl(folder_path, output_file, bucket_path, matched_data, split, report=None, budget=None):
+    """
+    Write the JSONL examples for one split.
+
+    matched_data is either the metadata store location or a MetadataIndex from
+    load_prompt_metadata, so callers rendering several splits load it only once.
+    If a TokenBudget is given, BudgetExceeded is raised before anything is written when
+    an example or the whole file is over its limits.
+    """
+    report = report or StageReport('generate_jsonl')
+
+    if isinstance(matched_data, MetadataIndex):
+        params_index = matched_data
+    else:
+        with report.phase(f"read_metadata_{split}", total=0):
+            params_index = load_prompt_metadata(matched_data)
 
     jsonl_data = []
+    totals = {'text_tokens': 0, 'image_tokens': 0, 'tokens': 0, 'jsonl_bytes': 0, 'image_bytes': 0}
     split_path = Path(folder_path) / split
-    if split_path.exists():
-        for label in ['normal', 'benign', 'malignant']:
-            label_path = split_path / label
-            if label_path.exists():
-                # Get all PNG files and sort them naturally
-                image_files = sorted(label_path.glob('*.png'), key=natural_sort_key)
-                for image_file in image_files:
-                    image_path = f"{split}/{label}/{image_file.name}"
-                    # Get metadata for this image if available
-                    metadata = params_dict.get(image_path)
-                    jsonl_data.append(create_jsonl_example(image_path, label, bucket_path, metadata, metadata))
+    with report.phase(f"render_{split}", total=0) as phase:
+        if split_path.exists():
+            for label in ['normal', 'benign', 'malignant']:
+                label_path = split_path / label
+                if label_path.exists():
+                    # Get all PNG files and sort them naturally
+                    image_files = sorted(label_path.glob('*.png'), key=natural_sort_key)
+                    for image_file in image_files:
+                        image_path = f"{split}/{label}/{image_file.name}"
+                        # Get metadata for this image if available
+                        metadata = params_index.get(image_path)
+                        line, cost = render_example((image_file, image_path, label, metadata), bucket_path)
+                        if budget is not None:
+                            budget.check_request(cost, image_path)
+                        for key in totals:
+                            totals[key] += cost[key]
+                        jsonl_data.append(line)
+                        phase.tick()
+    if budget is not None:
+        budget.check_file(totals['tokens'], totals['jsonl_bytes'], output_file)
+    report.set(f"tokens_{split}", totals)
 
     # Write JSONL data to a file
-    with open(output_file, 'w') as f:
-        for item in jsonl_data:
-            f.write(json.dumps(item) + '\n')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with report.phase(f"write_{split}", total=0) as phase:
+        with open(output_file, 'w') as f:
+            f.writelines(jsonl_data)
+        phase.add_bytes(bytes_written=file_size(output_file))
 
     print(f"JSONL file created successfully at {output_file}.")
     print(f"Total examples: {len(jsonl_data)}")
+    print(f"Estimated input tokens: {totals['tokens']} ({totals['text_tokens']} text + {totals['image_tokens']} image)")
+
+def generate_fold_jsonl(folder_path, output_dir, bucket_path, matched_data, manifest, report=None, budget=None,
+                        executor=None):
+    """
+    Write fold_<i>_train.jsonl and fold_<i>_val.jsonl for every fold of the manifest.
+
+    The images under folder_path/<category>/ are shared by all folds: their prompts come
+    from matched_data (the metadata store location) and their folds from manifest, written
+    by partition_dataset.write_fold_manifest. Every example is rendered once, on executor
+    (serial if not given), and streamed into the validation file of its own fold and the
+    training files of all the others. If a TokenBudget is given, BudgetExceeded is raised
+    and no file is written when an example or a file is over its limits.
+    """
+    report = report or StageReport('generate_jsonl')
+    executor = executor or Executor()
+    with report.phase('read_metadata_folds', total=0):
+        params_index = load_prompt_metadata(matched_data)
+        if not metadata_exists(manifest):
+            raise ValueError(f"No fold manifest at {manifest}; run partition_dataset.py with PIPELINE_FOLDS set")
+        df = read_metadata(manifest, columns=['image_filename', 'fold'])
+        fold_of = dict(zip(df['image_filename'], df['fold']))
+    folds = sorted(int(fold) for fold in set(fold_of.values()) if fold >= 0)
+    if not folds:
+        raise ValueError(f"The fold manifest {manifest} assigns no folds")
+
+    tasks = []
+    task_folds = []
+    for label in ['normal', 'benign', 'malignant']:
+        label_path = Path(folder_path) / label
+        if label_path.exists():
+            for image_file in sorted(label_path.glob('*.png'), key=natural_sort_key):
+                fold = fold_of.get(f"{label}/{image_file.name}", -1)
+                if fold < 0:
+                    continue
+                tasks.append((str(image_file), f"{label}/{image_file.name}", label, params_index.get(image_file.name)))
+                task_folds.append(fold)
+
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {(fold, part): Path(output_dir) / f"fold_{fold}_{part}.jsonl" for fold in folds for part in ('train', 'val')}
+    totals = {output: {'examples': 0, 'tokens': 0, 'jsonl_bytes': 0} for output in outputs}
+    with ExitStack() as stack, report.phase('render_folds', total=len(tasks)) as phase:
+        # Written to temporary files that only replace the outputs once every budget check passed
+        files = {output: stack.enter_context(open(stack.enter_context(atomic_path(path)), 'w'))
+                 for output, path in outputs.items()}
+        for fold, result in zip(task_folds, executor.imap(partial(render_example, bucket_path=bucket_path), tasks)):
+            if not result.ok:
+                raise ValueError(f"Could not render {result.item[1]}: {result.error}")
+            line, cost = result.value
+            if budget is not None:
+                budget.check_request(cost, result.item[1])
+            for other in folds:
+                output = (other, 'val' if other == fold else 'train')
+                files[output].write(line)
+                totals[output]['examples'] += 1
+                totals[output]['tokens'] += cost['tokens']
+                totals[output]['jsonl_bytes'] += cost['jsonl_bytes']
+            phase.tick(bytes_written=len(line) * len(folds))
+        if budget is not None:
+            for output, total in totals.items():
+                budget.check_file(total['tokens'], total['jsonl_bytes'], outputs[output])
+    report.set('folds', {f"fold_{fold}_{part}": total for (fold, part), total in totals.items()})
+
+    for (fold, part), total in totals.items():
+        print(f"{outputs[(fold, part)]}: {total['examples']} examples, {total['tokens']} estimated input tokens")
+    return outputs
 
 def main():
     # Define paths
     folder_path = "balanced_dataset"
     bucket_path = "gs://fetus-ultrasound-balanced-with-metadata/balanced_dataset"
-    matched_data_csv = "partitioned_dataset/matched_data.csv"
+    matched_data = "partitioned_dataset"
+
+    # The ellipse-cropped images (and their rewritten ellipse metadata) from crop_overlays.py when PIPELINE_CROP is set
+    folder_path, matched_data = dataset_dirs(folder_path, matched_data)
+    if folder_path == CROPPED_DIR:
+        bucket_path = f"gs://fetus-ultrasound-balanced-with-metadata/{CROPPED_DIR}"
+        print(f"Using cropped images from {CROPPED_DIR}")
     
+    # Fail generation instead of producing requests that are too large or too expensive
+    budget = configured_budget()
+    
+    report = StageReport('generate_jsonl')
+    folds = fold_count()
+    if folds:
+        # Every fold renders from the one manifested image set (uploaded once by upload_dataset.py)
+        print(f"Rendering {folds} folds from overlayed_dataset...")
+        try:
+            with open_executor() as executor:
+                generate_fold_jsonl("overlayed_dataset", "jsonl/folds",
+                                    "gs://fetus-ultrasound-balanced-with-metadata/overlayed_dataset",
+                                    "overlayed_dataset", FOLD_MANIFEST, report=report, budget=budget, executor=executor)
+        except BudgetExceeded as e:
+            print(f"Error: token budget exceeded: {e}")
+            report.set('budget_exceeded', str(e))
+            report.write()
+            raise SystemExit(1)
+        report.write()
+        return
+
+    # Load the metadata once and share it across the splits
+    with report.phase('read_metadata', total=0):
+        params_index = load_prompt_metadata(matched_data)
+
     # Process each split
     for split in ['train', 'val', 'test']:
         output_file = f"jsonl/balanced_{split}_dataset.jsonl"
         print(f"\nProcessing {split} split...")
-        generate_jsonl(folder_path, output_file, bucket_path, matched_data_csv, split)
+        try:
+            generate_jsonl(folder_path, output_file, bucket_path, params_index, split, report=report, budget=budget)
+        except BudgetExceeded as e:
+            print(f"Error: token budget exceeded: {e}")
+            report.set('budget_exceeded', str(e))
+            report.write()
+            raise SystemExit(1)
+    report.write()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -11,149 +11,295 @@ import os
 import pandas as pd
 from pathlib import Path
 import shutil
+import threading
+from functools import partial
 
-def create_ellipse_overlay(image, ellipse_params):
-    """Create an overlay with the ellipse drawn on the original image."""
-    overlay = image.copy()
-    
-    # Draw the ellipse
-    cv2.ellipse(overlay,
-                (int(ellipse_params['center_x']), int(ellipse_params['center_y'])),
-                (int(ellipse_params['axis_x']), int(ellipse_params['axis_y'])),
-                ellipse_params['angle'],
-                0, 360, (0, 255, 0), 2)  # Green color, 2px thickness
-    
-    # Blend the overlay with the original image
-    result = cv2.addWeighted(overlay, 0.7, image, 0.3, 0)
-    return result
+from instrumentation import StageReport, file_size
+from metadata_store import read_metadata, write_metadata
+from image_cache import file_stamp, image_key, imread, open_image_cache
+from executor import Executor, open_executor, print_errors
+from mask_store import ANNOTATION_SUFFIX, annotation_key, open_mask_store
+from stage_journal import StageJournal, atomic_imwrite, journaled_imap, remove_temp_files
+
+def fit_ellipse(annotation):
+    """
+    Fit an ellipse to the largest region of a grayscale annotation mask.
+
+    Returns the ellipse parameters with semi-axes, as used by create_ellipse_overlay.
+    Raises ValueError if the mask has no usable contour.
+    """
+    # Threshold to binary
+    _, thresh = cv2.threshold(annotation, 127, 255, cv2.THRESH_BINARY)
+
+    # Find contours
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        raise ValueError("No contours found")
+
+    # Fit ellipse to the largest contour
+    cnt = max(contours, key=cv2.contourArea)
+    if len(cnt) < 5:
+        raise ValueError("Not enough points to fit ellipse")
+
+    (center_x, center_y), (axis_x, axis_y), angle = cv2.fitEllipse(cnt)
+    return {
+        'center_x': center_x,
+        'center_y': center_y,
+        'axis_x': axis_x/2,  # OpenCV returns full length, divide by 2 for radius
+        'axis_y': axis_y/2,
+        'angle': angle
+    }
+
+# Overlay ring: green, 2px, blended 70/30 with the original image
+ELLIPSE_COLOR = (0, 255, 0)
+ELLIPSE_THICKNESS = 2
+OVERLAY_ALPHA = 0.7
+
+def ellipse_region(ellipse_params, width, height, thickness=ELLIPSE_THICKNESS):
+    """
+    (x0, y0, x1, y1) bounding every pixel cv2.ellipse can draw for ellipse_params, clipped
+    to the image, or None if the ellipse is entirely outside it.
+    """
+    center_x, center_y = int(ellipse_params['center_x']), int(ellipse_params['center_y'])
+    axis_x, axis_y = int(ellipse_params['axis_x']), int(ellipse_params['axis_y'])
+    # OpenCV rounds the angle to whole degrees, so take the larger extent of both neighbours
+    angles = np.deg2rad([np.floor(ellipse_params['angle']), np.ceil(ellipse_params['angle'])])
+    half_width = np.hypot(axis_x * np.cos(angles), axis_y * np.sin(angles)).max()
+    half_height = np.hypot(axis_x * np.sin(angles), axis_y * np.cos(angles)).max()
+    # The ring extends by the line thickness; the rest covers rounding of the polygon points
+    pad = thickness + 2
+    x0 = max(center_x - int(np.ceil(half_width)) - pad, 0)
+    y0 = max(center_y - int(np.ceil(half_height)) - pad, 0)
+    x1 = min(center_x + int(np.ceil(half_width)) + pad + 1, width)
+    y1 = min(center_y + int(np.ceil(half_height)) + pad + 1, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+class OverlayRenderer:
+    """
+    Renders the same pixels as the original full-frame overlay while only touching the ellipse's bounding region.
+
+    The original drew the ring on a copy of the frame and blended the whole copy 70/30 with
+    the frame. Blending a pixel with itself gives the pixel back, so only the region around
+    the ring needs drawing and blending; everything else is a plain copy. The renderer keeps
+    a scratch buffer for that region between calls, so use one renderer per worker thread.
+    """
+
+    def __init__(self):
+        self._scratch = np.empty(0, dtype=np.uint8)
+
+    def _region_copy(self, region):
+        """Copy region into the reused scratch buffer and return the copy."""
+        if self._scratch.size < region.size:
+            self._scratch = np.empty(region.size, dtype=np.uint8)
+        copy = self._scratch[:region.size].reshape(region.shape)
+        np.copyto(copy, region)
+        return copy
+
+    def render(self, image, ellipse_params, out=None):
+        """
+        Overlay of one image, written to out (a new array by default).
+
+        out may be image itself to render in place, or any array of the same shape and dtype.
+        """
+        if out is None:
+            out = image.copy()
+        elif out is not image:
+            np.copyto(out, image)
+        region = ellipse_region(ellipse_params, image.shape[1], image.shape[0])
+        if region is None:
+            return out
+        x0, y0, x1, y1 = region
+        # The original pixels of the region: image is still untouched unless rendering in place
+        original = self._region_copy(image[y0:y1, x0:x1]) if out is image else image[y0:y1, x0:x1]
+        target = out[y0:y1, x0:x1]
+        cv2.ellipse(target,
+                    (int(ellipse_params['center_x']) - x0, int(ellipse_params['center_y']) - y0),
+                    (int(ellipse_params['axis_x']), int(ellipse_params['axis_y'])),
+                    ellipse_params['angle'],
+                    0, 360, ELLIPSE_COLOR, ELLIPSE_THICKNESS)
+        cv2.addWeighted(target, OVERLAY_ALPHA, original, 1 - OVERLAY_ALPHA, 0, dst=target)
+        return out
+
+    def render_batch(self, images, ellipse_params_list, out=None):
+        """
+        Overlays of many images.
+
+        out may be a list of arrays, or one (N, height, width, channels) array when the
+        images share a shape; by default a new array is allocated per image.
+        """
+        if out is None:
+            out = [None] * len(images)
+        return [self.render(image, params, target)
+                for image, params, target in zip(images, ellipse_params_list, out)]
 
-def process_annotations(annotation_dir, output_base_path):
-    """Process annotation images and generate overlays."""
+_renderers = threading.local()
+
+def get_renderer():
+    """The OverlayRenderer of the calling thread."""
+    renderer = getattr(_renderers, 'renderer', None)
+    if renderer is None:
+        renderer = _renderers.renderer = OverlayRenderer()
+    return renderer
+
+def create_ellipse_overlay(image, ellipse_params, out=None):
+    """Create an overlay with the ellipse drawn on the original image (see OverlayRenderer)."""
+    return get_renderer().render(image, ellipse_params, out)
+
+def overlay_in_place(image, ellipse_params):
+    """
+    Overlay drawn into image itself when it is writeable, for callers that no longer need
+    the original; a read-only image is copied instead.
+    """
+    return create_ellipse_overlay(image, ellipse_params, image if image.flags.writeable else None)
+
+def overlay_row(original_img, category, ellipse_params):
+    """Metadata row of the overlay of original_img; source_filename is the original image's name."""
+    return {
+        'image_number': int(original_img.split('_')[0]),
+        'image_filename': f"overlay_{original_img}",
+        'category': category,
+        'fetal_health': 1.0 if category == 'normal' else (2.0 if category == 'benign' else 3.0),
+        'ellipse_center_x': ellipse_params['center_x'],
+        'ellipse_center_y': ellipse_params['center_y'],
+        'ellipse_axis_x': ellipse_params['axis_x'],
+        'ellipse_axis_y': ellipse_params['axis_y'],
+        'ellipse_angle': ellipse_params['angle'],
+        'has_annotation': True,
+        'source_filename': original_img
+    }
+
+def overlay_annotation(image_path, output_dir, image_cache=None, mask_store=None):
+    """
+    Fit the ellipse of one <category>/<name>.png image's annotation and write its overlay.
+
+    The annotation mask is read from mask_store (a MaskStore) if given, otherwise from the
+    <name>_Annotation.png next to the image. Returns (metadata row, bytes read, bytes written).
+    Raises ValueError if the annotation or the image cannot be used.
+    """
+    original_path = Path(image_path)
+    category = original_path.parent.name
+    original_img = original_path.name
+
+    # Read annotation mask
+    if mask_store is not None:
+        img = mask_store.get(annotation_key(original_img))
+        annotation_bytes = 0
+    else:
+        annotation_path = original_path.with_name(original_img.replace(".png", ANNOTATION_SUFFIX))
+        img = imread(annotation_path, cv2.IMREAD_GRAYSCALE, image_cache)
+        annotation_bytes = file_size(annotation_path)
+    if img is None:
+        raise ValueError("Could not read annotation")
+    ellipse_params = fit_ellipse(img)
+
+    if not original_path.exists():
+        raise ValueError(f"Original image not found: {original_path}")
+
+    # Read original image
+    original = imread(original_path, cv2.IMREAD_COLOR, image_cache)
+    if original is None:
+        raise ValueError(f"Could not read original image: {original_path}")
+
+    # Create overlay
+    overlay = overlay_in_place(original, ellipse_params)
+
+    # Save overlay
+    overlay_filename = f"overlay_{original_img}"
+    overlay_path = Path(output_dir) / category / overlay_filename
+    atomic_imwrite(overlay_path, overlay)
+    if image_cache is not None:
+        # Later stages read the overlay, so cache it now instead of decoding it again
+        image_cache.put(image_key(overlay_path), overlay, file_stamp(overlay_path))
+
+    # Data for CSV; original metadata is joined on source_filename by process_annotations
+    data_entry = overlay_row(original_img, category, ellipse_params)
+    return data_entry, annotation_bytes + file_size(original_path), file_size(overlay_path)
+
+def process_annotations(annotation_dir, output_base_path, report=None, image_cache=None, executor=None,
+                        journal=None):
+    """
+    Process annotation images and generate overlays.
+
+    Annotation masks come from the mask store written by match_metadata.py, or from the
+    _Annotation.png files of older matched trees. If image_cache (a DecodedImageCache) is given,
+    decoded images are read from and added to it. The annotations are processed on executor (serial if not given); failures are listed in the report.
+    If journal (a StageJournal) is given, every written overlay is journaled and the images
+    an interrupted run already finished are skipped.
+    """
+    report = report or StageReport('generate_overlays')
+    executor = executor or Executor()
+    
     # Create output directory
-    output_dir = "overlayed_dataset"
+    output_dir = output_base_path
     os.makedirs(output_dir, exist_ok=True)
     
     # Initialize counters and data collection
     total_processed = 0
     category_counts = {}
     processed_data = []
+    errors = []
     
-    # Read the original matched_data.csv to preserve all metadata
-    original_metadata = pd.read_csv(Path(annotation_dir) / 'matched_data.csv')
-    metadata_dict = dict(zip(original_metadata['image_filename'], original_metadata.to_dict('records')))
+    # Read the original metadata table; it is joined onto the overlay rows at the end
+    original_metadata = read_metadata(annotation_dir)
     
     # Process each category
-    for category in os.listdir(annotation_dir):
-        category_path = Path(annotation_dir) / category
-        if not category_path.is_dir():
-            continue
-            
-        # Create category output directory
-        category_output = Path(output_dir) / category
-        os.makedirs(category_output, exist_ok=True)
-        
-        print(f"\nProcessing {category} category...")
-        category_processed = 0
+    categories = [c for c in os.listdir(annotation_dir) if (Path(annotation_dir) / c).is_dir()]
+    mask_store = open_mask_store(annotation_dir)
+    if mask_store is not None:
+        annotations = {
+            c: [Path(annotation_dir) / c / f for f in os.listdir(Path(annotation_dir) / c)
+                if f.endswith(".png") and annotation_key(f) in mask_store]
+            for c in categories
+        }
+    else:
+        annotations = {
+            c: [Path(annotation_dir) / c / f.replace(ANNOTATION_SUFFIX, ".png")
+                for f in os.listdir(Path(annotation_dir) / c) if f.endswith(ANNOTATION_SUFFIX)]
+            for c in categories
+        }
+    task = partial(overlay_annotation, output_dir=output_dir, image_cache=image_cache, mask_store=mask_store)
+    with report.phase('overlay', total=sum(len(paths) for paths in annotations.values())) as phase:
+        for category in categories:
+            # Create category output directory
+            os.makedirs(Path(output_dir) / category, exist_ok=True)
         
-        # Process each annotation image
-        for fname in os.listdir(category_path):
-            if not fname.endswith("_Annotation.png"):
-                continue
-                
-            # Read annotation image
-            img_path = category_path / fname
-            img = cv2.imread(str(img_path), cv2.IMREAD_GRAYSCALE)
-            
-            if img is None:
-                print(f"Could not read image: {img_path}")
-                continue
-            
-            # Threshold to binary
-            _, thresh = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
-            
-            # Find contours
-            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            if len(contours) == 0:
-                print(f"No contours found in: {fname}")
-                continue
-            
-            # Fit ellipse to the largest contour
-            cnt = max(contours, key=cv2.contourArea)
-            
-            if len(cnt) < 5:
-                print(f"Not enough points to fit ellipse in: {fname}")
-                continue
-            
-            # Fit ellipse
-            ellipse = cv2.fitEllipse(cnt)
-            (center_x, center_y), (axis_x, axis_y), angle = ellipse
-            
-            # Get the original image
-            original_img = fname.replace("_Annotation.png", ".png")
-            original_path = category_path / original_img
-            
-            if not original_path.exists():
-                print(f"Original image not found: {original_path}")
-                continue
-            
-            # Read original image
-            original = cv2.imread(str(original_path))
-            if original is None:
-                print(f"Could not read original image: {original_path}")
-                continue
-            
-            # Create overlay
-            ellipse_params = {
-                'center_x': center_x,
-                'center_y': center_y,
-                'axis_x': axis_x/2,  # OpenCV returns full length, divide by 2 for radius
-                'axis_y': axis_y/2,
-                'angle': angle
-            }
-            
-            overlay = create_ellipse_overlay(original, ellipse_params)
-            
-            # Save overlay
-            overlay_filename = f"overlay_{original_img}"
-            overlay_path = category_output / overlay_filename
-            cv2.imwrite(str(overlay_path), overlay)
-            
-            # Get original metadata for this image
-            original_metadata = metadata_dict.get(original_img, {})
-            
-            # Add data for CSV, preserving all original metadata
-            data_entry = {
-                'image_number': int(original_img.split('_')[0]),
-                'image_filename': overlay_filename,
-                'category': category,
-                'fetal_health': 1.0 if category == 'normal' else (2.0 if category == 'benign' else 3.0),
-                'ellipse_center_x': center_x,
-                'ellipse_center_y': center_y,
-                'ellipse_axis_x': axis_x/2,
-                'ellipse_axis_y': axis_y/2,
-                'ellipse_angle': angle,
-                'has_annotation': True
-            }
-            
-            # Add all original metadata fields
-            for key, value in original_metadata.items():
-                if key not in data_entry:
-                    data_entry[key] = value
-            
-            processed_data.append(data_entry)
-            
-            category_processed += 1
-            total_processed += 1
-            print(f"Processed: {fname}")
+            print(f"\nProcessing {category} category...")
+            category_processed = 0
+            results = []
+            # Journaled overlays are only reused while their file is still there
+            for result in journaled_imap(executor, task, annotations[category], journal,
+                                         key=lambda path: f"{path.parent.name}/{path.name}",
+                                         keep=lambda path, value: (Path(output_dir) / path.parent.name /
+                                                                   value[0]['image_filename']).exists()):
+                results.append(result)
+                if not result.ok:
+                    phase.error()
+                    continue
+                data_entry, bytes_read, bytes_written = result.value
+                processed_data.append(data_entry)
+                category_processed += 1
+                total_processed += 1
+                phase.tick(bytes_read=bytes_read, bytes_written=bytes_written)
+            errors += print_errors(results)
         
-        category_counts[category] = category_processed
-        print(f"Completed {category}: {category_processed} images processed")
+            category_counts[category] = category_processed
+            print(f"Completed {category}: {category_processed} images processed")
+    if mask_store is not None:
+        mask_store.close()
     
-    # Create and save the updated CSV
+    # Join the original metadata fields onto the overlay rows and save the updated table
     df = pd.DataFrame(processed_data)
+    extra_columns = [c for c in original_metadata.columns if c not in df.columns]
+    original_metadata = original_metadata[extra_columns + ['image_filename']].rename(
+        columns={'image_filename': 'source_filename'})
+    df = df.merge(original_metadata, on='source_filename', how='left').drop(columns='source_filename')
     df = df.sort_values('image_number')
-    df.to_csv(Path(output_dir) / 'matched_data.csv', index=False)
+    write_metadata(df, output_dir)
+    report.set('category_counts', category_counts)
+    if errors:
+        report.set('errors', errors)
     
     return total_processed, category_counts
 
@@ -167,7 +313,23 @@ def main():
         return
     
     print("Starting overlay generation...")
-    total_processed, category_counts = process_annotations(annotation_dir, output_base)
+    report = StageReport('generate_overlays')
+    image_cache = open_image_cache()
+    # An interrupted run left its journal; resume it instead of starting over
+    os.makedirs(output_base, exist_ok=True)
+    remove_temp_files(output_base)
+    journal = StageJournal(output_base, 'generate_overlays')
+    if journal.resumed:
+        print(f"Resuming: {len(journal)} overlays already written")
+        report.set('resumed', len(journal))
+    with open_executor() as executor:
+        total_processed, category_counts = process_annotations(annotation_dir, output_base, report=report,
+                                                               image_cache=image_cache, executor=executor,
+                                                               journal=journal)
+    journal.finish()
+    if image_cache is not None:
+        report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+        image_cache.close()
     
     print("\nOverlay generation complete!")
     print(f"Total images processed: {total_processed}")
@@ -175,6 +337,7 @@ def main():
     for category, count in category_counts.items():
         print(f"{category}: {count} images")
     print(f"\nOverlays have been saved to: {output_base}")
+    report.write()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
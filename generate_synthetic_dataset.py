@@ -0,0 +1,195 @@
+"""
+Generate a synthetic stand-in for the Kaggle ultrasound fetus dataset.
+
+Writes ultrasound-like PNGs, elliptical `_Annotation.png` masks and a matching
+FetusDataset.csv in the same layout as the downloaded dataset, so the pipeline
+can be tested and benchmarked without Kaggle access.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+DATASET_SUBDIR = Path('Ultrasound Fetus Dataset/Ultrasound Fetus Dataset/Data/Data')
+CATEGORIES = ['normal', 'benign', 'malignant']
+# Roughly the class balance of the real CTG data
+CLASS_WEIGHTS = [0.78, 0.14, 0.08]
+
+# Column name -> (mean per class normal/benign/malignant, std, min, max)
+CTG_COLUMNS = {
+    'baseline value': ((132.0, 141.0, 131.0), 9.0, 106.0, 160.0),
+    'accelerations': ((0.004, 0.0005, 0.0004), 0.003, 0.0, 0.019),
+    'fetal_movement': ((0.008, 0.008, 0.026), 0.04, 0.0, 0.481),
+    'uterine_contractions': ((0.005, 0.002, 0.004), 0.003, 0.0, 0.015),
+    'light_decelerations': ((0.002, 0.0003, 0.004), 0.003, 0.0, 0.015),
+    'severe_decelerations': ((0.0, 0.0, 0.00004), 0.00005, 0.0, 0.001),
+    'prolongued_decelerations': ((0.0001, 0.0001, 0.0014), 0.0006, 0.0, 0.005),
+    'abnormal_short_term_variability': ((42.0, 61.0, 57.0), 15.0, 12.0, 87.0),
+    'mean_value_of_short_term_variability': ((1.4, 0.6, 1.6), 0.8, 0.2, 7.0),
+    'percentage_of_time_with_abnormal_long_term_variability': ((5.0, 29.0, 23.0), 15.0, 0.0, 91.0),
+    'mean_value_of_long_term_variability': ((8.7, 8.0, 3.6), 5.0, 0.0, 50.7),
+    'histogram_width': ((73.0, 49.0, 78.0), 38.0, 3.0, 180.0),
+    'histogram_min': ((91.0, 115.0, 86.0), 28.0, 50.0, 159.0),
+    'histogram_max': ((164.0, 164.0, 163.0), 17.0, 122.0, 238.0),
+    'histogram_number_of_peaks': ((4.0, 3.0, 4.0), 2.9, 0.0, 18.0),
+    'histogram_number_of_zeroes': ((0.3, 0.3, 0.4), 0.7, 0.0, 10.0),
+    'histogram_mode': ((139.0, 148.0, 115.0), 16.0, 60.0, 187.0),
+    'histogram_mean': ((137.0, 146.0, 113.0), 15.0, 73.0, 182.0),
+    'histogram_median': ((139.0, 148.0, 119.0), 14.0, 77.0, 186.0),
+    'histogram_variance': ((17.0, 8.0, 51.0), 29.0, 0.0, 269.0),
+    'histogram_tendency': ((0.3, 0.3, 0.0), 0.6, -1.0, 1.0),
+}
+# Columns that hold whole numbers in the real dataset
+INTEGER_COLUMNS = {
+    'baseline value', 'abnormal_short_term_variability', 'percentage_of_time_with_abnormal_long_term_variability',
+    'histogram_width', 'histogram_min', 'histogram_max', 'histogram_number_of_peaks',
+    'histogram_number_of_zeroes', 'histogram_mode', 'histogram_mean', 'histogram_median',
+    'histogram_variance', 'histogram_tendency',
+}
+
+def synthesize_labels(num_images, seed=42):
+    """Return a fetal_health class (1.0/2.0/3.0) for each image."""
+    rng = np.random.default_rng(seed)
+    return rng.choice([1.0, 2.0, 3.0], size=num_images, p=CLASS_WEIGHTS)
+
+def synthesize_metadata(labels, seed=42):
+    """Create a FetusDataset.csv-style DataFrame with class-dependent CTG features."""
+    rng = np.random.default_rng(seed + 1)
+    class_index = (labels - 1).astype(int)
+    columns = {}
+    for column, (means, std, low, high) in CTG_COLUMNS.items():
+        values = np.asarray(means)[class_index] + rng.normal(0.0, std, size=len(labels))
+        values = np.clip(values, low, high)
+        if column in INTEGER_COLUMNS:
+            values = np.round(values)
+        else:
+            values = np.round(values, 4)
+        columns[column] = values + 0.0  # Avoid -0.0 from rounding
+    columns['fetal_health'] = labels
+    return pd.DataFrame(columns)
+
+def synthesize_image(image_number, category, width, height, seed=42):
+    """
+    Render one ultrasound-like frame and its ellipse annotation mask.
+
+    Returns (image, mask) as uint8 arrays of shape (height, width).
+    """
+    rng = np.random.default_rng([seed, image_number])
+
+    # Fan-shaped acquisition sector with speckle over soft tissue
+    tissue = np.full((height, width), 60, dtype=np.float32)
+    sector = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(sector, (width // 2, 0), (int(height * 1.1), int(height * 1.1)), 90, -40, 40, 255, -1)
+
+    # Head: bright skull ring around a darker brain region
+    cx = width / 2 + rng.uniform(-0.1, 0.1) * width
+    cy = height / 2 + rng.uniform(-0.1, 0.1) * height
+    ax = rng.uniform(0.22, 0.32) * width
+    ay = ax * rng.uniform(0.65, 0.9)
+    angle = rng.uniform(0, 180)
+    center = (int(cx), int(cy))
+    axes = (int(ax), int(ay))
+    cv2.ellipse(tissue, center, axes, angle, 0, 360, 35, -1)
+    cv2.ellipse(tissue, center, axes, angle, 0, 360, 200, max(2, width // 80))
+
+    # Midline echo
+    theta = np.deg2rad(angle)
+    dx, dy = np.cos(theta) * ax * 0.8, np.sin(theta) * ax * 0.8
+    cv2.line(tissue, (int(cx - dx), int(cy - dy)), (int(cx + dx), int(cy + dy)), 120, 1)
+
+    # Category-specific findings inside the head
+    if category == 'benign':
+        r = int(ay * rng.uniform(0.12, 0.2))
+        cv2.circle(tissue, (int(cx + ax * 0.3), int(cy)), r, 10, -1)
+    elif category == 'malignant':
+        r = int(ay * rng.uniform(0.2, 0.35))
+        cv2.circle(tissue, (int(cx - ax * 0.25), int(cy + ay * 0.2)), r, 170, -1)
+
+    # Multiplicative Rayleigh speckle, slightly correlated
+    speckle = rng.rayleigh(1.0, size=(height, width)).astype(np.float32)
+    speckle = cv2.GaussianBlur(speckle, (3, 3), 0)
+    image = tissue * speckle
+    image[sector == 0] = 0
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, center, axes, angle, 0, 360, 255, 2)
+    return image, mask
+
+def _write_images(args):
+    """Worker: render and write a contiguous range of images."""
+    datasets_dir, start, labels, width, height, seed, annotation_ratio = args
+    rng = np.random.default_rng([seed, start, 7])
+    for offset, label in enumerate(labels):
+        image_number = start + offset
+        category = CATEGORIES[int(label) - 1]
+        image, mask = synthesize_image(image_number, category, width, height, seed)
+        category_dir = Path(datasets_dir) / category
+        cv2.imwrite(str(category_dir / f"{image_number}_HC.png"), image)
+        if rng.random() < annotation_ratio:
+            cv2.imwrite(str(category_dir / f"{image_number}_HC_Annotation.png"), mask)
+    return len(labels)
+
+def generate_synthetic_dataset(output_root='data', num_images=1000, width=320, height=240, seed=42,
+                               annotation_ratio=1.0, workers=None, chunk_size=500):
+    """
+    Generate a synthetic dataset laid out like the Kaggle download.
+
+    Args:
+        output_root: Directory the Kaggle archive would be unzipped into
+        num_images: Number of images (and CSV rows) to generate
+        width, height: Frame size in pixels
+        seed: Random seed; the same seed always produces the same dataset
+        annotation_ratio: Fraction of images that get an `_Annotation.png` mask
+        workers: Number of worker processes (default: CPU count)
+        chunk_size: Images rendered per worker task
+
+    Returns the path to the directory containing FetusDataset.csv.
+    """
+    base_path = Path(output_root) / DATASET_SUBDIR
+    datasets_dir = base_path / 'Datasets'
+    for category in CATEGORIES:
+        (datasets_dir / category).mkdir(parents=True, exist_ok=True)
+
+    labels = synthesize_labels(num_images, seed)
+    synthesize_metadata(labels, seed).to_csv(base_path / 'FetusDataset.csv', index=False)
+
+    # Image numbers are 1-based: row idx of the CSV corresponds to image idx + 1
+    tasks = [
+        (str(datasets_dir), start + 1, labels[start:start + chunk_size], width, height, seed, annotation_ratio)
+        for start in range(0, num_images, chunk_size)
+    ]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        written = sum(pool.map(_write_images, tasks))
+
+    with open(base_path / 'synthetic.json', 'w') as f:
+        json.dump({'num_images': num_images, 'width': width, 'height': height, 'seed': seed,
+                   'annotation_ratio': annotation_ratio}, f)
+    print(f"Generated {written} synthetic images in {datasets_dir}")
+    return base_path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--num-images', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--annotation-ratio', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output-root', default='data')
+    args = parser.parse_args()
+
+    generate_synthetic_dataset(args.output_root, args.num_images, args.width, args.height, args.seed,
+                               args.annotation_ratio, args.workers)
+
+if __name__ == "__main__":
+    main()
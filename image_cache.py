@@ -0,0 +1,247 @@
+"""
+Optional cache of decoded images shared by the CPU stages.
+
+Decoded pixels are stored in one memory-mapped uint8 file with an offset/shape index keyed
+by image id, so an image decoded by one stage (or run) is read back by later stages and
+by worker processes with a single memory copy instead of decoding the PNG again. The store has a size
+limit and evicts the least recently used images when it is full.
+
+Enable it for the pipeline scripts by pointing DECODED_IMAGE_CACHE at a directory.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+CACHE_DIR_ENV = 'DECODED_IMAGE_CACHE'
+CACHE_BYTES_ENV = 'DECODED_IMAGE_CACHE_BYTES'
+DEFAULT_MAX_BYTES = 8 * 1024 ** 3
+
+PIXELS_FILE = 'pixels.bin'
+INDEX_FILE = 'index.json'
+
+class DecodedImageCache:
+    """
+    Memory-mapped store of decoded uint8 images with LRU eviction.
+
+    A single process fills the cache; any number of processes can open it with
+    readonly=True and read the arrays back. Readers see the index as it was
+    when they opened it. Pickling a cache (e.g. to send it to a worker process) flushes
+    it and reopens it read-only on the other side. Threads can share one instance.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, readonly=False):
+        self.cache_dir = Path(cache_dir)
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> entry dict; ordered from least to most recently used
+        self._entries = OrderedDict()
+        # size -> offsets of freed extents of exactly that size
+        self._free = {}
+        self._tail = 0
+        self._lock = threading.RLock()
+
+        index_path = self.cache_dir / INDEX_FILE
+        if index_path.exists():
+            with open(index_path) as f:
+                state = json.load(f)
+            self.max_bytes = state['max_bytes']
+            self._tail = state['tail']
+            self._free = {int(size): offsets for size, offsets in state['free'].items()}
+            for key, entry in state['entries']:
+                self._entries[key] = entry
+        elif readonly:
+            raise FileNotFoundError(f"No decoded image cache at {self.cache_dir}")
+        else:
+            self.max_bytes = int(max_bytes)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        pixels_path = self.cache_dir / PIXELS_FILE
+        if not readonly and (not pixels_path.exists() or pixels_path.stat().st_size < self.max_bytes):
+            # Sparse file: disk blocks are only used as images are written
+            with open(pixels_path, 'ab') as f:
+                f.truncate(self.max_bytes)
+        self._pixels = np.memmap(pixels_path, dtype=np.uint8, mode='r' if readonly else 'r+',
+                                 shape=(self.max_bytes,))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __reduce__(self):
+        self.flush()
+        return (_open_readonly, (str(self.cache_dir),))
+
+    @property
+    def used_bytes(self):
+        return sum(entry['nbytes'] for entry in self._entries.values())
+
+    def get(self, key, stamp=None):
+        """
+        Return a copy of the cached array for key, or None on a miss.
+
+        If stamp is given it must match the stamp stored with the entry (see file_stamp).
+        The pixels are copied while the lock is held, since another thread's put() may
+        evict the entry and reuse its space as soon as the lock is released.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (stamp is not None and entry.get('stamp') != stamp):
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.readonly:
+                self._entries.move_to_end(key)
+            view = self._pixels[entry['offset']:entry['offset'] + entry['nbytes']]
+            return np.array(view).reshape(entry['shape'])
+
+    def put(self, key, array, stamp=None):
+        """
+        Copy array into the cache under key, evicting old entries if needed.
+
+        Returns the array itself (as a contiguous uint8 array); the cache keeps its own copy.
+        """
+        if self.readonly:
+            return array
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+        nbytes = array.nbytes
+        if nbytes > self.max_bytes or nbytes == 0:
+            return array
+        with self._lock:
+            if key in self._entries:
+                self._release(key)
+
+            offset = self._allocate(nbytes)
+            while offset is None:
+                self._evict_oldest()
+                offset = self._allocate(nbytes)
+
+            self._pixels[offset:offset + nbytes] = array.reshape(-1)
+            self._entries[key] = {'offset': offset, 'nbytes': nbytes, 'shape': list(array.shape), 'stamp': stamp}
+        return array
+
+    def imread(self, path, flags=cv2.IMREAD_COLOR, key=None):
+        """
+        cv2.imread through the cache.
+
+        The key defaults to the file name and decode flags; entries are invalidated when
+        the file's size or modification time changes.
+        """
+        key = key or image_key(path, flags)
+        stamp = file_stamp(path)
+        if stamp is None:
+            return None
+        cached = self.get(key, stamp)
+        if cached is not None:
+            return cached
+        image = cv2.imread(str(path), flags)
+        if image is None:
+            return None
+        return self.put(key, image, stamp)
+
+    def flush(self):
+        """Persist the index atomically and flush the pixel data."""
+        if self.readonly:
+            return
+        with self._lock:
+            self._pixels.flush()
+            state = {
+                'max_bytes': self.max_bytes,
+                'tail': self._tail,
+                'free': {str(size): offsets for size, offsets in self._free.items() if offsets},
+                'entries': list(self._entries.items()),
+            }
+        index_path = self.cache_dir / INDEX_FILE
+        tmp_path = index_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, index_path)
+
+    def close(self):
+        self.flush()
+        self._pixels = None
+
+    def _allocate(self, nbytes):
+        """Return an offset for nbytes: an exact-size freed extent first, then the tail."""
+        free = self._free.get(nbytes)
+        if free:
+            return free.pop()
+        if self._tail + nbytes <= self.max_bytes:
+            offset = self._tail
+            self._tail += nbytes
+            return offset
+        if not self._entries:
+            # Everything has been evicted: start again from an empty file
+            self._free.clear()
+            self._tail = 0
+            return self._allocate(nbytes)
+        return None
+
+    def _release(self, key):
+        entry = self._entries.pop(key)
+        if entry['offset'] + entry['nbytes'] == self._tail:
+            self._tail = entry['offset']
+        else:
+            self._free.setdefault(entry['nbytes'], []).append(entry['offset'])
+
+    def _evict_oldest(self):
+        key = next(iter(self._entries))
+        self._release(key)
+        self.evictions += 1
+
+# Read-only caches opened in this process by unpickling, one per directory
+_readonly_caches = {}
+
+def _open_readonly(cache_dir):
+    cache = _readonly_caches.get(cache_dir)
+    if cache is None:
+        cache = _readonly_caches[cache_dir] = DecodedImageCache(cache_dir, readonly=True)
+    return cache
+
+def image_key(path, flags=cv2.IMREAD_COLOR):
+    """Cache key for an image: its file name plus the decode flags."""
+    return f"{Path(path).name}:{flags}"
+
+def file_stamp(path):
+    """Size and modification time of a file, used to detect stale cache entries."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def open_image_cache(cache_dir=None, max_bytes=None, readonly=False):
+    """
+    Open the decoded image cache configured by the environment, or return None if disabled.
+
+    cache_dir and max_bytes default to DECODED_IMAGE_CACHE and DECODED_IMAGE_CACHE_BYTES.
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    max_bytes = max_bytes or int(os.environ.get(CACHE_BYTES_ENV, DEFAULT_MAX_BYTES))
+    return DecodedImageCache(cache_dir, max_bytes=max_bytes, readonly=readonly)
+
+def imread(path, flags=cv2.IMREAD_COLOR, cache=None):
+    """cv2.imread that goes through cache when one is given."""
+    if cache is None:
+        return cv2.imread(str(path), flags)
+    return cache.imread(path, flags)
@@ -0,0 +1,718 @@
+"""
+Low-latency online inference service for single ultrasound frames.
+
+POST /predict takes a raw ultrasound image, its annotation mask and the CTG metadata as JSON
+(images base64-encoded). The ellipse is fitted and the overlay rendered in memory with the
+generate_overlays logic, the prompt is built with convert_batch_format.create_dynamic_prompt,
+and the request is sent to the model endpoint. Requests are grouped into micro-batches and
+sent over a pool of persistent connections with a limit on in-flight calls.
+GET /metrics reports p50/p99 latencies.
+
+With --context-cache, the static prompt prefix is registered once as cached content
+(context_cache.py) and each request carries only the image and its measurement and metadata
+lines; if the endpoint cannot use cached content, or a tuned model has not passed the agreement
+check in context_cache.py, the full prompts are sent instead.
+
+    python inference_server.py --endpoint-url https://us-central1-aiplatform.googleapis.com/v1/projects/.../endpoints/...:predict
+    python inference_server.py --self-test
+    python inference_server.py --self-test --context-cache
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+from context_cache import ContextCache, cached_contents_url
+from convert_batch_format import create_dynamic_prompt, effective_prompt
+from crop_overlays import DEFAULT_MAX_SIDE, crop_max_side, crop_to_ellipse
+from generate_overlays import create_ellipse_overlay, fit_ellipse
+from instrumentation import StageReport
+from metadata_store import ELLIPSE_COLUMNS, FEATURE_COLUMNS
+from prediction_cache import estimate_input_tokens, open_prediction_cache, request_hash
+from triage_model import DEFAULT_THRESHOLD, TRIAGE_MODEL_PATH, open_triage_cascade, triage_response
+
+LABELS = ['normal', 'benign', 'malignant']
+TOKEN_ENV = 'ENDPOINT_ACCESS_TOKEN'
+
+class ServiceUnavailable(Exception):
+    """The service is overloaded and cannot queue another request."""
+
+class ModelError(Exception):
+    """The model endpoint returned an error or an unusable response; status is the HTTP status, if any."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def rejected_request(error):
+    """Whether error is the endpoint refusing the request itself (4xx other than rate limiting)."""
+    return isinstance(error, ModelError) and error.status is not None and 400 <= error.status < 500 \
+        and error.status != 429
+
+class ConnectionPool:
+    """
+    Fixed-size pool of persistent HTTP(S) connections to one host.
+
+    At most size requests are in flight at once; further callers wait for a free connection.
+    """
+
+    def __init__(self, url, size=8, timeout=60):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and return (status, response bytes)."""
+        with self._slots:
+            try:
+                connection, reused = self._idle.get_nowait(), True
+            except queue.Empty:
+                connection, reused = self._connect(), False
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed an idle connection: retry once on a fresh one
+                connection = self._connect()
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+            data = response.read()
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class AccessToken:
+    """
+    Bearer token for Vertex AI.
+
+    Either a fixed token, or Google credentials whose token is refreshed when it is about to
+    expire (google.auth treats it as expired a few minutes early) or after a 401. Safe to share
+    between threads.
+    """
+
+    def __init__(self, credentials=None, token=None):
+        self.credentials = credentials
+        self.token = token
+        self._lock = threading.Lock()
+
+    def get(self):
+        """The current token, refreshing the credentials first if needed ('' for none)."""
+        if self.credentials is None:
+            return self.token or ''
+        with self._lock:
+            if not self.credentials.valid:
+                import google.auth.transport.requests
+                self.credentials.refresh(google.auth.transport.requests.Request())
+            return self.credentials.token
+
+    def invalidate(self):
+        """Force a refresh on the next get(), e.g. after the endpoint answered 401."""
+        if self.credentials is not None:
+            with self._lock:
+                self.credentials.token = None
+
+    def headers(self, headers=None):
+        """headers plus the Authorization header, if there is a token."""
+        headers = dict(headers or {})
+        token = self.get()
+        if token:
+            headers['Authorization'] = f"Bearer {token}"
+        return headers
+
+def default_access_token():
+    """AccessToken for Vertex AI from ENDPOINT_ACCESS_TOKEN or the default Google credentials."""
+    token = os.environ.get(TOKEN_ENV)
+    if token:
+        return AccessToken(token=token)
+    import google.auth
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+    return AccessToken(credentials)
+
+def access_token_for(url, access_token=None):
+    """
+    AccessToken for requests to url.
+
+    access_token may be an AccessToken, a fixed token string ('' for none) or None for the
+    default credentials on https URLs and no token otherwise.
+    """
+    if isinstance(access_token, AccessToken):
+        return access_token
+    if access_token is None and urlsplit(url).scheme == 'https':
+        return default_access_token()
+    return AccessToken(token=access_token)
+
+class ModelClient:
+    """
+    Client for a deployed model endpoint.
+
+    If the URL ends in :predict, a whole micro-batch is sent as one {"instances": [...]} call.
+    Otherwise (for example :generateContent) the requests of a batch are sent concurrently,
+    one per call, over the same connection pool.
+    """
+
+    def __init__(self, endpoint_url, pool_size=8, timeout=60, access_token=None):
+        self.endpoint_url = endpoint_url
+        self.batched = endpoint_url.endswith(':predict')
+        parts = urlsplit(endpoint_url)
+        self.path = parts.path + (f"?{parts.query}" if parts.query else '')
+        self.pool = ConnectionPool(endpoint_url, pool_size, timeout)
+        self._executor = ThreadPoolExecutor(pool_size)
+        self.access_token = access_token_for(endpoint_url, access_token)
+
+    def _post(self, body):
+        body = json.dumps(body).encode('utf-8')
+        headers = self.access_token.headers({'Content-Type': 'application/json'})
+        status, data = self.pool.request('POST', self.path, body, headers)
+        if status == 401:
+            # The token expired or was revoked early: refresh it and retry once
+            self.access_token.invalidate()
+            headers = self.access_token.headers({'Content-Type': 'application/json'})
+            status, data = self.pool.request('POST', self.path, body, headers)
+        if status != 200:
+            raise ModelError(f"Endpoint returned HTTP {status}: {data[:200].decode('utf-8', 'replace')}", status)
+        return json.loads(data)
+
+    def predict(self, requests):
+        """Return one generateContent response (or exception) per request."""
+        if self.batched:
+            predictions = self._post({'instances': requests})['predictions']
+            if len(predictions) != len(requests):
+                raise ModelError(f"Expected {len(requests)} predictions, got {len(predictions)}")
+            return predictions
+        futures = [self._executor.submit(self._post, request) for request in requests]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+def response_text(response):
+    """Concatenated text of the first candidate of a generateContent response."""
+    try:
+        parts = response['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        return ''
+    return ''.join(part.get('text', '') for part in parts)
+
+def parse_label(text):
+    """Return the first class name in the model's answer, or None."""
+    words = [word.strip('.,:;!*"\'') for word in text.lower().split()]
+    for word in words:
+        if word in LABELS:
+            return word
+    return None
+
+class MicroBatcher:
+    """
+    Groups submitted items into batches of up to max_batch_size, waiting at most max_wait
+    seconds for a batch to fill, and runs at most max_concurrency batches at once.
+
+    handle_batch(items) must return one result per item; results that are exceptions are
+    raised from the corresponding future.
+    """
+
+    def __init__(self, handle_batch, max_batch_size=8, max_wait=0.01, max_concurrency=4, max_pending=256):
+        self.handle_batch = handle_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue(max_pending)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_concurrency)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.batched_items = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queue an item and return a Future for its result."""
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future))
+        except queue.Full:
+            raise ServiceUnavailable("Too many pending requests")
+        return future
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            # Wait for a free slot; requests arriving meanwhile go into the next batch
+            self._slots.acquire()
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        try:
+            with self._lock:
+                self.batches += 1
+                self.batched_items += len(batch)
+            try:
+                results = self.handle_batch([item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+class LatencyTracker:
+    """Keeps the latest latency samples per name and reports count, mean, p50 and p99."""
+
+    def __init__(self, window=10000):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            samples = {name: np.array(values) for name, values in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for name, values in samples.items():
+            result[name] = {
+                'count': counts[name],
+                'mean_ms': float(values.mean() * 1000),
+                'p50_ms': float(np.percentile(values, 50) * 1000),
+                'p99_ms': float(np.percentile(values, 99) * 1000),
+            }
+        return result
+
+def decode_image(data, flags):
+    """Decode a base64-encoded image, raising ValueError if it is not a valid image."""
+    try:
+        buffer = np.frombuffer(base64.b64decode(data, validate=True), dtype=np.uint8)
+    except (ValueError, TypeError):
+        raise ValueError("Image is not valid base64")
+    image = cv2.imdecode(buffer, flags) if buffer.size else None
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image
+
+def build_model_request(image, mask, metadata, crop=False, max_side=DEFAULT_MAX_SIDE, ellipse_params=None):
+    """
+    Render the overlay and prompt for one frame in memory.
+
+    ellipse_params may be passed if the ellipse has already been fitted to mask.
+
+    Returns (request, prompt_metadata, png): the generateContent request body with the overlay
+    inlined as PNG, the metadata the prompt was built from and the PNG bytes.
+    """
+    ellipse_params = ellipse_params or fit_ellipse(mask)
+    overlay = create_ellipse_overlay(image, ellipse_params)
+    ellipse = {column: ellipse_params[column[len('ellipse_'):]] for column in ELLIPSE_COLUMNS}
+    if crop:
+        # Same framing as the cropped training data
+        overlay, ellipse, _ = crop_to_ellipse(overlay, ellipse, max_side=max_side)
+
+    prompt_metadata = dict(ellipse)
+    features = {field: metadata[field] for field in FEATURE_COLUMNS if field in metadata}
+    if len(features) == len(FEATURE_COLUMNS):
+        prompt_metadata.update(features)
+
+    ok, png = cv2.imencode('.png', overlay)
+    if not ok:
+        raise ValueError("Could not encode overlay")
+    png = png.tobytes()
+    request = {
+        'contents': [{
+            'role': 'user',
+            'parts': [
+                {'inlineData': {'mimeType': 'image/png', 'data': base64.b64encode(png).decode('ascii')}},
+                {'text': create_dynamic_prompt(prompt_metadata)}
+            ]
+        }]
+    }
+    return request, prompt_metadata, png
+
+class InferenceService:
+    """
+    Preprocessing, micro-batching and metrics behind the HTTP handler.
+
+    If a TriageCascade is given, frames it is confident about are answered from their metadata
+    without rendering or calling the model. If a PredictionCache is given, requests it already
+    holds for model_id are answered without calling the model. If a ContextCache is given,
+    requests reference its cached prompt prefix; batches the endpoint rejects are resent with
+    the full prompts and caching is switched off.
+    """
+
+    def __init__(self, client, max_batch_size=8, max_wait_ms=10, max_concurrency=4, max_pending=256,
+                 timeout=60, crop=False, max_side=DEFAULT_MAX_SIDE, cache=None, model_id=None, triage=None, context_cache=None):
+        self.client = client
+        self.cache = cache
+        self.triage = triage
+        self.context_cache = context_cache
+        self.model_id = model_id or client.endpoint_url
+        self.timeout = timeout
+        self.crop = crop
+        self.max_side = max_side
+        self.latency = LatencyTracker()
+        self.errors = 0
+        self.batcher = MicroBatcher(self._call_model, max_batch_size, max_wait_ms / 1000, max_concurrency,
+                                    max_pending)
+
+    def _call_model(self, items):
+        """items are (full request, compact request or None) pairs."""
+        start = time.perf_counter()
+        try:
+            results = self.client.predict([compact or request for request, compact in items])
+        except Exception as e:
+            if not any(compact for _, compact in items) or not rejected_request(e):
+                raise
+            results = [e] * len(items)
+        rejected = [i for i, (_, compact) in enumerate(items) if compact and rejected_request(results[i])]
+        if rejected:
+            self.context_cache.disable(f"Endpoint rejected cached content: {results[rejected[0]]}")
+            retried = self.client.predict([items[i][0] for i in rejected])
+            for i, result in zip(rejected, retried):
+                results[i] = result
+        self.latency.record('model_call', time.perf_counter() - start)
+        return results
+
+    def predict(self, payload):
+        """Handle one /predict body and return the response dict."""
+        start = time.perf_counter()
+        if not isinstance(payload, dict) or 'image' not in payload or 'mask' not in payload:
+            raise ValueError("Body must contain 'image' and 'mask'")
+        mask = decode_image(payload['mask'], cv2.IMREAD_GRAYSCALE)
+        metadata = payload.get('metadata') or {}
+        ellipse_params = fit_ellipse(mask)
+        ellipse = {column: ellipse_params[column[len('ellipse_'):]] for column in ELLIPSE_COLUMNS}
+
+        if self.triage is not None:
+            # The triage model is trained on ellipses in the original frame, before any crop
+            result = self.triage.classify(dict(metadata, **ellipse))
+            if result is not None:
+                finished = time.perf_counter()
+                self.latency.record('triage', finished - start)
+                self.latency.record('total', finished - start)
+                return {'label': result[0], 'text': response_text(triage_response(result[0])),
+                        'ellipse': ellipse, 'source': 'triage', 'latency_ms': (finished - start) * 1000}
+
+        image = decode_image(payload['image'], cv2.IMREAD_COLOR)
+        request, prompt_metadata, png = build_model_request(image, mask, metadata, self.crop, self.max_side,
+                                                            ellipse_params)
+        queued = time.perf_counter()
+        self.latency.record('preprocess', queued - start)
+
+        compact = self.context_cache.compact(request, prompt_metadata) if self.context_cache is not None else None
+        prompt = effective_prompt(compact or request)
+        key = request_hash(png, prompt) if self.cache is not None else None
+        response = self.cache.get(self.model_id, key) if key else None
+        source = 'cache' if response is not None else 'model'
+        if response is None:
+            response = self.batcher.submit((request, compact)).result(timeout=self.timeout)
+        text = response_text(response)
+        finished = time.perf_counter()
+        if source == 'cache':
+            self.latency.record('cache_hit', finished - queued)
+        else:
+            self.latency.record('queue_and_model', finished - queued)
+            if key:
+                self.cache.put(self.model_id, key, response, estimate_input_tokens(png, prompt), finished - queued)
+        self.latency.record('total', finished - start)
+        return {
+            'label': parse_label(text),
+            'text': text,
+            'ellipse': {column: prompt_metadata[column] for column in ELLIPSE_COLUMNS},
+            'source': source,
+            'latency_ms': (finished - start) * 1000,
+        }
+
+    def metrics(self):
+        batches = self.batcher.batches
+        metrics = {
+            'latency': self.latency.summary(),
+            'errors': self.errors,
+            'batches': batches,
+            'mean_batch_size': self.batcher.batched_items / batches if batches else 0.0,
+        }
+        if self.cache is not None:
+            metrics['prediction_cache'] = self.cache.savings()
+        if self.triage is not None:
+            metrics['triage'] = self.triage.stats()
+        if self.context_cache is not None:
+            metrics['context_cache'] = self.context_cache.stats()
+        return metrics
+
+    def close(self):
+        self.batcher.close()
+        self.client.close()
+        if self.cache is not None:
+            self.cache.close()
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send_json(200, self.server.service.metrics())
+        elif self.path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        service = self.server.service
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._send_json(200, service.predict(payload))
+            return
+        except (ValueError, KeyError) as e:
+            status, message = 400, str(e)
+        except ServiceUnavailable as e:
+            status, message = 503, str(e)
+        except FutureTimeoutError:
+            status, message = 504, "Model endpoint timed out"
+        except Exception as e:
+            status, message = 502, f"{type(e).__name__}: {e}"
+        service.errors += 1
+        self._send_json(status, {'error': message})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(service, host='127.0.0.1', port=8080):
+    """Start the HTTP server on a background thread and return it."""
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def synthetic_payloads(count, width=320, height=240):
+    """Request bodies built from synthetic frames, for load testing."""
+    from generate_synthetic_dataset import CATEGORIES, synthesize_image, synthesize_labels, synthesize_metadata
+    labels = synthesize_labels(count)
+    features = synthesize_metadata(labels).rename(columns={'baseline value': 'baseline_value'})
+    payloads = []
+    for i, label in enumerate(labels):
+        image, mask = synthesize_image(i, CATEGORIES[int(label) - 1], width, height)
+        row = features.iloc[i]
+        payloads.append({
+            'image': base64.b64encode(cv2.imencode('.png', image)[1].tobytes()).decode('ascii'),
+            'mask': base64.b64encode(cv2.imencode('.png', mask)[1].tobytes()).decode('ascii'),
+            'metadata': {field: float(row[field]) for field in FEATURE_COLUMNS},
+        })
+    return payloads
+
+def load_test(server_url, payloads, total_requests=200, concurrency=16):
+    """Send total_requests to server_url from concurrency clients; return client-side latency stats."""
+    pool = ConnectionPool(server_url, concurrency)
+    tracker = LatencyTracker()
+    bodies = [json.dumps(payload).encode('utf-8') for payload in payloads]
+    failures = []
+
+    def send(i):
+        start = time.perf_counter()
+        status, data = pool.request('POST', '/predict', bodies[i % len(bodies)],
+                                    {'Content-Type': 'application/json'})
+        tracker.record('client', time.perf_counter() - start)
+        if status != 200:
+            failures.append(data)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, range(total_requests)))
+    elapsed = time.perf_counter() - start
+    pool.close()
+    stats = tracker.summary()['client']
+    stats.update({'requests': total_requests, 'failures': len(failures), 'requests_per_sec': total_requests / elapsed})
+    return stats
+
+def self_test(args):
+    """Run the service against the local stub endpoint and print the latency metrics."""
+    from stub_endpoint import MIN_CACHED_TOKENS, start_stub_endpoint
+    min_cached_tokens = MIN_CACHED_TOKENS if args.stub_min_cached_tokens is None else args.stub_min_cached_tokens
+    stub = start_stub_endpoint(latency_ms=args.stub_latency_ms, context_cache=not args.stub_without_context_cache,
+                               min_cached_tokens=min_cached_tokens)
+    endpoint_url = f"{stub.url}/v1/endpoints/stub:predict"
+    client = ModelClient(endpoint_url, pool_size=args.pool_size, access_token='')
+    context_cache = None
+    if args.context_cache:
+        context_cache = ContextCache(cached_contents_url(endpoint_url), args.cache_model or 'stub', access_token='')
+    service = InferenceService(client, args.max_batch_size, args.max_wait_ms, args.max_concurrency,
+                               crop=args.crop, max_side=args.max_side, context_cache=context_cache)
+    server = start_server(service, port=0)
+    report = StageReport('inference_server')
+
+    print(f"Self-test: service {server.url} -> stub endpoint {stub.url}")
+    with report.phase('load_test', total=args.requests) as phase:
+        client_stats = load_test(server.url, synthetic_payloads(32), args.requests, args.concurrency)
+        phase.tick(args.requests - client_stats['failures'])
+    metrics = service.metrics()
+
+    print(f"\nRequests: {client_stats['requests']} ({client_stats['failures']} failed), "
+          f"{client_stats['requests_per_sec']:.1f} req/s at concurrency {args.concurrency}")
+    print(f"Client latency: p50 {client_stats['p50_ms']:.1f} ms, p99 {client_stats['p99_ms']:.1f} ms")
+    for name, stats in metrics['latency'].items():
+        print(f"  {name}: p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms")
+    print(f"Model calls: {stub.calls} for {stub.instances} instances "
+          f"(mean batch {metrics['mean_batch_size']:.1f}, max {stub.max_batch_size})")
+    if stub.instances:
+        print(f"Request payload: {stub.request_bytes / stub.instances / 1024:.1f} KiB per instance, "
+              f"{stub.prompt_bytes / stub.instances:.0f} prompt text bytes per instance; "
+              f"{stub.cached_instances} of {stub.instances} instances used cached content")
+    ok = client_stats['failures'] == 0
+    if context_cache is not None and context_cache.active and not stub.cached_instances:
+        print("Error: context caching was requested and supported but no request used it")
+        ok = False
+
+    report.set('client', client_stats)
+    report.set('service', metrics)
+    report.set('endpoint_payload', {'request_bytes': stub.request_bytes, 'prompt_bytes': stub.prompt_bytes,
+                                    'instances': stub.instances, 'cached_instances': stub.cached_instances})
+    report.write()
+    server.shutdown()
+    service.close()
+    stub.shutdown()
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--endpoint-url', help="Model endpoint URL (:predict for batched calls, or :generateContent)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--max-concurrency', type=int, default=4, help="Model calls in flight at once")
+    parser.add_argument('--pool-size', type=int, default=8, help="Persistent connections to the endpoint")
+    parser.add_argument('--crop', action='store_true', help="Crop to the ellipse like crop_overlays.py")
+    parser.add_argument('--max-side', type=int, default=crop_max_side(),
+                        help="Maximum side of the crop; should match the one the model was tuned on")
+    parser.add_argument('--model-id', help="Model id for the prediction cache (default: the endpoint URL)")
+    parser.add_argument('--no-cache', action='store_true', help="Do not use the prediction cache")
+    parser.add_argument('--triage', action='store_true',
+                        help="Answer confident cases with the local triage model instead of the endpoint")
+    parser.add_argument('--triage-model', default=TRIAGE_MODEL_PATH, help="Triage model from triage_model.py")
+    parser.add_argument('--triage-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Confidence at which the triage model answers instead of the endpoint")
+    parser.add_argument('--context-cache', action='store_true',
+                        help="Register the static prompt prefix as cached content and send only the per-image part")
+    parser.add_argument('--cache-model',
+                        help="Model resource the cached content is created for (e.g. the tuned model behind the "
+                             "endpoint; it must have passed the agreement check in context_cache.py)")
+    parser.add_argument('--self-test', action='store_true', help="Load test against a local stub endpoint")
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--stub-latency-ms', type=float, default=50)
+    parser.add_argument('--stub-without-context-cache', action='store_true',
+                        help="Self-test: the stub rejects cached content, to exercise the fallback")
+    parser.add_argument('--stub-min-cached-tokens', type=int,
+                        help="Self-test: smallest cached content the stub accepts, in estimated tokens "
+                             "(default: the Vertex AI minimum)")
+    args = parser.parse_args()
+
+    if args.self_test:
+        raise SystemExit(0 if self_test(args) else 1)
+    if not args.endpoint_url:
+        parser.error("--endpoint-url is required unless --self-test is given")
+
+    client = ModelClient(args.endpoint_url, pool_size=args.pool_size)
+    cache = None if args.no_cache else open_prediction_cache()
+    triage = None
+    if args.triage:
+        triage = open_triage_cascade(args.triage_model, args.triage_threshold)
+        if triage is None:
+            parser.error(f"--triage needs a trained triage model at {args.triage_model}")
+    context_cache = None
+    if args.context_cache:
+        if not args.cache_model:
+            parser.error("--cache-model is required with --context-cache")
+        context_cache = ContextCache(cached_contents_url(args.endpoint_url), args.cache_model)
+    service = InferenceService(client, args.max_batch_size, args.max_wait_ms, args.max_concurrency, crop=args.crop,
+                               max_side=args.max_side, cache=cache, model_id=args.model_id, triage=triage,
+                               context_cache=context_cache)
+    server = start_server(service, args.host, args.port)
+    print(f"Serving on {server.url} (POST /predict, GET /metrics)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print(json.dumps(service.metrics(), indent=2))
+        server.shutdown()
+        service.close()
+
+if __name__ == "__main__":
+    main()
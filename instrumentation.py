@@ -0,0 +1,223 @@
+"""
+Shared instrumentation for the pipeline stages: per-phase wall/CPU time, throughput,
+bytes read and written, peak memory, cache hit ratios and a throttled progress display.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+REPORT_DIR = "reports"
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def file_size(path):
+    """Return the size of a file in bytes, or 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def format_bytes(num_bytes):
+    """Format a byte count for humans."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+class ProgressDisplay:
+    """
+    Single-line progress display that redraws at most once per interval.
+
+    Replaces per-item print statements, which become measurable overhead at scale.
+    """
+
+    def __init__(self, label, total=None, interval=1.0, stream=None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.done = 0
+        self.start = time.perf_counter()
+        self._last_draw = 0.0
+        # Count shown by the last draw, so close() does not repeat an up-to-date line
+        self._drawn = None
+        self._interactive = hasattr(self.stream, "isatty") and self.stream.isatty()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last_draw >= self.interval:
+            self._last_draw = now
+            self._draw(now)
+
+    def close(self):
+        if self._drawn != self.done:
+            self._draw(time.perf_counter())
+        if self._interactive:
+            self.stream.write("\n")
+        self.stream.flush()
+
+    def _draw(self, now):
+        self._drawn = self.done
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.done / elapsed
+        if self.total:
+            pct = 100.0 * self.done / self.total
+            remaining = (self.total - self.done) / rate if rate > 0 else float("inf")
+            line = f"{self.label}: {self.done}/{self.total} ({pct:.1f}%) {rate:.1f} img/s, ETA {remaining:.0f}s"
+        else:
+            line = f"{self.label}: {self.done} {rate:.1f} img/s"
+        if self._interactive:
+            self.stream.write("\r" + line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+class PhaseStats:
+    """Counters for one phase of a stage."""
+
+    def __init__(self, name, total=None, progress_interval=1.0):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.progress = ProgressDisplay(name, total=total, interval=progress_interval) if total != 0 else None
+
+    def tick(self, n=1, bytes_read=0, bytes_written=0):
+        """Record n completed items and the bytes they read and wrote."""
+        self.items += n
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        if self.progress is not None:
+            self.progress.update(n)
+
+    def error(self, n=1):
+        self.errors += n
+
+    def add_bytes(self, bytes_read=0, bytes_written=0):
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "items": self.items,
+            "errors": self.errors,
+            "wall_seconds": round(self.wall_seconds, 4),
+            "cpu_seconds": round(self.cpu_seconds, 4),
+            "items_per_second": round(self.items / self.wall_seconds, 2) if self.wall_seconds > 0 else None,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+
+class StageReport:
+    """
+    Collects metrics for one pipeline stage and writes them as a JSON run report.
+
+    Usage:
+        report = StageReport('generate_overlays')
+        with report.phase('overlay', total=len(files)) as phase:
+            for f in files:
+                ...
+                phase.tick(bytes_read=..., bytes_written=...)
+        report.write()
+    """
+
+    def __init__(self, stage, report_dir=REPORT_DIR, progress_interval=1.0):
+        self.stage = stage
+        self.report_dir = report_dir
+        self.progress_interval = progress_interval
+        self.phases = []
+        self.caches = {}
+        self.extra = {}
+        self.started_at = datetime.now(timezone.utc)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextmanager
+    def phase(self, name, total=None):
+        """Time a phase; yields PhaseStats for recording items and bytes."""
+        stats = PhaseStats(name, total=total, progress_interval=self.progress_interval)
+        self.phases.append(stats)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.wall_seconds = time.perf_counter() - wall_start
+            stats.cpu_seconds = time.process_time() - cpu_start
+            if stats.progress is not None and stats.items:
+                stats.progress.close()
+
+    def record_cache(self, name, hits, misses):
+        """Record hit/miss counts for a named cache."""
+        cache = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+        cache["hits"] += hits
+        cache["misses"] += misses
+
+    def set(self, key, value):
+        """Attach an arbitrary JSON-serialisable value to the report."""
+        self.extra[key] = value
+
+    def to_dict(self):
+        wall = time.perf_counter() - self._wall_start
+        items = sum(p.items for p in self.phases)
+        caches = {}
+        for name, counts in self.caches.items():
+            lookups = counts["hits"] + counts["misses"]
+            caches[name] = dict(counts, hit_ratio=round(counts["hits"] / lookups, 4) if lookups else None)
+        return {
+            "stage": self.stage,
+            "started_at": self.started_at.isoformat(),
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(time.process_time() - self._cpu_start, 4),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "items": items,
+            "bytes_read": sum(p.bytes_read for p in self.phases),
+            "bytes_written": sum(p.bytes_written for p in self.phases),
+            "phases": [p.to_dict() for p in self.phases],
+            "caches": caches,
+            "extra": self.extra,
+        }
+
+    def write(self, path=None):
+        """Write the JSON report and print a one-line summary. Returns the report path."""
+        data = self.to_dict()
+        if path is None:
+            timestamp = self.started_at.strftime("%Y%m%dT%H%M%S")
+            path = Path(self.report_dir) / f"{self.stage}_{timestamp}.json"
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+        peak = data["peak_rss_bytes"]
+        print(f"[{self.stage}] {data['items']} items in {data['wall_seconds']:.2f}s "
+              f"(cpu {data['cpu_seconds']:.2f}s), read {format_bytes(data['bytes_read'])}, "
+              f"wrote {format_bytes(data['bytes_written'])}"
+              + (f", peak RSS {format_bytes(peak)}" if peak else ""))
+        print(f"[{self.stage}] Run report written to {path}")
+        return path
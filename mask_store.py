@@ -0,0 +1,234 @@
+"""
+Compact store of the binary annotation masks.
+
+The _Annotation.png masks are only used to fit one ellipse, yet each is a full-resolution
+PNG that is copied and decoded. match_metadata.py instead run-length encodes every mask
+(thresholded at 127, as the ellipse fit does) into one blob file with a JSON index keyed
+by image file name. A mask is rebuilt in memory from its runs in well under a millisecond,
+so refitting every ellipse needs no PNG decoding.
+
+Each blob is the zlib-compressed little-endian uint32 run lengths of the row-major mask,
+alternating background and foreground and starting with background.
+
+    python mask_store.py matched_dataset       # build a store from *_Annotation.png files
+    python mask_store.py matched_dataset --refit
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from instrumentation import StageReport, file_size, format_bytes
+
+STORE_NAME = 'annotation_masks'
+ANNOTATION_SUFFIX = '_Annotation.png'
+
+def store_paths(location):
+    """(blob file, index file) of the store in directory location."""
+    location = Path(location)
+    return location / f"{STORE_NAME}.bin", location / f"{STORE_NAME}.json"
+
+def encode_mask(mask):
+    """Run-length encode a grayscale or boolean mask; pixels above 127 are foreground."""
+    mask = np.asarray(mask)
+    flat = (mask if mask.dtype == bool else mask > 127).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        # Runs always start with background
+        counts = np.concatenate(([0], counts))
+    return zlib.compress(counts.astype('<u4').tobytes(), 9)
+
+def decode_mask(blob, shape):
+    """Rebuild the uint8 mask (0 or 255) of the given (height, width) from encode_mask output."""
+    counts = np.frombuffer(zlib.decompress(blob), dtype='<u4')
+    values = np.zeros(len(counts), dtype=np.uint8)
+    values[1::2] = 255
+    return np.repeat(values, counts).reshape(shape)
+
+class MaskStore:
+    """
+    Run-length encoded masks in one blob file with a JSON index.
+
+    mode is 'r' (read only), 'a' (add to an existing store) or 'w' (start an empty one).
+    Writes go to the end of the blob file; the index is written by flush() and close().
+    Pickling a store (e.g. to send it to a worker process) reopens it read-only, once per
+    process for each version of the index.
+    """
+
+    def __init__(self, location, mode='r'):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError(f"Invalid mode {mode!r}")
+        self.location = Path(location)
+        self.mode = mode
+        self.blob_path, self.index_path = store_paths(location)
+        self._entries = {}
+        self._lock = threading.Lock()
+        if mode == 'w':
+            self.location.mkdir(parents=True, exist_ok=True)
+            open(self.blob_path, 'wb').close()
+        elif self.index_path.exists():
+            with open(self.index_path) as f:
+                self._entries = json.load(f)['entries']
+        elif mode == 'r':
+            raise FileNotFoundError(f"No annotation mask store in {self.location}")
+        self._file = open(self.blob_path, 'rb' if mode == 'r' else 'a+b')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __reduce__(self):
+        self.flush()
+        return (_open_readonly, (str(self.location), _index_stamp(self.index_path)))
+
+    def keys(self):
+        return list(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(entry['nbytes'] for entry in self._entries.values())
+
+    def put(self, key, mask):
+        """Encode and add a mask under key (replacing any earlier one). Returns the encoded size."""
+        if self.mode == 'r':
+            raise ValueError("Mask store is opened read-only")
+        blob = encode_mask(mask)
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(blob)
+            self._entries[key] = {'offset': offset, 'nbytes': len(blob), 'shape': list(np.shape(mask)[:2])}
+        return len(blob)
+
+    def get(self, key):
+        """The uint8 mask (0 or 255) stored under key, or None if there is none."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        with self._lock:
+            self._file.seek(entry['offset'])
+            blob = self._file.read(entry['nbytes'])
+        return decode_mask(blob, tuple(entry['shape']))
+
+    def flush(self):
+        """Write the index atomically."""
+        if self.mode == 'r':
+            return
+        with self._lock:
+            self._file.flush()
+            tmp_path = self.index_path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': self._entries}, f)
+            os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+# Read-only stores opened in this process by unpickling, keyed by directory and index stamp
+_readonly_stores = {}
+
+def _index_stamp(index_path):
+    try:
+        stat = os.stat(index_path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def _open_readonly(location, stamp):
+    store = _readonly_stores.get(location)
+    if store is None or store[0] != stamp:
+        store = _readonly_stores[location] = (stamp, MaskStore(location))
+    return store[1]
+
+def open_mask_store(location):
+    """Open the store in location read-only, or return None if there is none."""
+    if not store_paths(location)[1].exists():
+        return None
+    return MaskStore(location)
+
+def annotation_key(image_filename):
+    """Store key of the mask of an image: the image file name."""
+    return Path(image_filename).name
+
+def build_store(source_dir, location=None, report=None):
+    """
+    Encode every <category>/*_Annotation.png under source_dir into a store in location
+    (default source_dir). Returns (number of masks, PNG bytes, store bytes).
+    """
+    location = location or source_dir
+    report = report or StageReport('mask_store')
+    paths = sorted(Path(source_dir).glob(f"*/*{ANNOTATION_SUFFIX}"))
+    png_bytes = 0
+    with MaskStore(location, 'w') as store, report.phase('encode', total=len(paths)) as phase:
+        for path in paths:
+            mask = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                print(f"Could not read image: {path}")
+                phase.error()
+                continue
+            encoded = store.put(annotation_key(path.name.replace(ANNOTATION_SUFFIX, '.png')), mask)
+            png_bytes += file_size(path)
+            phase.tick(bytes_read=file_size(path), bytes_written=encoded)
+        count, store_bytes = len(store), store.nbytes
+    return count, png_bytes, store_bytes
+
+def refit_all(location, report=None):
+    """Refit the ellipse of every stored mask in memory. Returns {key: ellipse params or None}."""
+    # generate_overlays imports this module
+    from generate_overlays import fit_ellipse
+
+    report = report or StageReport('mask_store')
+    ellipses = {}
+    with MaskStore(location) as store, report.phase('refit', total=len(store)) as phase:
+        for key in store.keys():
+            try:
+                ellipses[key] = fit_ellipse(store.get(key))
+            except ValueError:
+                ellipses[key] = None
+                phase.error()
+            phase.tick()
+    return ellipses
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help="Directory with <category>/*_Annotation.png masks (e.g. matched_dataset)")
+    parser.add_argument('--refit', action='store_true', help="Refit every ellipse from an existing store")
+    args = parser.parse_args()
+
+    report = StageReport('mask_store')
+    if args.refit:
+        start = time.perf_counter()
+        ellipses = refit_all(args.directory, report)
+        seconds = time.perf_counter() - start
+        print(f"Refitted {len(ellipses)} ellipses in {seconds:.2f}s "
+              f"({sum(e is None for e in ellipses.values())} masks without a usable contour)")
+    else:
+        count, png_bytes, store_bytes = build_store(args.directory, report=report)
+        print(f"Encoded {count} masks: {format_bytes(png_bytes)} of PNGs -> {format_bytes(store_bytes)} "
+              f"({png_bytes / max(store_bytes, 1):.1f}x smaller) in {store_paths(args.directory)[0]}")
+    report.write()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Typed columnar store for the per-image metadata table (matched_data).
+
+Every stage reads and writes the table through this module. It is stored as Parquet with
+explicit dtypes so stages can load only the columns they use, and a CSV copy is exported
+next to it for humans.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stage_journal import atomic_path
+
+METADATA_NAME = 'matched_data'
+
+ELLIPSE_COLUMNS = ['ellipse_center_x', 'ellipse_center_y', 'ellipse_axis_x', 'ellipse_axis_y', 'ellipse_angle']
+
+# The 21 CTG features from FetusDataset.csv, in prompt order
+FEATURE_COLUMNS = [
+    'baseline_value', 'accelerations', 'fetal_movement', 'uterine_contractions',
+    'light_decelerations', 'severe_decelerations', 'prolongued_decelerations',
+    'abnormal_short_term_variability', 'mean_value_of_short_term_variability',
+    'percentage_of_time_with_abnormal_long_term_variability',
+    'mean_value_of_long_term_variability', 'histogram_width', 'histogram_min',
+    'histogram_max', 'histogram_number_of_peaks', 'histogram_number_of_zeroes',
+    'histogram_mode', 'histogram_mean', 'histogram_median', 'histogram_variance',
+    'histogram_tendency'
+]
+
+# Columns needed to render a prompt for one image
+PROMPT_COLUMNS = ['image_filename'] + ELLIPSE_COLUMNS + FEATURE_COLUMNS
+
+# Explicit dtypes for the known columns; any other column keeps its inferred dtype
+DTYPES = {
+    'image_number': 'int32',
+    'image_filename': 'string',
+    'has_annotation': 'bool',
+    'category': 'category',
+    'original_category': 'category',
+    'corrected_category': 'category',
+    'fetal_health': 'float64',
+    'fold': 'int8',
+}
+DTYPES.update({column: 'float64' for column in ELLIPSE_COLUMNS + FEATURE_COLUMNS})
+
+def parquet_path(location):
+    """Resolve a directory, .csv or .parquet path to the Parquet file of the store."""
+    location = Path(location)
+    if location.suffix in ('.csv', '.parquet'):
+        return location.with_suffix('.parquet')
+    return location / f"{METADATA_NAME}.parquet"
+
+def csv_path(location):
+    """Resolve a directory, .csv or .parquet path to the CSV export of the store."""
+    return parquet_path(location).with_suffix('.csv')
+
+def apply_dtypes(df):
+    """Cast the known columns of df to their declared dtypes."""
+    dtypes = {column: dtype for column, dtype in DTYPES.items() if column in df.columns}
+    return df.astype(dtypes)
+
+def write_metadata(df, location, export_csv=True):
+    """
+    Write the metadata table to location (a directory or matched_data.{csv,parquet} path).
+
+    Returns the Parquet path.
+    """
+    path = parquet_path(location)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = apply_dtypes(df)
+    # Written to temporary files and renamed, so an interrupted stage never leaves a partial table
+    with atomic_path(path) as tmp_path:
+        df.to_parquet(tmp_path, index=False)
+    if export_csv:
+        with atomic_path(csv_path(location)) as tmp_path:
+            df.to_csv(tmp_path, index=False)
+    return path
+
+def read_metadata(location, columns=None):
+    """
+    Read the metadata table, loading only the requested columns.
+
+    Falls back to the CSV export for trees written before the Parquet store existed.
+    Requested columns that do not exist in the table are ignored.
+    """
+    path = parquet_path(location)
+    if path.exists():
+        if columns is not None:
+            available = _parquet_columns(path)
+            columns = [c for c in columns if c in available]
+        return pd.read_parquet(path, columns=columns)
+
+    path = csv_path(location)
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in columns if c in header] if columns is not None else None
+    loaded = usecols if usecols is not None else list(header)
+    dtypes = {column: dtype for column, dtype in DTYPES.items() if column in loaded}
+    return pd.read_csv(path, usecols=usecols, dtype=dtypes)
+
+def _parquet_columns(path):
+    import pyarrow.parquet as pq
+    return set(pq.read_schema(path).names)
+
+def metadata_exists(location):
+    return parquet_path(location).exists() or csv_path(location).exists()
+
+def _to_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+class MetadataIndex:
+    """
+    Keyed row lookup over a metadata table without materialising a dict per row.
+
+    Rows are kept as column arrays; get() builds a plain dict for one row on demand.
+    """
+
+    def __init__(self, df, key='image_filename'):
+        self.columns = list(df.columns)
+        self._arrays = [df[column].to_numpy() for column in self.columns]
+        self._positions = {k: i for i, k in enumerate(df[key].tolist())}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get(self, key, default=None):
+        position = self._positions.get(key)
+        if position is None:
+            return default
+        return {column: _to_python(array[position]) for column, array in zip(self.columns, self._arrays)}
+
+def iter_records(df):
+    """Yield each row of df as a dict of Python scalars."""
+    columns = list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        yield dict(zip(columns, row))
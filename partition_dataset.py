@@ -8,10 +8,86 @@ Partition the dataset into train, validation, and test sets.
 import os
 import shutil
 import random
+from functools import partial
 from pathlib import Path
 import pandas as pd
 
-def partition_dataset(source_dir, output_base, train_ratio=0.7, val_ratio=0.15, test_ratio=0.15, seed=42):
+from instrumentation import StageReport, file_size
+from metadata_store import read_metadata, write_metadata
+from perceptual_hash import DEDUPE_RADIUS, group_near_duplicates, hash_image, summarize_groups
+from image_cache import open_image_cache
+from executor import Executor, open_executor
+
+# Number of cross-validation folds; if set, main() writes the fold manifest instead of copying a split
+FOLDS_ENV = 'PIPELINE_FOLDS'
+FOLD_MANIFEST = os.path.join('partitioned_dataset', 'fold_manifest.parquet')
+
+def fold_count():
+    """Number of folds requested through PIPELINE_FOLDS, or None for the single split."""
+    return int(os.environ.get(FOLDS_ENV) or 0) or None
+
+def find_duplicate_groups(source_dir, radius, image_cache=None, report=None, executor=None):
+    """
+    Hash every image under source_dir/<category>/ on executor and group near-duplicates.
+
+    Returns a dict mapping 'category/filename' to a group id.
+    """
+    report = report or StageReport('partition_dataset')
+    executor = executor or Executor()
+    paths = {}
+    for category in ['normal', 'benign', 'malignant']:
+        category_path = os.path.join(source_dir, category)
+        if os.path.exists(category_path):
+            for f in sorted(os.listdir(category_path)):
+                if f.endswith('.png'):
+                    paths[f"{category}/{f}"] = os.path.join(category_path, f)
+
+    hashes = {}
+    with report.phase('hash', total=len(paths)) as phase:
+        results = executor.imap(partial(hash_image, image_cache=image_cache), list(paths.values()))
+        for key, result in zip(paths, results):
+            if not result.ok or result.value is None:
+                phase.error()
+                continue
+            hashes[key] = result.value
+            phase.tick(bytes_read=file_size(result.item))
+
+    with report.phase('group', total=0):
+        groups = group_near_duplicates(hashes, radius)
+    summary = summarize_groups(groups)
+    report.set('near_duplicates', summary)
+    print(f"Found {summary['duplicate_groups']} near-duplicate groups "
+          f"({summary['redundant_images']} redundant images) at Hamming radius {radius}")
+    return groups
+
+def split_by_groups(images, keys, groups, group_splits, n_train, n_val):
+    """
+    Split shuffled images so every near-duplicate group lands in a single split.
+
+    Groups are taken in the order their first member appears in images. A group already
+    placed (for example from another category) keeps its split; new groups fill train,
+    then val, then test. group_splits is updated in place.
+    """
+    members = {}
+    for img, key in zip(images, keys):
+        members.setdefault(groups.get(key, key), []).append(img)
+
+    splits = {'train': [], 'val': [], 'test': []}
+    for group, group_images in members.items():
+        split = group_splits.get(group)
+        if split is None:
+            if len(splits['train']) < n_train:
+                split = 'train'
+            elif len(splits['val']) < n_val:
+                split = 'val'
+            else:
+                split = 'test'
+            group_splits[group] = split
+        splits[split].extend(group_images)
+    return splits
+
+def partition_dataset(source_dir, output_base, train_ratio=0.7, val_ratio=0.15, test_ratio=0.15, seed=42, report=None,
+                      dedupe_radius=None, image_cache=None, executor=None):
     """
     Partition the dataset into train, validation, and test sets while maintaining class balance.
     
@@ -22,7 +98,19 @@ def partition_dataset(source_dir, output_base, train_ratio=0.7, val_ratio=0.15,
         val_ratio: Proportion of data for validation (default: 0.15)
         test_ratio: Proportion of data for testing (default: 0.15)
         seed: Random seed for reproducibility
+        report: Optional StageReport to record timings and bytes copied
+        dedupe_radius: If set, near-duplicate images (perceptual hashes within this Hamming
+            distance) are kept together in the same split
+        image_cache: Optional DecodedImageCache used when hashing
+        executor: Optional Executor the images are hashed on (serial if not given)
     """
+    report = report or StageReport('partition_dataset')
+    
+    groups = None
+    group_splits = {}
+    if dedupe_radius is not None:
+        groups = find_duplicate_groups(source_dir, dedupe_radius, image_cache, report, executor)
+    
     # Set random seed for reproducibility
     random.seed(seed)
     
@@ -48,22 +136,27 @@ def partition_dataset(source_dir, output_base, train_ratio=0.7, val_ratio=0.15,
         n_val = int(n_images * val_ratio)
         
         # Split the images
-        train_images = images[:n_train]
-        val_images = images[n_train:n_train + n_val]
-        test_images = images[n_train + n_val:]
+        if groups is None:
+            splits = {
+                'train': images[:n_train],
+                'val': images[n_train:n_train + n_val],
+                'test': images[n_train + n_val:]
+            }
+        else:
+            keys = [f"{category}/{img}" for img in images]
+            splits = split_by_groups(images, keys, groups, group_splits, n_train, n_val)
+        train_images, val_images, test_images = splits['train'], splits['val'], splits['test']
         
         # Copy images to their respective directories
-        splits = {
-            'train': train_images,
-            'val': val_images,
-            'test': test_images
-        }
         
-        for split_name, split_images in splits.items():
-            for img in split_images:
-                src = os.path.join(category_path, img)
-                dst = os.path.join(output_base, split_name, category, img)
-                shutil.copy2(src, dst)
+        with report.phase(f"copy_{category}", total=n_images) as phase:
+            for split_name, split_images in splits.items():
+                for img in split_images:
+                    src = os.path.join(category_path, img)
+                    dst = os.path.join(output_base, split_name, category, img)
+                    shutil.copy2(src, dst)
+                    size = file_size(dst)
+                    phase.tick(bytes_read=size, bytes_written=size)
         
         print(f"\nCategory: {category}")
         print(f"Total images: {n_images}")
@@ -71,6 +164,66 @@ def partition_dataset(source_dir, output_base, train_ratio=0.7, val_ratio=0.15,
         print(f"Validation: {len(val_images)} images ({len(val_images)/n_images*100:.1f}%)")
         print(f"Test: {len(test_images)} images ({len(test_images)/n_images*100:.1f}%)")
 
+def assign_folds(images, keys, groups, group_folds, k):
+    """
+    Deal shuffled images into k folds so every near-duplicate group lands in a single fold.
+
+    Groups are taken in the order their first member appears in images. A group already
+    placed (for example from another category) keeps its fold; a new group goes to the fold
+    with the fewest images of this category so far. group_folds is updated in place.
+    Returns {image: fold}.
+    """
+    members = {}
+    for img, key in zip(images, keys):
+        members.setdefault(groups.get(key, key) if groups else key, []).append(img)
+
+    counts = [0] * k
+    folds = {}
+    for group, group_images in members.items():
+        fold = group_folds.get(group)
+        if fold is None:
+            fold = group_folds[group] = counts.index(min(counts))
+        counts[fold] += len(group_images)
+        folds.update((img, fold) for img in group_images)
+    return folds
+
+def write_fold_manifest(source_dir, manifest, k=5, seed=42, report=None, dedupe_radius=None, image_cache=None,
+                        executor=None):
+    """
+    Assign every image under source_dir/<category>/ to one of k folds, stratified by category.
+
+    Instead of copying the images, the fold of each image is written to the manifest table
+    (image_filename as <category>/<file>, category, fold), so all folds share one set of
+    images and source_dir is left untouched. Near-duplicate images (within dedupe_radius, if
+    set) share a fold. Returns a {category: [count per fold]} summary.
+    """
+    report = report or StageReport('partition_dataset')
+    groups = None
+    if dedupe_radius is not None:
+        groups = find_duplicate_groups(source_dir, dedupe_radius, image_cache, report, executor)
+
+    random.seed(seed)
+    folds = {}
+    group_folds = {}
+    summary = {}
+    for category in ['normal', 'benign', 'malignant']:
+        category_path = os.path.join(source_dir, category)
+        if not os.path.exists(category_path):
+            print(f"Warning: Category directory not found: {category_path}")
+            continue
+        # Sorted first so the shuffle, and the folds, do not depend on the directory order
+        images = sorted(f for f in os.listdir(category_path) if f.endswith('.png'))
+        random.shuffle(images)
+        category_folds = assign_folds(images, [f"{category}/{img}" for img in images], groups, group_folds, k)
+        folds.update((f"{category}/{img}", fold) for img, fold in category_folds.items())
+        summary[category] = [list(category_folds.values()).count(fold) for fold in range(k)]
+
+    df = pd.DataFrame({'image_filename': list(folds), 'fold': list(folds.values())})
+    df['category'] = df['image_filename'].str.split('/').str[0]
+    write_metadata(df, manifest)
+    report.set('folds', summary)
+    return summary
+
 def main():
     # Define paths
     source_dir = "overlayed_dataset"  # Updated to use the correct source directory
@@ -80,9 +233,31 @@ def main():
         print(f"Error: Source directory not found at {source_dir}")
         return
     
+    report = StageReport('partition_dataset')
+    image_cache = open_image_cache()
+    folds = fold_count()
+    if folds:
+        print(f"Assigning {folds} stratified folds...")
+        with open_executor() as executor:
+            summary = write_fold_manifest(source_dir, FOLD_MANIFEST, folds, report=report, dedupe_radius=DEDUPE_RADIUS,
+                                          image_cache=image_cache, executor=executor)
+        if image_cache is not None:
+            report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+            image_cache.close()
+        print("\nImages per fold:")
+        print(pd.DataFrame(summary, index=[f"fold {fold}" for fold in range(folds)]).T)
+        print(f"\nFold manifest written to {FOLD_MANIFEST}")
+        report.write()
+        return
+
     print("Starting dataset partitioning...")
     print("Using split ratios: 70% train, 15% validation, 15% test")
-    partition_dataset(source_dir, output_base)
+    with open_executor() as executor:
+        partition_dataset(source_dir, output_base, report=report, dedupe_radius=DEDUPE_RADIUS, image_cache=image_cache,
+                          executor=executor)
+    if image_cache is not None:
+        report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+        image_cache.close()
     
     # Create a summary CSV
     summary_data = []
@@ -101,16 +276,8 @@ def main():
     summary_df = pd.DataFrame(summary_data)
     summary_df.to_csv(os.path.join(output_base, 'partition_summary.csv'), index=False)
     
-    # Copy the matched_data.csv to the partitioned dataset directory
-    if os.path.exists(os.path.join(source_dir, 'matched_data.csv')):
-        shutil.copy2(
-            os.path.join(source_dir, 'matched_data.csv'),
-            os.path.join(output_base, 'matched_data.csv')
-        )
-
-    # Update image_filename field in matched_data.csv to reflect new split/category/image.png paths
-    matched_data_path = os.path.join(output_base, 'matched_data.csv')
-    df = pd.read_csv(matched_data_path)
+    # Update image_filename in the metadata table to reflect new split/category/image.png paths
+    df = read_metadata(source_dir)
     new_paths = {}
     for split in ['train', 'val', 'test']:
         for category in ['normal', 'benign', 'malignant']:
@@ -120,19 +287,17 @@ def main():
             for fname in os.listdir(dir_path):
                 if fname.endswith('.png'):
                     new_paths[fname] = f"{split}/{category}/{fname}"
-    updated = 0
-    for idx, row in df.iterrows():
-        fname = os.path.basename(row['image_filename'])
-        if fname in new_paths:
-            df.at[idx, 'image_filename'] = new_paths[fname]
-            updated += 1
-    df.to_csv(matched_data_path, index=False)
+    mapped = df['image_filename'].map(os.path.basename).map(new_paths)
+    updated = int(mapped.notna().sum())
+    df['image_filename'] = mapped.fillna(df['image_filename'])
+    write_metadata(df, output_base)
     print(f"\nUpdated {updated} image paths in matched_data.csv to match partitioned dataset structure.")
 
     print("\nPartitioning complete!")
     print(f"Partitioned dataset saved to: {output_base}")
     print("\nPartition Summary:")
     print(summary_df.pivot(index='category', columns='split', values='count'))
+    report.write()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Perceptual hashes and a Hamming-distance index for finding near-duplicate images.
+
+Near-identical ultrasound frames must land in the same split (otherwise the test set leaks
+into training) and only need to be scored, uploaded and predicted once. dHash/pHash give
+64-bit fingerprints that stay close under small changes; the multi-index hash table finds
+all fingerprints within a Hamming radius without comparing every pair.
+
+Ultrasound frames share a lot of layout (the acquisition fan, the skull ring), so 64 bits
+alone cannot separate near-duplicates from merely similar frames. Candidates found with the
+64-bit hash are therefore verified with a 1024-bit dHash of a 32x32 thumbnail.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+from itertools import combinations
+
+import cv2
+import numpy as np
+
+from image_cache import imread
+
+HASH_BITS = 64
+# Hamming distance (out of 64 dHash bits) within which frames are checked as near-duplicates
+DEDUPE_RADIUS = 8
+
+def _pack_bits(bits):
+    """Pack a boolean array into a Python int."""
+    return int.from_bytes(np.packbits(bits.reshape(-1)).tobytes(), 'big')
+
+def dhash(gray, size=8):
+    """Difference hash: sign of horizontal gradients on a (size+1) x size thumbnail."""
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack_bits(small[:, 1:] > small[:, :-1])
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+_DCT_32 = _dct_matrix(32)
+
+def phash(gray):
+    """DCT hash: low 8x8 frequencies of a 32x32 thumbnail compared with their median."""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float64)
+    coefficients = (_DCT_32 @ small @ _DCT_32.T)[:8, :8]
+    # The DC term only reflects mean brightness, so leave it out of the median
+    median = np.median(coefficients.reshape(-1)[1:])
+    return _pack_bits(coefficients > median)
+
+HASH_FUNCTIONS = {'dhash': dhash, 'phash': phash}
+
+# Side of the thumbnail for the verification hash, and the fraction of its bits that may differ
+FINE_HASH_SIZE = 32
+FINE_HASH_THRESHOLD = 0.15
+
+def hash_image(path, method='dhash', image_cache=None):
+    """
+    Fingerprint of an image file: (64-bit hash, 1024-bit verification dHash).
+
+    Returns None if the image cannot be read.
+    """
+    image = imread(path, cv2.IMREAD_COLOR, image_cache)
+    if image is None:
+        return None
+    return fingerprint(image, method)
+
+def fingerprint(image, method='dhash'):
+    """(64-bit hash, 1024-bit verification dHash) of a decoded BGR image."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return HASH_FUNCTIONS[method](gray), dhash(gray, FINE_HASH_SIZE)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit hashes.
+
+    Each hash is split into num_chunks substrings, each indexed in its own table. Two hashes
+    within distance r agree to within r // num_chunks bits on at least one substring, so a
+    query only has to probe substrings that close and verify the candidates it finds.
+    """
+
+    def __init__(self, num_chunks=4):
+        if HASH_BITS % num_chunks:
+            raise ValueError(f"num_chunks must divide {HASH_BITS}")
+        self.num_chunks = num_chunks
+        self.chunk_bits = HASH_BITS // num_chunks
+        self._mask = (1 << self.chunk_bits) - 1
+        self._tables = [{} for _ in range(num_chunks)]
+        self._hashes = []
+        self._ids = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _chunks(self, value):
+        return [(value >> (i * self.chunk_bits)) & self._mask for i in range(self.num_chunks)]
+
+    def _neighbours(self, chunk, radius):
+        """All chunk values within radius bits of chunk."""
+        yield chunk
+        for flips in range(1, radius + 1):
+            for positions in combinations(range(self.chunk_bits), flips):
+                value = chunk
+                for position in positions:
+                    value ^= 1 << position
+                yield value
+
+    def add(self, value, item_id):
+        position = len(self._ids)
+        self._hashes.append(value)
+        self._ids.append(item_id)
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            table.setdefault(chunk, []).append(position)
+
+    def query(self, value, radius):
+        """Return [(item_id, distance)] for every indexed hash within radius of value."""
+        chunk_radius = radius // self.num_chunks
+        seen = set()
+        matches = []
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for probe in self._neighbours(chunk, chunk_radius):
+                for position in table.get(probe, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    distance = hamming_distance(value, self._hashes[position])
+                    if distance <= radius:
+                        matches.append((self._ids[position], distance))
+        return matches
+
+def group_near_duplicates(hashes, radius=8, num_chunks=4, fine_threshold=FINE_HASH_THRESHOLD):
+    """
+    Group near-duplicate items (transitively).
+
+    hashes maps item id -> fingerprint from hash_image, or -> a bare 64-bit hash. Candidates
+    within radius on the 64-bit hash are confirmed when their verification hashes differ in
+    at most fine_threshold of the bits. Returns item id -> group id, where the group id is
+    the first item id of the group in iteration order.
+    """
+    fine_limit = fine_threshold * FINE_HASH_SIZE * FINE_HASH_SIZE
+    parent = {}
+
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    index = HammingIndex(num_chunks)
+    for item_id, fingerprint in hashes.items():
+        value, fine = fingerprint if isinstance(fingerprint, tuple) else (fingerprint, None)
+        parent[item_id] = item_id
+        for other, _ in index.query(value, radius):
+            if fine is not None and hamming_distance(fine, hashes[other][1]) > fine_limit:
+                continue
+            parent[find(item_id)] = find(other)
+        index.add(value, item_id)
+
+    # Name each group after its first member so group ids are stable
+    first_member = {}
+    groups = {}
+    for item_id in hashes:
+        groups[item_id] = first_member.setdefault(find(item_id), item_id)
+    return groups
+
+def summarize_groups(groups):
+    """Count duplicate groups and the images that are redundant copies."""
+    sizes = {}
+    for group in groups.values():
+        sizes[group] = sizes.get(group, 0) + 1
+    duplicate_groups = [size for size in sizes.values() if size > 1]
+    return {'images': len(groups), 'duplicate_groups': len(duplicate_groups),
+            'redundant_images': sum(size - 1 for size in duplicate_groups)}
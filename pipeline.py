@@ -0,0 +1,76 @@
+"""
+Single entry point for every pipeline stage.
+
+    python -m pipeline <command> [args]
+    python -m pipeline --help
+
+Stage modules are only imported when their command runs, so heavy dependencies (OpenCV,
+pandas, the Google Cloud SDKs) are loaded by the commands that need them and `--help`
+starts immediately. Every stage module can also be imported as a library without side effects.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import importlib
+import sys
+
+# command -> (module, function, takes its own arguments, help), in pipeline order
+COMMANDS = {
+    'download': ('download_dataset', 'download_dataset', False, "Download the dataset from Kaggle"),
+    'match': ('match_metadata', 'main', False, "Match ultrasound images with their metadata"),
+    'masks': ('mask_store', 'main', True, "Build or refit the run-length encoded annotation mask store"),
+    'overlays': ('generate_overlays', 'main', False, "Draw the fitted ellipse overlays"),
+    'partition': ('partition_dataset', 'main', False, "Split into train/val/test, keeping near-duplicates together"),
+    'balance': ('balance_dataset', 'main', False, "Keep the highest quality images to balance the classes"),
+    'crop': ('crop_overlays', 'main', True, "Crop the balanced overlays to the brain ellipse"),
+    'stream': ('streaming_pipeline', 'main', True, "Run match to JSONL in one streaming pass"),
+    'create-bucket': ('create_bucket', 'create_bucket', False, "Create the Cloud Storage bucket"),
+    'upload-dataset': ('upload_dataset', 'upload_dataset', False, "Upload the images to Cloud Storage"),
+    'jsonl': ('generate_jsonl', 'main', False, "Write the tuning JSONL files"),
+    'validate': ('validate_jsonl', 'main', True, "Validate JSONL files before upload"),
+    'budget': ('token_budget', 'main', True, "Analyze token and payload budgets"),
+    'upload-jsonl': ('upload_jsonl', 'upload_jsonl', False, "Validate and upload the JSONL files"),
+    'fine-tune': ('fine_tune_model', 'main', False, "Fine-tune Gemini on Vertex AI"),
+    'triage': ('triage_model', 'main', False, "Train the local triage model"),
+    'convert': ('convert_batch_format', 'main', False, "Convert the test set to batch prediction format"),
+    'batch-predict': ('batch_predict', 'main', False, "Run batch prediction on the test set"),
+    'retrieve': ('prediction_retrieval', 'main', True, "Download and stream the outputs of a batch prediction job"),
+    'serve': ('inference_server', 'main', True, "Run the online inference service"),
+    'stub': ('stub_endpoint', 'main', True, "Run the local stub model endpoint"),
+    'synth': ('generate_synthetic_dataset', 'main', True, "Generate a synthetic dataset"),
+    'benchmark': ('benchmark', 'main', True, "Benchmark the stages on synthetic data"),
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m pipeline', description="Fetal ultrasound Gemini pipeline")
+    subparsers = parser.add_subparsers(dest='command', metavar='<command>', required=True)
+    for name, (_, _, own_arguments, help_text) in COMMANDS.items():
+        if own_arguments:
+            # The stage parses its own arguments, including --help
+            subparsers.add_parser(name, help=help_text, add_help=False)
+        else:
+            subparsers.add_parser(name, help=help_text, description=help_text)
+    return parser
+
+def run(command, args=()):
+    """Import the stage for command and run it with args as its command line."""
+    module_name, function_name, _, _ = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    argv = sys.argv
+    sys.argv = [f"python -m pipeline {command}"] + list(args)
+    try:
+        return getattr(module, function_name)()
+    finally:
+        sys.argv = argv
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if extra and not COMMANDS[args.command][2]:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    return run(args.command, extra)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Cache of model predictions shared by batch and online prediction.
+
+Entries are keyed by (model_id, request hash), where the request hash covers the exact image
+bytes and the rendered prompt, so a prediction is reused only when the model would see the same
+input. Only misses are sent to the model. Entries expire after max_age_days, and the least
+recently used entries are evicted when the cache grows past max_bytes. Each entry records the
+estimated input tokens and the time it took to obtain, so hits can be reported as money and
+time saved.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from token_estimates import estimate_image_tokens, estimate_text_tokens, png_header_dimensions
+
+CACHE_PATH_ENV = 'PREDICTION_CACHE'
+DEFAULT_CACHE_PATH = 'prediction_cache/predictions.sqlite'
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_BYTES = 1024 ** 3
+# USD per million input tokens; set to the current price of the model and mode in use
+INPUT_PRICE_PER_MILLION_TOKENS = 0.15
+
+def request_hash(image_bytes, prompt):
+    """Hash of the exact image bytes and prompt text sent to the model."""
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b'\0')
+    digest.update(prompt.encode('utf-8'))
+    return digest.hexdigest()
+
+def estimate_input_tokens(image_bytes, prompt):
+    """Estimated input tokens of a request with one PNG image and a prompt."""
+    try:
+        width, height = png_header_dimensions(image_bytes[:24])
+        image_tokens = estimate_image_tokens(width, height)
+    except ValueError:
+        image_tokens = estimate_image_tokens(0, 0)
+    return image_tokens + estimate_text_tokens(prompt)
+
+class PredictionCache:
+    """SQLite-backed prediction cache; safe to share between threads of one process."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age_days=DEFAULT_MAX_AGE_DAYS, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " model_id TEXT NOT NULL, request_hash TEXT NOT NULL, response TEXT NOT NULL,"
+            " input_tokens INTEGER NOT NULL, seconds REAL NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model_id, request_hash))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self._db.commit()
+        self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def get_many(self, model_id, hashes):
+        """Return {request_hash: response} for the cached, unexpired hashes."""
+        hashes = list(dict.fromkeys(hashes))
+        now = time.time()
+        oldest = now - self.max_age_days * 86400
+        found = {}
+        with self._lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT request_hash, response, input_tokens, seconds FROM predictions"
+                    f" WHERE model_id = ? AND created >= ? AND request_hash IN ({','.join('?' * len(chunk))})",
+                    [model_id, oldest] + chunk).fetchall()
+                for key, response, input_tokens, seconds in rows:
+                    found[key] = json.loads(response)
+                    self.saved_tokens += input_tokens
+                    self.saved_seconds += seconds
+                self._db.executemany("UPDATE predictions SET last_used = ? WHERE model_id = ? AND request_hash = ?",
+                                     [(now, model_id, row[0]) for row in rows])
+            self._db.commit()
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return found
+
+    def get(self, model_id, key):
+        """Return the cached response for one request hash, or None."""
+        return self.get_many(model_id, [key]).get(key)
+
+    def put_many(self, model_id, entries):
+        """
+        Store predictions.
+
+        entries is an iterable of (request_hash, response, input_tokens, seconds), where
+        seconds is the time it took to get the prediction.
+        """
+        now = time.time()
+        rows = []
+        for key, response, input_tokens, seconds in entries:
+            data = json.dumps(response)
+            rows.append((model_id, key, data, int(input_tokens), float(seconds), len(data), now, now))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def put(self, model_id, key, response, input_tokens=0, seconds=0.0):
+        self.put_many(model_id, [(key, response, input_tokens, seconds)])
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones while over max_bytes."""
+        with self._lock:
+            removed = self._db.execute("DELETE FROM predictions WHERE created < ?",
+                                       (time.time() - self.max_age_days * 86400,)).rowcount
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+            if self.max_bytes is not None and total > self.max_bytes:
+                over = total - self.max_bytes
+                cursor = self._db.execute("SELECT model_id, request_hash, size FROM predictions ORDER BY last_used")
+                victims = []
+                for model_id, key, size in cursor:
+                    if over <= 0:
+                        break
+                    victims.append((model_id, key))
+                    over -= size
+                self._db.executemany("DELETE FROM predictions WHERE model_id = ? AND request_hash = ?", victims)
+                removed += len(victims)
+            self._db.commit()
+        return removed
+
+    def savings(self, price_per_million_tokens=INPUT_PRICE_PER_MILLION_TOKENS):
+        """Hits and misses so far, with the input tokens, money and time the hits saved."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'saved_input_tokens': self.saved_tokens,
+            'saved_usd': self.saved_tokens * price_per_million_tokens / 1e6,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._db.close()
+
+def print_savings(savings):
+    print(f"Prediction cache: {savings['hits']} hits, {savings['misses']} misses "
+          f"({savings['hit_ratio']:.1%} hit ratio)")
+    print(f"Saved ~{savings['saved_input_tokens']} input tokens (~${savings['saved_usd']:.4f}) "
+          f"and ~{savings['saved_seconds']:.1f}s of prediction time")
+
+def open_prediction_cache(path=None):
+    """
+    Open the prediction cache, or return None if it is disabled.
+
+    path defaults to PREDICTION_CACHE, then DEFAULT_CACHE_PATH; set PREDICTION_CACHE=off to disable it.
+    """
+    path = path or os.environ.get(CACHE_PATH_ENV, DEFAULT_CACHE_PATH)
+    if path.lower() in ('', 'off', 'none', '0'):
+        return None
+    return PredictionCache(path)
@@ -0,0 +1,269 @@
+"""
+Parallel streaming retrieval of batch prediction outputs.
+
+A batch prediction job writes its results as predictions_*.jsonl shards (optionally
+gzipped) under the gcs_output_directory returned by batch_predict.run_batch_prediction.
+PredictionRetriever lists the shards, downloads them concurrently on a bounded pool of
+threads, decompresses them as they stream in and yields the parsed prediction records as
+they arrive, so evaluation can start before the last shard lands.
+
+Each shard is also saved under <local_dir>/<job directory>/ (written to a temporary file
+and renamed) and journaled once complete, so an interrupted retrieval only downloads the
+shards it had not finished; finished shards are read back from disk.
+
+Storage is reached through a small interface (list, open) so the retriever can run on
+Cloud Storage or, with LOCAL_STORAGE_ROOT set, on a local directory standing in for the
+buckets (gs://<bucket>/<path> is read from <root>/<bucket>/<path>), e.g. for tests.
+
+    python prediction_retrieval.py gs://bucket/batch_predictions/prediction-model-... --workers 8
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from instrumentation import StageReport, format_bytes
+from stage_journal import StageJournal, atomic_path
+
+STORAGE_ROOT_ENV = 'LOCAL_STORAGE_ROOT'
+SHARD_PATTERN = 'predictions*.jsonl*'
+DEFAULT_WORKERS = 8
+CHUNK_BYTES = 1024 * 1024
+# Records buffered between the download threads and the consumer
+QUEUE_SIZE = 1024
+
+def split_uri(uri):
+    """(bucket, object path) of a gs:// URI."""
+    if not uri.startswith('gs://'):
+        raise ValueError(f"Not a gs:// URI: {uri}")
+    bucket, _, path = uri[len('gs://'):].partition('/')
+    return bucket, path
+
+class GCSStorage:
+    """Cloud Storage through google-cloud-storage."""
+
+    def __init__(self, client=None):
+        if client is None:
+            from google.cloud import storage
+            client = storage.Client()
+        self.client = client
+
+    def list(self, prefix_uri):
+        """[(uri, size)] of the objects under prefix_uri."""
+        bucket, prefix = split_uri(prefix_uri.rstrip('/') + '/')
+        return [(f"gs://{bucket}/{blob.name}", blob.size) for blob in self.client.list_blobs(bucket, prefix=prefix)]
+
+    def open(self, uri):
+        """Binary stream of an object's stored bytes."""
+        bucket, path = split_uri(uri)
+        # raw_download keeps gzip-encoded objects compressed; iter_lines decompresses them
+        return self.client.bucket(bucket).blob(path).open('rb', raw_download=True)
+
+class LocalStorage:
+    """A local directory standing in for Cloud Storage: gs://<bucket>/<path> is <root>/<bucket>/<path>."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, uri):
+        bucket, path = split_uri(uri)
+        return self.root / bucket / path
+
+    def list(self, prefix_uri):
+        directory = self._path(prefix_uri.rstrip('/'))
+        if not directory.is_dir():
+            return []
+        return [(f"{prefix_uri.rstrip('/')}/{path.relative_to(directory).as_posix()}", path.stat().st_size)
+                for path in sorted(directory.rglob('*')) if path.is_file()]
+
+    def open(self, uri):
+        return open(self._path(uri), 'rb')
+
+def open_storage():
+    """LocalStorage under LOCAL_STORAGE_ROOT if it is set, otherwise Cloud Storage."""
+    root = os.environ.get(STORAGE_ROOT_ENV)
+    return LocalStorage(root) if root else GCSStorage()
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+def iter_lines(chunks):
+    """Yield the lines of a stream of byte chunks, gunzipping them on the fly if the stream is gzipped."""
+    decompressor = None
+    pending = b''
+    for i, chunk in enumerate(chunks):
+        if i == 0 and chunk.startswith(GZIP_MAGIC):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line
+    if decompressor is not None:
+        pending += decompressor.flush()
+    if pending:
+        yield pending
+
+def parse_records(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def read_chunks(stream, chunk_bytes=CHUNK_BYTES):
+    while True:
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            return
+        yield chunk
+
+class PredictionRetriever:
+    """
+    Downloads the prediction shards of batch jobs on workers threads.
+
+    local_dir keeps a copy of every shard and the journal of finished ones.
+    """
+
+    def __init__(self, storage=None, local_dir='batch_predictions', workers=DEFAULT_WORKERS, report=None):
+        self.storage = storage or open_storage()
+        self.local_dir = Path(local_dir)
+        self.workers = workers
+        self.report = report or StageReport('prediction_retrieval')
+        self.downloaded_bytes = 0
+        self.resumed_shards = 0
+        self._lock = threading.Lock()
+
+    def shards(self, output_directory):
+        """[(uri, size)] of the prediction shards under output_directory."""
+        return [(uri, size) for uri, size in self.storage.list(output_directory)
+                if fnmatch.fnmatch(uri.rsplit('/', 1)[-1], SHARD_PATTERN)]
+
+    def job_dir(self, output_directory):
+        """Local directory of one job's shards."""
+        return self.local_dir / output_directory.rstrip('/').rsplit('/', 1)[-1]
+
+    def _fetch(self, uri, size, job_dir, journal, put, stop):
+        """Worker: stream one shard to disk and put its records; reads the local copy if already finished."""
+        local_path = job_dir / uri.rsplit('/', 1)[-1]
+        done, saved_size = journal.lookup(uri)
+        if done and saved_size == size and local_path.exists():
+            with open(local_path, 'rb') as f:
+                for record in parse_records(iter_lines(read_chunks(f))):
+                    put(record)
+            return 0, True
+
+        downloaded = 0
+        with atomic_path(local_path) as tmp_path, open(tmp_path, 'wb') as out, self.storage.open(uri) as stream:
+            def chunks():
+                nonlocal downloaded
+                for chunk in read_chunks(stream):
+                    if stop.is_set():
+                        raise InterruptedError("Retrieval stopped")
+                    out.write(chunk)
+                    downloaded += len(chunk)
+                    yield chunk
+
+            for record in parse_records(iter_lines(chunks())):
+                put(record)
+            out.close()
+        with self._lock:
+            journal.record(uri, size)
+        return downloaded, False
+
+    def iter_predictions(self, output_directory):
+        """
+        Yield every prediction record of the job in output_directory as soon as it is parsed.
+
+        Records of different shards are interleaved; an error in any shard is raised once the
+        records already parsed have been yielded.
+        """
+        shards = self.shards(output_directory)
+        job_dir = self.job_dir(output_directory)
+        job_dir.mkdir(parents=True, exist_ok=True)
+        records = queue.Queue(QUEUE_SIZE)
+        stop = threading.Event()
+        done = object()
+
+        def put(record):
+            while not stop.is_set():
+                try:
+                    records.put(record, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            raise InterruptedError("Retrieval stopped")
+
+        def fetch(uri, size):
+            try:
+                return self._fetch(uri, size, job_dir, journal, put, stop)
+            finally:
+                put(done)
+
+        journal = StageJournal(job_dir, 'prediction_retrieval')
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            with self.report.phase('retrieve', total=len(shards)) as phase:
+                futures = [pool.submit(fetch, uri, size) for uri, size in shards]
+                remaining = len(futures)
+                while remaining:
+                    record = records.get()
+                    if record is done:
+                        remaining -= 1
+                        phase.tick()
+                        continue
+                    yield record
+                for future in futures:
+                    downloaded, resumed = future.result()
+                    self.downloaded_bytes += downloaded
+                    self.resumed_shards += resumed
+                    phase.add_bytes(bytes_read=downloaded)
+        finally:
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            journal.close()
+        self.report.set('retrieval', {'shards': len(shards), 'resumed_shards': self.resumed_shards,
+                                      'downloaded_bytes': self.downloaded_bytes})
+
+    def local_files(self, output_directory):
+        """Paths of the shards saved for the job in output_directory."""
+        return sorted(p for p in self.job_dir(output_directory).iterdir() if fnmatch.fnmatch(p.name, SHARD_PATTERN))
+
+    def clear(self, output_directory):
+        """Remove the saved shards and journal of a job."""
+        shutil.rmtree(self.job_dir(output_directory), ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output_directory', help="gcs_output_directory of the batch prediction job")
+    parser.add_argument('--local-dir', default='batch_predictions')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    report = StageReport('prediction_retrieval')
+    retriever = PredictionRetriever(local_dir=args.local_dir, workers=args.workers, report=report)
+    start = time.perf_counter()
+    first = None
+    count = errors = 0
+    for record in retriever.iter_predictions(args.output_directory):
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+        errors += 'response' not in record
+    seconds = time.perf_counter() - start
+    print(f"Retrieved {count} predictions ({errors} without a response) in {seconds:.2f}s; "
+          f"first after {first or 0:.2f}s. Downloaded {format_bytes(retriever.downloaded_bytes)}, "
+          f"{retriever.resumed_shards} shards resumed from {retriever.job_dir(args.output_directory)}")
+    report.write()
+
+if __name__ == "__main__":
+    main()
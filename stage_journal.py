@@ -0,0 +1,180 @@
+"""
+Crash-safe resume journal for the long-running image stages.
+
+A stage that dies partway (out of memory, a preempted VM) used to start again from zero.
+StageJournal is an append-only JSON-lines file in the stage's output directory with one
+line per finished item: its key, the stamp (size and mtime) of its input and its result.
+Outputs are written to a temporary file and renamed into place before the item is
+journaled, so a journaled item always has its complete output and a crash leaves at most
+a stray temporary file, which is removed on restart. A restarted stage skips the journaled
+items whose inputs are unchanged and reuses their results, so it ends with the same
+outputs as an uninterrupted run. The journal is removed once the stage completes.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import cv2
+
+from executor import TaskResult
+from image_cache import file_stamp
+
+TEMP_SUFFIX = '.tmp'
+# The journal is flushed after every item, but only fsynced this often
+SYNC_SECONDS = 1.0
+
+def temp_path(path):
+    """Temporary file next to path that a write goes to before it is renamed to path."""
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}{TEMP_SUFFIX}")
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path to write path's contents to; it is renamed to path if the block
+    succeeds and removed if it fails.
+    """
+    tmp_path = temp_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def atomic_write_bytes(path, data):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+def atomic_imwrite(path, image):
+    """cv2.imwrite path atomically (encoded in memory, since the extension picks the format)."""
+    ok, buffer = cv2.imencode(Path(path).suffix, image)
+    if not ok:
+        raise ValueError(f"Could not encode image: {path}")
+    atomic_write_bytes(path, buffer.tobytes())
+
+def atomic_copy(src, dst):
+    """shutil.copy2 src to dst atomically."""
+    with atomic_path(dst) as tmp_path:
+        shutil.copy2(src, tmp_path)
+
+def remove_temp_files(directory):
+    """Remove the temporary files an interrupted run left under directory. Returns how many."""
+    removed = 0
+    for path in Path(directory).rglob(f"*{TEMP_SUFFIX}"):
+        if path.is_file():
+            path.unlink()
+            removed += 1
+    return removed
+
+class StageJournal:
+    """
+    Append-only record of the finished items of a stage, in directory/<stage>.journal.
+
+    Results must be JSON-serializable. Items are keyed by a string and stamped with their
+    input file, so an item whose input changed since it was journaled is done again.
+    """
+
+    def __init__(self, directory, stage):
+        self.path = Path(directory) / f"{stage}.journal"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._entries = {}
+        if self.path.exists():
+            self._load()
+        self._file = open(self.path, 'a')
+        self._synced = time.monotonic()
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # A crash while appending can leave a torn last line; drop it so appends start cleanly
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(complete))
+        for line in complete.decode().splitlines():
+            entry = json.loads(line)
+            self._entries[entry['key']] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def resumed(self):
+        """True if an earlier run left finished items."""
+        return bool(self._entries)
+
+    def lookup(self, key, source=None):
+        """
+        (True, result) if key was journaled with source's current stamp (or without a
+        source), otherwise (False, None).
+        """
+        entry = self._entries.get(key)
+        if entry is None or (source is not None and entry['stamp'] != file_stamp(source)):
+            return False, None
+        return True, entry['result']
+
+    def record(self, key, result, source=None):
+        """Journal key as finished with result; source is its input file, if any."""
+        entry = {'key': key, 'stamp': file_stamp(source) if source is not None else None, 'result': result}
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        now = time.monotonic()
+        if now - self._synced >= SYNC_SECONDS:
+            os.fsync(self._file.fileno())
+            self._synced = now
+        self._entries[key] = entry
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """Close and remove the journal once the stage has completed."""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+def journal_exists(directory, stage):
+    return (Path(directory) / f"{stage}.journal").exists()
+
+def journaled_imap(executor, function, paths, journal=None, key=str, keep=None):
+    """
+    executor.imap(function, paths) that takes the results of finished paths from journal
+    and journals the new successes, yielding a TaskResult per path in input order.
+
+    key turns a path into its journal key; keep(path, result), if given, must also hold
+    for a journaled result to be reused (e.g. its output file still exists).
+    """
+    paths = list(paths)
+    done = {}
+    if journal is not None:
+        for path in paths:
+            found, result = journal.lookup(key(path), path)
+            if found and (keep is None or keep(path, result)):
+                done[path] = result
+    results = executor.imap(function, [path for path in paths if path not in done])
+    for path in paths:
+        if path in done:
+            yield TaskResult(path, done[path], None)
+            continue
+        result = next(results)
+        if journal is not None and result.ok:
+            journal.record(key(path), result.value, path)
+        yield result
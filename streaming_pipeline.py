@@ -0,0 +1,364 @@
+"""
+Streaming pipeline from the raw Kaggle dataset to the tuning JSONL files.
+
+The staged scripts materialize matched_dataset, overlayed_dataset, partitioned_dataset and
+balanced_dataset before generate_jsonl.py runs. This runs the same steps as a chain of
+generators instead:
+
+1. scan: match the raw images with their FetusDataset.csv rows (as match_metadata.py)
+2. analyze: fit the ellipse, render the overlay in memory, hash and score it
+3. select: split into train/val/test keeping near-duplicates together and keep the highest
+   quality normal/benign images (as partition_dataset.py and balance_dataset.py); this
+   only needs the small per-image records, not the pixels
+4. render: render the selected overlays again and write them to balanced_dataset/
+5. write: the JSONL examples of each split, as generate_jsonl.py
+
+Steps 2 and 4 run on the executor (executor.py) with a bounded number of chunks in flight,
+and the scan and render steps feed the next step through bounded queues from their own
+threads, so reading, CPU work and writing overlap. Only the balanced images, the metadata
+table (partitioned_dataset/matched_data.parquet, where the later stages look for it) and
+the JSONL files are written; memory holds one small record per image besides the images in
+flight.
+
+Splits are drawn from the sorted file names, so they are reproducible but differ from
+partition_dataset.py, which shuffles the directory listing order.
+
+    python streaming_pipeline.py
+    PIPELINE_EXECUTOR=process python streaming_pipeline.py --no-dedupe
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+from functools import partial
+from pathlib import Path
+
+import cv2
+import pandas as pd
+
+from balance_dataset import image_quality
+from executor import open_executor, print_errors
+from generate_jsonl import create_jsonl_example, natural_sort_key
+from generate_overlays import fit_ellipse, overlay_in_place, overlay_row
+from image_cache import imread, open_image_cache
+from instrumentation import StageReport, file_size
+from match_metadata import BASE_PATH, health_to_category, metadata_row, scan_dataset
+from mask_store import ANNOTATION_SUFFIX
+from metadata_store import MetadataIndex, PROMPT_COLUMNS, apply_dtypes, write_metadata
+from partition_dataset import split_by_groups
+from perceptual_hash import DEDUPE_RADIUS, fingerprint, group_near_duplicates
+from token_budget import BudgetExceeded, configured_budget, example_cost, image_info
+
+SPLITS = ['train', 'val', 'test']
+CATEGORIES = ['normal', 'benign', 'malignant']
+# Items a producer thread may run ahead of its consumer
+QUEUE_SIZE = 64
+
+def prefetch(iterable, maxsize=QUEUE_SIZE):
+    """
+    Iterate over iterable in a background thread, at most maxsize items ahead.
+
+    An exception raised by iterable is re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+            return
+        items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+def iter_dataset(base_path=BASE_PATH):
+    """
+    Yield one record per annotated image of the raw dataset, in FetusDataset.csv order.
+
+    Records hold the image and annotation paths, the category from fetal_health and the
+    matched_data row.
+    """
+    base_path = Path(base_path)
+    datasets_path = base_path / 'Datasets'
+    df = pd.read_csv(base_path / 'FetusDataset.csv')
+    image_mapping = scan_dataset(datasets_path)
+    for idx, row in df.iterrows():
+        img_info = image_mapping.get(idx + 1)
+        if img_info is None or not img_info['has_annotation']:
+            continue
+        category = health_to_category[row['fetal_health']]
+        image_path = datasets_path / img_info['category'] / img_info['filename']
+        yield {
+            'image_path': str(image_path),
+            'annotation_path': str(image_path.with_name(image_path.stem + ANNOTATION_SUFFIX)),
+            'category': category,
+            'metadata': metadata_row(idx + 1, img_info, row, category),
+        }
+
+def analyze_image(record, dedupe=True, image_cache=None):
+    """
+    Worker: fit the ellipse of one record and hash and score its overlay in memory.
+
+    Returns a small dict without pixels. Raises ValueError if the image cannot be used.
+    """
+    annotation = imread(record['annotation_path'], cv2.IMREAD_GRAYSCALE, image_cache)
+    if annotation is None:
+        raise ValueError("Could not read annotation")
+    ellipse_params = fit_ellipse(annotation)
+    image = imread(record['image_path'], cv2.IMREAD_COLOR, image_cache)
+    if image is None:
+        raise ValueError("Could not read original image")
+    overlay = overlay_in_place(image, ellipse_params)
+
+    row = overlay_row(Path(record['image_path']).name, record['category'], ellipse_params)
+    del row['source_filename']
+    row.update({k: v for k, v in record['metadata'].items() if k not in row})
+    return {
+        'image_path': record['image_path'],
+        'ellipse': ellipse_params,
+        'row': row,
+        'hash': fingerprint(overlay) if dedupe else None,
+        # Malignant images are always kept, so only the others are scored
+        'score': image_quality(overlay) if record['category'] != 'malignant' else None,
+    }
+
+def assign_splits(by_name, seed=42, train_ratio=0.7, val_ratio=0.15, dedupe_radius=DEDUPE_RADIUS):
+    """
+    Split the analyzed images like partition_dataset, from their sorted overlay file names.
+
+    by_name maps overlay file name to its analyzed record. Returns
+    {split: {category: [overlay file name]}}.
+    """
+    names = {category: sorted(name for name, a in by_name.items() if a['row']['category'] == category)
+             for category in CATEGORIES}
+    groups = None
+    if dedupe_radius is not None:
+        hashes = {f"{c}/{name}": by_name[name]['hash'] for c in CATEGORIES for name in names[c]}
+        groups = group_near_duplicates(hashes, dedupe_radius)
+
+    rng = random.Random(seed)
+    group_splits = {}
+    splits = {split: {} for split in SPLITS}
+    for category in CATEGORIES:
+        images = list(names[category])
+        rng.shuffle(images)
+        n_train = int(len(images) * train_ratio)
+        n_val = int(len(images) * val_ratio)
+        if groups is None:
+            category_splits = {'train': images[:n_train], 'val': images[n_train:n_train + n_val],
+                               'test': images[n_train + n_val:]}
+        else:
+            keys = [f"{category}/{img}" for img in images]
+            category_splits = split_by_groups(images, keys, groups, group_splits, n_train, n_val)
+        for split in SPLITS:
+            splits[split][category] = category_splits[split]
+    return splits
+
+def select_balanced(splits, by_name, dedupe_radius=DEDUPE_RADIUS):
+    """
+    Keep the highest quality normal/benign images per split like balance_dataset.
+
+    by_name maps overlay file name to its analyzed record. Returns (selected, dropped) where
+    selected is {split: {category: [overlay file name]}}.
+    """
+    selected = {}
+    dropped = 0
+    for split in SPLITS:
+        categories = {}
+        for category in CATEGORIES:
+            images = sorted(splits[split][category])
+            if dedupe_radius is not None:
+                groups = group_near_duplicates({img: by_name[img]['hash'] for img in images}, dedupe_radius)
+                unique_images = [img for img in images if groups.get(img, img) == img]
+                dropped += len(images) - len(unique_images)
+                images = unique_images
+            categories[category] = images
+        smallest_count = min(len(images) for images in categories.values())
+        selected[split] = {}
+        for category, images in categories.items():
+            if category in ['normal', 'benign']:
+                images = sorted(images, key=lambda img: by_name[img]['score'], reverse=True)[:smallest_count]
+            selected[split][category] = sorted(images, key=natural_sort_key)
+    return selected, dropped
+
+def render_overlay(task, output_dir, image_cache=None):
+    """
+    Worker: render one selected overlay into output_dir/<split>/<category>/.
+
+    task is (image path, ellipse params, relative output path). Returns the (width, height)
+    and bytes of the written PNG.
+    """
+    image_path, ellipse_params, relative_path = task
+    image = imread(image_path, cv2.IMREAD_COLOR, image_cache)
+    if image is None:
+        raise ValueError("Could not read original image")
+    output_path = Path(output_dir) / relative_path
+    cv2.imwrite(str(output_path), overlay_in_place(image, ellipse_params))
+    return image_info(output_path)
+
+def run_streaming_pipeline(base_path=BASE_PATH, output_dir='balanced_dataset', metadata_dir='partitioned_dataset',
+                           jsonl_dir='jsonl', bucket_path=None, seed=42, dedupe_radius=DEDUPE_RADIUS,
+                           budget=None, executor=None, image_cache=None, report=None):
+    """
+    Run the whole pipeline from base_path to the JSONL files in jsonl_dir.
+
+    Writes the balanced images to output_dir and the metadata table to metadata_dir.
+    If a TokenBudget is given, BudgetExceeded is raised and no JSONL file of the failing
+    split is left behind. Returns {split: number of examples}.
+    """
+    report = report or StageReport('streaming_pipeline')
+    executor = executor or open_executor()
+    bucket_path = bucket_path or f"gs://fetus-ultrasound-balanced-with-metadata/{Path(output_dir).name}"
+    errors = []
+
+    # Scan and analyze: one small record per image
+    analyze = partial(analyze_image, dedupe=dedupe_radius is not None, image_cache=image_cache)
+    analyzed = []
+    results = []
+    with report.phase('analyze', total=0) as phase:
+        for result in executor.imap(analyze, prefetch(iter_dataset(base_path))):
+            if result.ok:
+                analyzed.append(result.value)
+                phase.tick(bytes_read=file_size(result.item['image_path']))
+            else:
+                results.append(result)
+                phase.error()
+    errors += print_errors(results, describe=lambda record: record['image_path'])
+    print(f"Analyzed {len(analyzed)} annotated images")
+
+    # Select: partition and balance on the records
+    with report.phase('select', total=0):
+        by_name = {a['row']['image_filename']: a for a in analyzed}
+        splits = assign_splits(by_name, seed, dedupe_radius=dedupe_radius)
+        selected, dropped = select_balanced(splits, by_name, dedupe_radius)
+    if dedupe_radius is not None:
+        report.set('near_duplicates_dropped', dropped)
+    report.set('selected', {split: {c: len(images) for c, images in categories.items()}
+                            for split, categories in selected.items()})
+
+    # Metadata table with the split/category/file paths, as partition_dataset writes it
+    split_paths = {name: f"{split}/{category}/{name}"
+                   for split in SPLITS for category in CATEGORIES for name in splits[split][category]}
+    df = pd.DataFrame([a['row'] for a in analyzed]).sort_values('image_number')
+    df['image_filename'] = df['image_filename'].map(split_paths)
+    df = apply_dtypes(df)
+    write_metadata(df, metadata_dir)
+    params_index = MetadataIndex(df[PROMPT_COLUMNS])
+
+    # Render the selected overlays and stream the JSONL examples as they are written
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    for split in SPLITS:
+        for category in CATEGORIES:
+            (Path(output_dir) / split / category).mkdir(parents=True, exist_ok=True)
+    tasks = [(by_name[name]['image_path'], by_name[name]['ellipse'], f"{split}/{category}/{name}")
+             for split in SPLITS for category in CATEGORIES for name in selected[split][category]]
+    render = partial(render_overlay, output_dir=output_dir, image_cache=image_cache)
+    os.makedirs(jsonl_dir, exist_ok=True)
+
+    counts = {split: 0 for split in SPLITS}
+    totals = {split: {'text_tokens': 0, 'image_tokens': 0, 'tokens': 0, 'jsonl_bytes': 0, 'image_bytes': 0}
+              for split in SPLITS}
+    files = {}
+    results = []
+    try:
+        with report.phase('render', total=len(tasks)) as phase:
+            for result in prefetch(executor.imap(render, tasks)):
+                if not result.ok:
+                    results.append(result)
+                    phase.error()
+                    continue
+                image_path = result.item[2]
+                split, label = image_path.split('/')[:2]
+                if split not in files:
+                    files[split] = open(Path(jsonl_dir) / f"balanced_{split}_dataset.jsonl.tmp", 'w')
+                metadata = params_index.get(image_path)
+                example = create_jsonl_example(image_path, label, bucket_path, metadata, metadata)
+                line = json.dumps(example) + '\n'
+                size, image_bytes = result.value
+                cost = example_cost(example['contents'][0]['parts'][1]['text'], label, size, image_bytes, len(line))
+                if budget is not None:
+                    budget.check_request(cost, image_path)
+                for key in totals[split]:
+                    totals[split][key] += cost[key]
+                files[split].write(line)
+                counts[split] += 1
+                phase.tick(bytes_written=image_bytes + len(line))
+        for split in SPLITS:
+            if budget is not None:
+                budget.check_file(totals[split]['tokens'], totals[split]['jsonl_bytes'],
+                                  f"{jsonl_dir}/balanced_{split}_dataset.jsonl")
+    except BaseException:
+        for split, f in files.items():
+            f.close()
+            os.remove(f.name)
+        raise
+    for f in files.values():
+        f.close()
+    for split in SPLITS:
+        tmp_path = Path(jsonl_dir) / f"balanced_{split}_dataset.jsonl.tmp"
+        if split not in files:
+            tmp_path.write_text('')
+        os.replace(tmp_path, tmp_path.with_suffix(''))
+        report.set(f"tokens_{split}", totals[split])
+    errors += print_errors(results, describe=lambda task: task[0])
+    if errors:
+        report.set('errors', errors)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--base-path', default=str(BASE_PATH), help="Raw dataset directory holding FetusDataset.csv")
+    parser.add_argument('--output-dir', default='balanced_dataset')
+    parser.add_argument('--metadata-dir', default='partitioned_dataset')
+    parser.add_argument('--jsonl-dir', default='jsonl')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-dedupe', action='store_true', help="Do not group or drop near-duplicate frames")
+    args = parser.parse_args()
+
+    if not (Path(args.base_path) / 'FetusDataset.csv').exists():
+        print(f"Error: FetusDataset.csv not found in {args.base_path}")
+        return
+
+    report = StageReport('streaming_pipeline')
+    image_cache = open_image_cache()
+    budget = configured_budget()
+    try:
+        with open_executor() as executor:
+            counts = run_streaming_pipeline(args.base_path, args.output_dir, args.metadata_dir, args.jsonl_dir,
+                                            seed=args.seed, dedupe_radius=None if args.no_dedupe else DEDUPE_RADIUS,
+                                            budget=budget, executor=executor, image_cache=image_cache, report=report)
+    except BudgetExceeded as e:
+        print(f"Error: token budget exceeded: {e}")
+        report.set('budget_exceeded', str(e))
+        report.write()
+        raise SystemExit(1)
+    finally:
+        if image_cache is not None:
+            report.record_cache('decoded_images', image_cache.hits, image_cache.misses)
+            image_cache.close()
+
+    for split, count in counts.items():
+        print(f"{split}: {count} examples written to {args.jsonl_dir}/balanced_{split}_dataset.jsonl")
+    print(f"Balanced images saved to: {args.output_dir}")
+    report.write()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Local stand-in for a deployed Gemini endpoint, for testing the online inference service.
+
+It accepts Vertex AI style `:predict` bodies ({"instances": [...]}) and single
+`:generateContent` requests, sleeps for a configurable latency and answers with a
+deterministic label derived from the request, so repeated runs give the same results.
+It also registers cached content (POST .../cachedContents) unless started without context
+caching or the content is below the minimum cached size, rejects requests that reference
+unknown cached content, and counts the request and prompt text bytes it receives so the
+payload saved by caching can be checked.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from token_estimates import estimate_text_tokens
+
+LABELS = ['normal', 'benign', 'malignant']
+# Vertex AI rejects cached content smaller than this
+MIN_CACHED_TOKENS = 2048
+
+def stub_label(request):
+    """Deterministic label for a generateContent request body."""
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).digest()
+    return LABELS[digest[0] % len(LABELS)]
+
+def prompt_bytes(request):
+    """UTF-8 bytes of the text parts of a generateContent request."""
+    return sum(len(part.get('text', '').encode('utf-8'))
+               for content in request.get('contents', []) for part in content.get('parts', []))
+
+def cached_text(body):
+    """Text of the system instruction and contents of a cachedContents body."""
+    contents = body.get('contents', []) + ([body['systemInstruction']] if 'systemInstruction' in body else [])
+    return ''.join(part.get('text', '') for content in contents for part in content.get('parts', []))
+
+def stub_response(request):
+    """A generateContent response containing the stub label."""
+    return {
+        'candidates': [{'content': {'role': 'model', 'parts': [{'text': stub_label(request)}]}}],
+        'usageMetadata': {'promptTokenCount': 0, 'candidatesTokenCount': 1},
+    }
+
+class StubEndpointHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _create_cached_content(self, body):
+        server = self.server
+        if not server.context_cache:
+            self._send_json(400, {'error': {'code': 400, 'message': "Context caching is not supported"}})
+            return
+        tokens = estimate_text_tokens(cached_text(body))
+        if tokens < server.min_cached_tokens:
+            self._send_json(400, {'error': {'code': 400, 'message': f"Cached content has about {tokens} tokens; "
+                                            f"the minimum is {server.min_cached_tokens}"}})
+            return
+        with server.lock:
+            name = f"projects/stub/locations/local/cachedContents/{len(server.cached_contents) + 1}"
+            server.cached_contents[name] = body
+        self._send_json(200, {'name': name, 'model': body.get('model')})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.loads(raw)
+        server = self.server
+        if self.path.endswith('/cachedContents'):
+            self._create_cached_content(body)
+            return
+        instances = body['instances'] if 'instances' in body else [body]
+        unknown = [i['cachedContent'] for i in instances if 'cachedContent' in i and i['cachedContent'] not in
+                   server.cached_contents]
+        if unknown:
+            self._send_json(400, {'error': {'code': 400, 'message': f"Cached content not found: {unknown[0]}"}})
+            return
+        if 'instances' in body:
+            payload = {'predictions': [stub_response(instance) for instance in instances]}
+        else:
+            payload = stub_response(body)
+
+        with server.lock:
+            server.calls += 1
+            server.instances += len(instances)
+            server.max_batch_size = max(server.max_batch_size, len(instances))
+            server.request_bytes += len(raw)
+            server.prompt_bytes += sum(prompt_bytes(instance) for instance in instances)
+            server.cached_instances += sum('cachedContent' in instance for instance in instances)
+        time.sleep((server.latency_ms + server.per_instance_ms * len(instances)) / 1000)
+
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_endpoint(port=0, latency_ms=50, per_instance_ms=2, context_cache=True,
+                        min_cached_tokens=MIN_CACHED_TOKENS):
+    """
+    Start the stub endpoint on a background thread.
+
+    Cached content with fewer than min_cached_tokens (estimated) is rejected like Vertex AI does.
+
+    Returns the server; its url attribute is the base URL, and calls, instances,
+    max_batch_size, request_bytes, prompt_bytes and cached_instances count what it has
+    received. Call shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubEndpointHandler)
+    server.daemon_threads = True
+    server.latency_ms = latency_ms
+    server.per_instance_ms = per_instance_ms
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.instances = 0
+    server.max_batch_size = 0
+    server.context_cache = context_cache
+    server.min_cached_tokens = min_cached_tokens
+    server.cached_contents = {}
+    server.request_bytes = 0
+    server.prompt_bytes = 0
+    server.cached_instances = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--per-instance-ms', type=float, default=2)
+    parser.add_argument('--no-context-cache', action='store_true', help="Reject cached content registration")
+    parser.add_argument('--min-cached-tokens', type=int, default=MIN_CACHED_TOKENS,
+                        help="Reject cached content smaller than this many (estimated) tokens")
+    args = parser.parse_args()
+
+    server = start_stub_endpoint(args.port, args.latency_ms, args.per_instance_ms, not args.no_context_cache,
+                                 args.min_cached_tokens)
+    print(f"Stub endpoint listening on {server.url} (POST .../endpoints/stub:predict)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
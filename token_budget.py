@@ -0,0 +1,258 @@
+"""
+Token and payload budget analysis for tuning examples and batch requests.
+
+Every prompt stacks the base prompt, the ellipse block and the 21-field metadata block on top of
+an image. This estimates the text tokens, the image tokens (from the PNG dimensions) and the
+bytes of every example, aggregates them per split and per class with histograms, and flags
+outliers. TokenBudget enforces per-request and per-file limits; generate_jsonl.py and
+streaming_pipeline.py use configured_budget() to fail generation when a limit is exceeded.
+
+    python token_budget.py jsonl/balanced_*.jsonl batch_prediction_input.jsonl
+    python token_budget.py jsonl/balanced_train_dataset.jsonl --max-request-tokens 2000
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import StageReport, file_size, format_bytes
+from token_estimates import estimate_image_tokens, estimate_text_tokens, png_dimensions
+from validate_jsonl import MAX_PROMPT_TOKENS, detect_format, local_object_path, object_layout
+
+HISTOGRAM_BINS = 10
+# Examples beyond Q3 + OUTLIER_IQR * IQR of their split/class group, and at least
+# OUTLIER_MIN_RATIO above the group median, are flagged
+OUTLIER_IQR = 1.5
+OUTLIER_MIN_RATIO = 1.1
+
+# Limits applied while generating JSONL, each overridable by its environment variable
+# (0 lifts the limit). The request limit covers prompt text, label and image tokens, so it
+# must leave room for validate_jsonl.MAX_PROMPT_TOKENS of prompt text alone.
+BUDGET_ENVS = {
+    'max_request_tokens': 'PIPELINE_MAX_REQUEST_TOKENS',
+    'max_request_bytes': 'PIPELINE_MAX_REQUEST_BYTES',
+    'max_file_tokens': 'PIPELINE_MAX_FILE_TOKENS',
+    'max_file_bytes': 'PIPELINE_MAX_FILE_BYTES',
+}
+DEFAULT_LIMITS = {'max_request_tokens': 4096, 'max_file_bytes': 1024 ** 3}
+
+class BudgetExceeded(Exception):
+    """A request or file is over its configured token or byte limit."""
+
+class TokenBudget:
+    """Per-request and per-file token and byte limits; a limit of None is not enforced."""
+
+    def __init__(self, max_request_tokens=None, max_request_bytes=None, max_file_tokens=None, max_file_bytes=None):
+        self.max_request_tokens = max_request_tokens
+        self.max_request_bytes = max_request_bytes
+        self.max_file_tokens = max_file_tokens
+        self.max_file_bytes = max_file_bytes
+
+    @staticmethod
+    def _check(value, limit, what, where):
+        if limit is not None and value > limit:
+            raise BudgetExceeded(f"{where}: {what} {value} exceeds the limit of {limit}")
+
+    def check_request(self, cost, where):
+        """Raise BudgetExceeded if one request's cost (from example_cost) is over a limit."""
+        self._check(cost['tokens'], self.max_request_tokens, 'estimated tokens', where)
+        self._check(cost['request_bytes'], self.max_request_bytes, 'request bytes', where)
+
+    def check_file(self, tokens, jsonl_bytes, where):
+        """Raise BudgetExceeded if a whole file is over a limit."""
+        self._check(tokens, self.max_file_tokens, 'estimated tokens', where)
+        self._check(jsonl_bytes, self.max_file_bytes, 'bytes', where)
+
+def configured_budget():
+    """TokenBudget of DEFAULT_LIMITS overridden by the BUDGET_ENVS variables."""
+    limits = {}
+    for name, env in BUDGET_ENVS.items():
+        value = os.environ.get(env)
+        limits[name] = DEFAULT_LIMITS.get(name) if not value else int(value) or None
+    if limits['max_request_tokens'] is not None and limits['max_request_tokens'] < MAX_PROMPT_TOKENS:
+        raise ValueError(f"{BUDGET_ENVS['max_request_tokens']}={limits['max_request_tokens']} is below the "
+                         f"{MAX_PROMPT_TOKENS} prompt tokens validate_jsonl.py allows")
+    return TokenBudget(**limits)
+
+def example_cost(prompt, label=None, image_size=None, image_bytes=0, jsonl_bytes=0):
+    """
+    Estimated cost of one example.
+
+    image_size is (width, height) or None if the image is not available. request_bytes is the
+    JSONL line plus the image it references.
+    """
+    text_tokens = estimate_text_tokens(prompt) + (estimate_text_tokens(label) if label else 0)
+    image_tokens = estimate_image_tokens(*image_size) if image_size else 0
+    return {
+        'text_tokens': text_tokens,
+        'image_tokens': image_tokens,
+        'tokens': text_tokens + image_tokens,
+        'jsonl_bytes': jsonl_bytes,
+        'image_bytes': image_bytes,
+        'request_bytes': jsonl_bytes + image_bytes,
+    }
+
+def image_info(path):
+    """((width, height), bytes) of a local PNG, or (None, 0) if it is missing."""
+    try:
+        return png_dimensions(path), file_size(path)
+    except (OSError, ValueError):
+        return None, 0
+
+def read_examples(path, local_root='.'):
+    """Yield one cost row per line of a tuning JSONL or batch input file."""
+    with open(path, 'rb') as f:
+        file_format = detect_format(f.readline())
+    if file_format is None:
+        raise ValueError(f"{path} is neither a tuning JSONL file nor a batch input file")
+
+    with open(path, 'rb') as f:
+        for raw in f:
+            if not raw.strip():
+                continue
+            record = json.loads(raw)
+            contents = record['request']['contents'] if file_format == 'batch' else record['contents']
+            parts = contents[0]['parts']
+            file_uri = parts[0]['fileData']['fileUri']
+            label = contents[1]['parts'][0]['text'] if file_format == 'tuning' else None
+            size, image_bytes = image_info(local_object_path(file_uri, local_root))
+            row = example_cost(parts[1]['text'], label, size, image_bytes, len(raw))
+            _, split, category, _ = object_layout(file_uri)
+            # Fold examples share one image set; group them by their fold file instead
+            split = split or Path(path).stem
+            row.update({'file': str(path), 'file_uri': file_uri, 'split': split, 'category': category,
+                        'image_found': size is not None})
+            yield row
+
+def summarize(df, by):
+    """Count, mean, p50, p95, max and total tokens and bytes per group."""
+    grouped = df.groupby(by, observed=True)
+    summary = grouped.agg(
+        examples=('tokens', 'size'),
+        text_tokens_mean=('text_tokens', 'mean'),
+        image_tokens_mean=('image_tokens', 'mean'),
+        tokens_mean=('tokens', 'mean'),
+        tokens_p50=('tokens', 'median'),
+        tokens_p95=('tokens', lambda values: values.quantile(0.95)),
+        tokens_max=('tokens', 'max'),
+        tokens_total=('tokens', 'sum'),
+        request_bytes_mean=('request_bytes', 'mean'),
+        request_bytes_total=('request_bytes', 'sum'),
+    )
+    return summary.reset_index()
+
+def histograms(df, by, column='tokens', bins=HISTOGRAM_BINS):
+    """Histogram of column per group, with the same bin edges for every group."""
+    edges = np.histogram_bin_edges(df[column], bins=bins)
+    result = {}
+    for key, group in df.groupby(by, observed=True):
+        counts, _ = np.histogram(group[column], bins=edges)
+        result['/'.join(key) if isinstance(key, tuple) else key] = counts.tolist()
+    return {'column': column, 'edges': edges.tolist(), 'counts': result}
+
+def find_outliers(df, columns=('tokens', 'request_bytes'), by=('split', 'category')):
+    """Rows well above the rest of their group in any of columns (see OUTLIER_IQR)."""
+    flags = pd.Series(False, index=df.index)
+    for column in columns:
+        grouped = df.groupby(list(by), observed=True)[column]
+        q1, q3 = grouped.transform(lambda v: v.quantile(0.25)), grouped.transform(lambda v: v.quantile(0.75))
+        median = grouped.transform('median')
+        flags |= (df[column] > q3 + OUTLIER_IQR * (q3 - q1)) & (df[column] > median * OUTLIER_MIN_RATIO)
+    return df[flags]
+
+def print_histogram(histogram, width=40):
+    edges = histogram['edges']
+    decimals = 0 if edges[-1] - edges[0] >= 10 * len(edges) else 1
+    for name, counts in histogram['counts'].items():
+        print(f"\n{name} ({histogram['column']}):")
+        peak = max(max(counts), 1)
+        for low, high, count in zip(edges, edges[1:], counts):
+            print(f"  {low:8.{decimals}f}-{high:<8.{decimals}f} {'#' * round(width * count / peak):<{width}} {count}")
+
+def analyze(paths, local_root='.', report=None):
+    """Analyze the files and return (examples DataFrame, results dict)."""
+    report = report or StageReport('token_budget')
+    rows = []
+    with report.phase('read', total=0) as phase:
+        for path in paths:
+            for row in read_examples(path, local_root):
+                rows.append(row)
+                phase.tick(bytes_read=row['jsonl_bytes'])
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return df, {}
+
+    outliers = find_outliers(df)
+    results = {
+        'examples': len(df),
+        'missing_images': int((~df['image_found']).sum()),
+        'per_split': summarize(df, ['split']).to_dict(orient='records'),
+        'per_class': summarize(df, ['split', 'category']).to_dict(orient='records'),
+        'per_file': summarize(df, ['file']).to_dict(orient='records'),
+        'histograms': histograms(df, ['split']),
+        'outliers': outliers[['file_uri', 'split', 'category', 'tokens', 'request_bytes']].to_dict(orient='records'),
+    }
+    report.set('token_budget', results)
+    return df, results
+
+def print_analysis(results):
+    print(f"Analyzed {results['examples']} examples ({results['missing_images']} without a local image)")
+    print("\nPer split and class:")
+    for row in results['per_class']:
+        print(f"  {row['split']:>5}/{row['category']:<9} {row['examples']:>6} examples, "
+              f"~{row['tokens_mean']:.0f} tokens/request ({row['text_tokens_mean']:.0f} text + "
+              f"{row['image_tokens_mean']:.0f} image), p95 {row['tokens_p95']:.0f}, max {row['tokens_max']:.0f}, "
+              f"{format_bytes(row['request_bytes_mean'])}/request")
+    print("\nPer file:")
+    for row in results['per_file']:
+        print(f"  {row['file']}: {row['examples']} examples, ~{row['tokens_total']:.0f} tokens, "
+              f"{format_bytes(row['request_bytes_total'])}")
+    print_histogram(results['histograms'])
+    print(f"\n{len(results['outliers'])} outliers (above Q3 + {OUTLIER_IQR} IQR and {OUTLIER_MIN_RATIO}x the median "
+          f"of their split/class)")
+    for row in results['outliers'][:10]:
+        print(f"  {row['file_uri']}: ~{row['tokens']} tokens, {format_bytes(row['request_bytes'])}")
+
+def check_budget(df, budget):
+    """Raise BudgetExceeded for the first request or file over the budget."""
+    for row in df.itertuples():
+        budget.check_request({'tokens': row.tokens, 'request_bytes': row.request_bytes}, row.file_uri)
+    for path, group in df.groupby('file'):
+        budget.check_file(int(group['tokens'].sum()), int(group['jsonl_bytes'].sum()), path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help="Tuning JSONL or batch prediction input files")
+    parser.add_argument('--local-root', default='.', help="Directory holding the uploaded dataset directories")
+    parser.add_argument('--max-request-tokens', type=int)
+    parser.add_argument('--max-request-bytes', type=int)
+    parser.add_argument('--max-file-tokens', type=int)
+    parser.add_argument('--max-file-bytes', type=int)
+    args = parser.parse_args()
+
+    report = StageReport('token_budget')
+    df, results = analyze(args.files, args.local_root, report)
+    if df.empty:
+        print("No examples found")
+        return
+    print_analysis(results)
+
+    budget = TokenBudget(args.max_request_tokens, args.max_request_bytes, args.max_file_tokens, args.max_file_bytes)
+    try:
+        check_budget(df, budget)
+    except BudgetExceeded as e:
+        print(f"\nError: budget exceeded: {e}")
+        report.set('budget_exceeded', str(e))
+        report.write()
+        raise SystemExit(1)
+    report.write()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Estimates of the Gemini tokens and bytes a training or prediction request costs.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import math
+import struct
+
+# Gemini bills an image whose sides are both <= 384px as one tile; larger images are
+# scaled and cut into 768x768 tiles. Each tile costs 258 tokens.
+SMALL_IMAGE_SIDE = 384
+IMAGE_TILE_SIDE = 768
+TOKENS_PER_IMAGE_TILE = 258
+# Rough average for English prompt text
+CHARS_PER_TOKEN = 4
+
+def estimate_image_tokens(width, height):
+    """Estimate the input tokens for an image of the given size."""
+    if width <= SMALL_IMAGE_SIDE and height <= SMALL_IMAGE_SIDE:
+        return TOKENS_PER_IMAGE_TILE
+    tiles = math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE)
+    return tiles * TOKENS_PER_IMAGE_TILE
+
+def estimate_text_tokens(text):
+    """Estimate the input tokens for a prompt string."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def png_header_dimensions(data):
+    """Read (width, height) from the first 24 bytes of PNG data, or raise ValueError."""
+    if len(data) < 24 or data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        raise ValueError("Not PNG data")
+    return struct.unpack('>II', data[16:24])
+
+def png_dimensions(path):
+    """Read (width, height) from a PNG header without decoding the image."""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    try:
+        return png_header_dimensions(header)
+    except ValueError:
+        raise ValueError(f"Not a PNG file: {path}")
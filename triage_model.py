@@ -0,0 +1,243 @@
+"""
+Local triage classifier that runs ahead of the Gemini model.
+
+A softmax regression trained with NumPy on the CTG features and ellipse shape of the train
+split. When its top class probability reaches the confidence threshold, the prediction path
+uses its label and skips the model call; uncertain cases still go to Gemini. Training prints
+the accuracy of the triaged cases against the fraction of calls avoided for a range of
+thresholds, so the threshold can be chosen on the validation split.
+
+The cascade replaces model outputs, so it is only used when asked for: batch_predict.py
+with PIPELINE_TRIAGE set (threshold from PIPELINE_TRIAGE_THRESHOLD) and inference_server.py
+with --triage.
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import json
+import math
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from instrumentation import StageReport
+from metadata_store import FEATURE_COLUMNS, read_metadata
+
+LABELS = ['normal', 'benign', 'malignant']
+# Position of the ellipse is irrelevant to the diagnosis, so only its shape is used
+TRIAGE_COLUMNS = FEATURE_COLUMNS + ['ellipse_axis_x', 'ellipse_axis_y', 'ellipse_angle']
+TRIAGE_MODEL_PATH = 'triage/triage_model.json'
+DEFAULT_THRESHOLD = 0.95
+TRIAGE_ENV = 'PIPELINE_TRIAGE'
+THRESHOLD_ENV = 'PIPELINE_TRIAGE_THRESHOLD'
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99]
+
+class TriageModel:
+    """Multinomial logistic regression over standardized features."""
+
+    def __init__(self, columns=TRIAGE_COLUMNS, labels=LABELS):
+        self.columns = list(columns)
+        self.labels = list(labels)
+        self.mean = None
+        self.std = None
+        self.weights = None
+        self.bias = None
+
+    def _standardize(self, X):
+        X = (np.asarray(X, dtype=np.float64) - self.mean) / self.std
+        # Missing values (e.g. no ellipse) fall back to the training mean
+        return np.nan_to_num(X, nan=0.0)
+
+    def fit(self, X, y, l2=1e-3, learning_rate=0.5, iterations=2000):
+        """Fit on feature matrix X (rows in self.columns order) and label indices y."""
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.int64)
+        self.mean = np.nanmean(X, axis=0)
+        self.std = np.nanstd(X, axis=0)
+        self.std[~(self.std > 0)] = 1.0
+        self.mean = np.nan_to_num(self.mean)
+        X = self._standardize(X)
+
+        n, d = X.shape
+        k = len(self.labels)
+        targets = np.eye(k)[y]
+        self.weights = np.zeros((d, k))
+        self.bias = np.zeros(k)
+        for _ in range(iterations):
+            error = (self._softmax(X @ self.weights + self.bias) - targets) / n
+            self.weights -= learning_rate * (X.T @ error + l2 * self.weights)
+            self.bias -= learning_rate * error.sum(axis=0)
+        return self
+
+    @staticmethod
+    def _softmax(logits):
+        logits = logits - logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict_proba(self, X):
+        return self._softmax(self._standardize(X) @ self.weights + self.bias)
+
+    def features(self, metadata):
+        """Feature row for one metadata dict; missing fields become NaN."""
+        row = []
+        for column in self.columns:
+            value = metadata.get(column)
+            row.append(float(value) if value is not None else math.nan)
+        return row
+
+    def to_dict(self):
+        return {'columns': self.columns, 'labels': self.labels, 'mean': self.mean.tolist(),
+                'std': self.std.tolist(), 'weights': self.weights.tolist(), 'bias': self.bias.tolist()}
+
+    def save(self, path=TRIAGE_MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path=TRIAGE_MODEL_PATH):
+        with open(path) as f:
+            state = json.load(f)
+        model = cls(state['columns'], state['labels'])
+        model.mean = np.array(state['mean'])
+        model.std = np.array(state['std'])
+        model.weights = np.array(state['weights'])
+        model.bias = np.array(state['bias'])
+        return model
+
+class TriageCascade:
+    """Answers confident cases locally and leaves the rest to the model. Safe to share between threads."""
+
+    def __init__(self, model, threshold=DEFAULT_THRESHOLD):
+        self.model = model
+        self.threshold = threshold
+        self.triaged = 0
+        self.forwarded = 0
+        self._lock = threading.Lock()
+
+    def _count(self, triaged):
+        with self._lock:
+            if triaged:
+                self.triaged += 1
+            else:
+                self.forwarded += 1
+
+    def classify(self, metadata):
+        """
+        Return (label, confidence) if the triage model is confident enough, else None.
+
+        Cases with any feature missing always go to the model.
+        """
+        row = self.model.features(metadata)
+        if any(math.isnan(value) for value in row):
+            self._count(False)
+            return None
+        probabilities = self.model.predict_proba([row])[0]
+        best = int(probabilities.argmax())
+        if probabilities[best] >= self.threshold:
+            self._count(True)
+            return self.model.labels[best], float(probabilities[best])
+        self._count(False)
+        return None
+
+    def stats(self):
+        with self._lock:
+            triaged, forwarded = self.triaged, self.forwarded
+        total = triaged + forwarded
+        return {'threshold': self.threshold, 'triaged': triaged, 'forwarded': forwarded,
+                'calls_avoided': triaged / total if total else 0.0}
+
+def triage_response(label):
+    """A generateContent-shaped response carrying a triage label."""
+    return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': label}]}}]}
+
+def open_triage_cascade(path=TRIAGE_MODEL_PATH, threshold=DEFAULT_THRESHOLD):
+    """Load the cascade if a trained triage model exists at path, else return None."""
+    if not path or not os.path.exists(path):
+        return None
+    return TriageCascade(TriageModel.load(path), threshold)
+
+def configured_triage_cascade(path=TRIAGE_MODEL_PATH):
+    """
+    The cascade if PIPELINE_TRIAGE is set, with the PIPELINE_TRIAGE_THRESHOLD threshold
+    (DEFAULT_THRESHOLD if unset), else None. Raises FileNotFoundError if it is enabled but
+    no triage model has been trained.
+    """
+    if os.environ.get(TRIAGE_ENV, '').lower() in ('', '0', 'false', 'off', 'no'):
+        return None
+    threshold = float(os.environ.get(THRESHOLD_ENV) or DEFAULT_THRESHOLD)
+    cascade = open_triage_cascade(path, threshold)
+    if cascade is None:
+        raise FileNotFoundError(f"{TRIAGE_ENV} is set but there is no triage model at {path}; run triage_model.py")
+    return cascade
+
+def load_split(matched_data, split):
+    """(X, y) for one split of the metadata store; y holds indices into LABELS."""
+    df = read_metadata(matched_data, columns=['image_filename', 'category'] + TRIAGE_COLUMNS)
+    df = df[df['image_filename'].str.startswith(f"{split}/")]
+    X = df[TRIAGE_COLUMNS].to_numpy(dtype=np.float64)
+    y = df['category'].astype(str).map({label: i for i, label in enumerate(LABELS)}).to_numpy()
+    return X, y
+
+def cascade_tradeoff(probabilities, y, thresholds=THRESHOLDS):
+    """
+    Accuracy of the triaged cases against the fraction of calls avoided, per threshold.
+
+    Returns one dict per threshold.
+    """
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == y
+    rows = []
+    for threshold in thresholds:
+        triaged = confidence >= threshold
+        rows.append({
+            'threshold': threshold,
+            'calls_avoided': float(triaged.mean()) if len(y) else 0.0,
+            'triaged': int(triaged.sum()),
+            'triage_accuracy': float(correct[triaged].mean()) if triaged.any() else None,
+        })
+    return rows
+
+def print_tradeoff(rows, split):
+    print(f"\nCascade trade-off on the {split} split:")
+    print(f"{'threshold':>10} {'calls avoided':>14} {'triage accuracy':>16}")
+    for row in rows:
+        accuracy = f"{row['triage_accuracy']:.1%}" if row['triage_accuracy'] is not None else '-'
+        print(f"{row['threshold']:>10.2f} {row['calls_avoided']:>14.1%} {accuracy:>16}")
+
+def main():
+    matched_data = "partitioned_dataset"
+    if not Path(matched_data).exists():
+        print(f"Error: Metadata not found at {matched_data}")
+        return
+
+    report = StageReport('triage_model')
+    with report.phase('train', total=0):
+        X_train, y_train = load_split(matched_data, 'train')
+        model = TriageModel().fit(X_train, y_train)
+    train_accuracy = float((model.predict_proba(X_train).argmax(axis=1) == y_train).mean())
+    print(f"Trained on {len(y_train)} images (train accuracy {train_accuracy:.1%})")
+    report.set('train_accuracy', train_accuracy)
+
+    for split in ['val', 'test']:
+        X, y = load_split(matched_data, split)
+        if not len(y):
+            continue
+        probabilities = model.predict_proba(X)
+        accuracy = float((probabilities.argmax(axis=1) == y).mean())
+        print(f"\n{split}: {len(y)} images, accuracy {accuracy:.1%} when every case is triaged")
+        rows = cascade_tradeoff(probabilities, y)
+        print_tradeoff(rows, split)
+        report.set(f"{split}_tradeoff", rows)
+
+    model.save(TRIAGE_MODEL_PATH)
+    print(f"\nTriage model saved to {TRIAGE_MODEL_PATH} (default threshold {DEFAULT_THRESHOLD}); "
+          f"set {TRIAGE_ENV}=1 to use it in batch_predict.py")
+    report.write()
+
+if __name__ == "__main__":
+    main()
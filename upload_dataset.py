@@ -8,15 +8,23 @@ Upload the balanced dataset to Google Cloud Storage.
 import subprocess
 import os
 
+from crop_overlays import dataset_dirs
+from partition_dataset import fold_count
+
 def upload_dataset():
     # Define source and destination paths
     source_dir = "balanced_dataset"
+    # The ellipse-cropped images from crop_overlays.py when PIPELINE_CROP is set
+    source_dir, _ = dataset_dirs(source_dir, None)
+    # Cross-validation folds all reference the one set of overlays
+    if fold_count():
+        source_dir = "overlayed_dataset"
     bucket_name = "fetus-ultrasound-balanced-with-metadata"
-    destination = f"gs://{bucket_name}/balanced_dataset"
+    destination = f"gs://{bucket_name}/{source_dir}"
     
     # Upload the dataset
     upload_cmd = f"gsutil -m cp -r {source_dir}/* {destination}/"
-    print(f"Uploading balanced dataset to {destination}")
+    print(f"Uploading {source_dir} to {destination}")
     subprocess.run(upload_cmd, shell=True, check=True)
     
     print("\nDataset upload complete!")
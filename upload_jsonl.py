@@ -7,16 +7,28 @@ Upload the balanced JSONL files to Google Cloud Storage.
 
 import subprocess
 import os
+from glob import glob
+
+from validate_jsonl import validate_files
+from partition_dataset import fold_count
 
 def upload_jsonl():
     # Define source and destination paths
     source_dir = "jsonl"
     bucket_name = "fetus-ultrasound-balanced-with-metadata"
     destination = f"gs://{bucket_name}/jsonl"
+    pattern = "balanced_*.jsonl"
+    if fold_count():
+        source_dir, destination, pattern = "jsonl/folds", f"{destination}/folds", "fold_*.jsonl"
+    
+    # Validate before uploading so a malformed file never reaches a tuning job
+    if not validate_files(sorted(glob(f"{source_dir}/{pattern}"))):
+        print("Error: JSONL validation failed; fix the errors above before uploading")
+        return
     
     # Upload the JSONL files
-    upload_cmd = f"gsutil -m cp {source_dir}/balanced_*.jsonl {destination}/"
-    print(f"Uploading balanced JSONL files to {destination}")
+    upload_cmd = f"gsutil -m cp {source_dir}/{pattern} {destination}/"
+    print(f"Uploading {pattern} files to {destination}")
     subprocess.run(upload_cmd, shell=True, check=True)
     
     print("\nJSONL files upload complete!")
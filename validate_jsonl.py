@@ -0,0 +1,283 @@
+"""
+Preflight validation of tuning JSONL files and batch prediction inputs.
+
+Checks every line of the formats written by generate_jsonl.create_jsonl_example (tuning
+examples) and convert_batch_format (batch requests) before they are uploaded:
+
+- the line is a JSON object with the expected contents/parts structure
+- the image part has a supported mimeType and a gs:// fileUri
+- the referenced object exists, either in a manifest of gs:// URIs (one per line, e.g. from
+  `gsutil ls -r`) or as the local file upload_dataset.py copies to that URI
+- the tuning label is one of the three classes and matches the category in the image path
+- the prompt fits the token budget
+
+Files are split into byte ranges that worker processes validate while streaming, so even
+multi-GB files are checked in seconds. Errors are written to a JSON report.
+
+    python validate_jsonl.py jsonl/balanced_train_dataset.jsonl batch_prediction_input.jsonl
+
+@author: Abhinav Raghavendra
+@year: 2025
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from token_estimates import estimate_text_tokens
+
+LABELS = {'normal', 'benign', 'malignant'}
+IMAGE_MIME_TYPES = {'image/png', 'image/jpeg'}
+MAX_PROMPT_TOKENS = 2048
+# Errors kept in the report per file; all errors are still counted
+MAX_REPORTED_ERRORS = 1000
+CHUNK_BYTES = 64 * 1024 ** 2
+REPORT_DIR = 'validation'
+
+SPLITS = ('train', 'val', 'test')
+
+def object_layout(file_uri):
+    """
+    (dataset_dir, split, category, file name) of an uploaded image.
+
+    upload_dataset.py copies <dataset_dir>/<split>/<category>/<file> to gs://<bucket>/<dataset_dir>/...,
+    except for cross-validation folds, which all reference overlayed_dataset/<category>/<file>;
+    split is None for those.
+    """
+    parts = file_uri.split('/')
+    if len(parts) >= 4 and parts[-3] in SPLITS:
+        return parts[-4], parts[-3], parts[-2], parts[-1]
+    return parts[-3], None, parts[-2], parts[-1]
+
+def local_object_path(file_uri, local_root='.'):
+    """Local copy of an uploaded object: its object_layout path under local_root."""
+    return Path(local_root, *[part for part in object_layout(file_uri) if part])
+
+def detect_format(line):
+    """'tuning' or 'batch' for the first line of a file, or None if it is neither."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(record, dict) and 'request' in record:
+        return 'batch'
+    if isinstance(record, dict) and 'contents' in record:
+        return 'tuning'
+    return None
+
+def _image_and_prompt(parts, errors):
+    """Check the [image, text] parts of a user turn; return (fileUri, prompt) or (None, None)."""
+    if not isinstance(parts, list) or len(parts) != 2:
+        errors.append(('schema', "User turn must have exactly two parts: image and prompt"))
+        return None, None
+    image, text = parts
+    file_data = image.get('fileData') if isinstance(image, dict) else None
+    if not isinstance(file_data, dict):
+        errors.append(('schema', "First part must contain fileData"))
+        return None, None
+    file_uri = file_data.get('fileUri')
+    if not isinstance(file_uri, str) or not file_uri:
+        errors.append(('missing_file_uri', "fileData has no fileUri"))
+        file_uri = None
+    elif not file_uri.startswith('gs://'):
+        errors.append(('bad_file_uri', f"fileUri is not a gs:// URI: {file_uri}"))
+    if file_data.get('mimeType') not in IMAGE_MIME_TYPES:
+        errors.append(('bad_mime_type', f"Unsupported mimeType: {file_data.get('mimeType')!r}"))
+    prompt = text.get('text') if isinstance(text, dict) else None
+    if not isinstance(prompt, str) or not prompt:
+        errors.append(('missing_prompt', "Second part must contain the prompt text"))
+        prompt = None
+    return file_uri, prompt
+
+def validate_record(record, file_format, max_prompt_tokens=MAX_PROMPT_TOKENS):
+    """
+    Validate one parsed line.
+
+    Returns (file_uri, errors) where errors is a list of (code, message).
+    """
+    errors = []
+    if not isinstance(record, dict):
+        return None, [('schema', "Line is not a JSON object")]
+    if file_format == 'batch':
+        record = record.get('request')
+        if not isinstance(record, dict):
+            return None, [('schema', "Missing request object")]
+    contents = record.get('contents')
+    expected_turns = 2 if file_format == 'tuning' else 1
+    if not isinstance(contents, list) or len(contents) != expected_turns:
+        return None, [('schema', f"contents must have {expected_turns} turn(s)")]
+
+    user = contents[0]
+    if not isinstance(user, dict) or user.get('role') != 'user':
+        errors.append(('schema', "First turn must have role 'user'"))
+        return None, errors
+    file_uri, prompt = _image_and_prompt(user.get('parts'), errors)
+    if prompt is not None and estimate_text_tokens(prompt) > max_prompt_tokens:
+        errors.append(('prompt_too_long',
+                       f"Prompt is ~{estimate_text_tokens(prompt)} tokens (limit {max_prompt_tokens})"))
+
+    if file_format == 'tuning':
+        model = contents[1]
+        parts = model.get('parts') if isinstance(model, dict) else None
+        if not isinstance(model, dict) or model.get('role') != 'model' or not isinstance(parts, list) or len(parts) != 1:
+            errors.append(('schema', "Second turn must be a model turn with one part"))
+        else:
+            label = parts[0].get('text') if isinstance(parts[0], dict) else None
+            if label not in LABELS:
+                errors.append(('bad_label', f"Label {label!r} is not one of {sorted(LABELS)}"))
+            elif file_uri and len(file_uri.split('/')) >= 3 and object_layout(file_uri)[2] != label:
+                errors.append(('label_mismatch', f"Label {label!r} does not match image path {file_uri}"))
+    return file_uri, errors
+
+_manifest = None
+_local_root = None
+_exists_cache = {}
+
+def _init_worker(manifest, local_root):
+    global _manifest, _local_root
+    _manifest = manifest
+    _local_root = local_root
+
+def _object_exists(file_uri):
+    if _manifest is not None:
+        return file_uri in _manifest
+    exists = _exists_cache.get(file_uri)
+    if exists is None:
+        exists = _exists_cache[file_uri] = local_object_path(file_uri, _local_root).is_file()
+    return exists
+
+def _validate_chunk(args):
+    """
+    Worker: validate the lines that start in [start, end) of a file.
+
+    Returns (lines, errors, error_counts) with line numbers relative to the chunk.
+    """
+    path, start, end, file_format, max_prompt_tokens, max_errors = args
+    lines = 0
+    errors = []
+    counts = {}
+    with open(path, 'rb') as f:
+        if start:
+            # A line belongs to the chunk its first byte falls in
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            raw = f.readline()
+            if not raw:
+                break
+            offset = position
+            position += len(raw)
+            lines += 1
+            if not raw.strip():
+                line_errors = [('empty_line', "Empty line")]
+            else:
+                try:
+                    record = json.loads(raw)
+                except ValueError as e:
+                    line_errors = [('invalid_json', str(e))]
+                else:
+                    file_uri, line_errors = validate_record(record, file_format, max_prompt_tokens)
+                    if file_uri and file_uri.startswith('gs://') and not _object_exists(file_uri):
+                        line_errors.append(('missing_object', f"Referenced object not found: {file_uri}"))
+            for code, message in line_errors:
+                counts[code] = counts.get(code, 0) + 1
+                if len(errors) < max_errors:
+                    errors.append({'line': lines, 'offset': offset, 'code': code, 'message': message})
+    return lines, errors, counts
+
+def load_manifest(path):
+    """Set of gs:// URIs listed one per line (e.g. the output of `gsutil ls -r gs://bucket/**`)."""
+    with open(path) as f:
+        return frozenset(line.strip() for line in f if line.strip().startswith('gs://'))
+
+def validate_file(path, manifest=None, local_root='.', max_prompt_tokens=MAX_PROMPT_TOKENS, workers=None,
+                  chunk_bytes=CHUNK_BYTES, max_errors=MAX_REPORTED_ERRORS):
+    """
+    Validate one JSONL file and return the report dict.
+
+    manifest is a set of existing gs:// URIs; without one, objects are looked up under
+    local_root the way upload_dataset.py lays them out.
+    """
+    start_time = time.perf_counter()
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        first_line = f.readline()
+    file_format = detect_format(first_line)
+    report = {'file': str(path), 'format': file_format, 'bytes': size, 'lines': 0, 'valid': None,
+              'error_counts': {}, 'errors': []}
+    if file_format is None:
+        report['error_counts'] = {'unknown_format': 1}
+        report['errors'] = [{'line': 1, 'offset': 0, 'code': 'unknown_format',
+                             'message': "First line is neither a tuning example nor a batch request"}]
+        report['valid'] = False
+        report['seconds'] = time.perf_counter() - start_time
+        return report
+
+    chunks = [(str(path), start, min(start + chunk_bytes, size), file_format, max_prompt_tokens, max_errors)
+              for start in range(0, size, chunk_bytes)] or [(str(path), 0, 0, file_format, max_prompt_tokens, 0)]
+    workers = workers or min(len(chunks), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(manifest, local_root)) as executor:
+            results = list(executor.map(_validate_chunk, chunks))
+    else:
+        _init_worker(manifest, local_root)
+        results = [_validate_chunk(chunk) for chunk in chunks]
+
+    line_base = 0
+    for lines, errors, counts in results:
+        for error in errors:
+            if len(report['errors']) < max_errors:
+                report['errors'].append(dict(error, line=error['line'] + line_base))
+        for code, count in counts.items():
+            report['error_counts'][code] = report['error_counts'].get(code, 0) + count
+        line_base += lines
+    report['lines'] = line_base
+    report['valid'] = not report['error_counts']
+    report['seconds'] = time.perf_counter() - start_time
+    return report
+
+def write_report(report, report_dir=REPORT_DIR):
+    """Write a validation report next to the others and return its path."""
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"{Path(report['file']).stem}.validation.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+def print_report(report):
+    status = "OK" if report['valid'] else "FAILED"
+    print(f"{report['file']}: {status} ({report['format']}, {report['lines']} lines, {report['seconds']:.2f}s)")
+    for code, count in sorted(report['error_counts'].items()):
+        print(f"  {code}: {count}")
+    for error in report['errors'][:5]:
+        print(f"  line {error['line']}: {error['message']}")
+
+def validate_files(paths, manifest_path=None, local_root='.', max_prompt_tokens=MAX_PROMPT_TOKENS, workers=None):
+    """Validate, print and write reports for several files; return True if all are valid."""
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    all_valid = True
+    for path in paths:
+        report = validate_file(path, manifest, local_root, max_prompt_tokens, workers)
+        print_report(report)
+        print(f"  Report written to {write_report(report)}")
+        all_valid = all_valid and report['valid']
+    return all_valid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help="Tuning JSONL or batch prediction input files")
+    parser.add_argument('--manifest', help="File listing the existing gs:// objects, one per line")
+    parser.add_argument('--local-root', default='.', help="Directory holding the uploaded dataset directories")
+    parser.add_argument('--max-prompt-tokens', type=int, default=MAX_PROMPT_TOKENS)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    valid = validate_files(args.files, args.manifest, args.local_root, args.max_prompt_tokens, args.workers)
+    raise SystemExit(0 if valid else 1)
+
+if __name__ == "__main__":
+    main()